@@ -430,3 +430,58 @@ bounceback_in_obstacle(
     }
 }
 
+__kernel void
+bounceback_links(
+    __global __read_only int *link_nodes,
+    __global __read_only int *link_directions,
+    __global __read_only int *link_opposites,
+    __global float *f_global,
+    const int nx, const int ny,
+    const int num_links)
+{
+    // Input should be a 1d workgroup over the links. Every entry swaps one pair of opposite populations on a solid
+    // node next to the fluid (see LB_D2Q9.obstacles.get_bounceback_pairs); no two entries touch the same population.
+    const int link = get_global_id(0);
+
+    if (link < num_links){
+        const int two_d_index = link_nodes[link];
+        const int direction_index = link_directions[link]*ny*nx + two_d_index;
+        const int opposite_index = link_opposites[link]*ny*nx + two_d_index;
+
+        const float f_direction = f_global[direction_index];
+        f_global[direction_index] = f_global[opposite_index];
+        f_global[opposite_index] = f_direction;
+    }
+}
+
+__kernel void
+copy_link_populations(
+    __global __read_only int *link_nodes,
+    __global __read_only int *link_directions,
+    __global __read_only int *link_opposites,
+    __global float *f_global,
+    __global float *saved_global,
+    const int nx, const int ny,
+    const int num_links,
+    const int restore)
+{
+    // Input should be a 1d workgroup over the links. Saves both populations of every bounceback pair in saved_global,
+    // or writes them back into f_global if restore is set, so that the obstacle does not collide.
+    const int link = get_global_id(0);
+
+    if (link < num_links){
+        const int two_d_index = link_nodes[link];
+        const int direction_index = link_directions[link]*ny*nx + two_d_index;
+        const int opposite_index = link_opposites[link]*ny*nx + two_d_index;
+
+        if (restore == 0){
+            saved_global[2*link] = f_global[direction_index];
+            saved_global[2*link + 1] = f_global[opposite_index];
+        }
+        else{
+            f_global[direction_index] = saved_global[2*link];
+            f_global[opposite_index] = saved_global[2*link + 1];
+        }
+    }
+}
+
@@ -6,6 +6,8 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import field_access
 
 # Required to draw obstacles
 import skimage as ski
@@ -52,12 +54,20 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Fisher_Expansion(object):
+class Fisher_Expansion(checkpoint.Checkpointable, field_access.Field_Access):
     """
     Simulates pipe flow using the D2Q9 lattice. Generally used to verify that our simulations were working correctly.
     For usage, see the docs folder.
     """
 
+    field_shapes = {
+        'f': ('nx', 'ny', 'num_populations', NUM_JUMPERS),
+        'feq': ('nx', 'ny', 'num_populations', NUM_JUMPERS),
+        'u': ('nx', 'ny'),
+        'v': ('nx', 'ny'),
+        'rho': ('nx', 'ny', 'num_populations')
+    }
+
     def __init__(self, Lx=1.0, Ly=1.0,
                  vx=0., vy=0., vc=0.,
                  mu_standard = 1.0, mu_list=None,
@@ -168,6 +178,9 @@ class Fisher_Expansion(object):
         self.lb_D_population_buf = None
         self.omega_buf = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v'] # Device fields saved by save_checkpoint
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables
@@ -449,32 +462,14 @@ class Fisher_Expansion(object):
             self.update_feq() # Update the equilibrium fields
             self.collide_particles() # Relax the nonequilibrium fields. Reaction takes place here.
 
+            self.step_count += 1
+
     def get_fields(self):
         """
-        :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
+        :return: Returns a dictionary of all fields. A field is only transferred from the GPU to the CPU the first
+                 time it is accessed, so reading fields['rho'] does not transfer f.
         """
-        f = np.zeros((self.nx, self.ny, self.num_populations, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, f, self.f, is_blocking=True)
-
-        feq = np.zeros((self.nx, self.ny, self.num_populations, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, feq, self.feq, is_blocking=True)
-
-        u = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, u, self.u, is_blocking=True)
-
-        v = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, v, self.v, is_blocking=True)
-
-        rho = np.zeros((self.nx, self.ny, self.num_populations), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, rho, self.rho, is_blocking=True)
-
-        results={}
-        results['f'] = f
-        results['u'] = u
-        results['v'] = v
-        results['rho'] = rho
-        results['feq'] = feq
-        return results
+        return field_access.Lazy_Fields(self.get_field, ['f', 'u', 'v', 'rho', 'feq'])
 
     def get_nondim_fields(self):
         """
@@ -482,8 +477,8 @@ class Fisher_Expansion(object):
         """
         fields = self.get_fields()
 
-        fields['u'] *= self.delta_x/self.delta_t
-        fields['v'] *= self.delta_x/self.delta_t
+        fields.scale('u', self.delta_x/self.delta_t)
+        fields.scale('v', self.delta_x/self.delta_t)
 
         return fields
 
@@ -494,7 +489,7 @@ class Fisher_Expansion(object):
         """
         fields = self.get_nondim_fields()
 
-        fields['u'] *= (self.L/self.T)
-        fields['v'] *= (self.L/self.T)
+        fields.scale('u', self.L/self.T)
+        fields.scale('v', self.L/self.T)
 
         return fields
\ No newline at end of file
@@ -6,6 +6,8 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import field_access
 
 # Required to draw obstacles
 import skimage as ski
@@ -52,7 +54,7 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Expansion(object):
+class Expansion(checkpoint.Checkpointable, field_access.Field_Access):
     """
     Simulates pipe flow using the D2Q9 lattice. Generally used to verify that our simulations were working correctly.
     For usage, see the docs folder.
@@ -179,6 +181,9 @@ class Expansion(object):
         self.lb_D_population_buf = None
         self.omega_buf = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'random_normal'] # Device fields saved by save_checkpoint
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables
@@ -495,32 +500,25 @@ class Expansion(object):
             self.random_generator.fill_normal(self.random_normal, queue=self.queue)
             self.random_normal.finish()
 
+            self.step_count += 1
+
+    def get_field_shapes(self):
+        """The nutrient concentration is stored as an extra population after the num_populations fields"""
+        num_fields = self.num_populations + 1
+        return {
+            'f': (self.nx, self.ny, num_fields, NUM_JUMPERS),
+            'feq': (self.nx, self.ny, num_fields, NUM_JUMPERS),
+            'u': (self.nx, self.ny),
+            'v': (self.nx, self.ny),
+            'rho': (self.nx, self.ny, num_fields)
+        }
+
     def get_fields(self):
         """
-        :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
+        :return: Returns a dictionary of all fields. A field is only transferred from the GPU to the CPU the first
+                 time it is accessed, so reading fields['rho'] does not transfer f.
         """
-        f = np.zeros((self.nx, self.ny, self.num_populations + 1, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, f, self.f, is_blocking=True)
-
-        feq = np.zeros((self.nx, self.ny, self.num_populations + 1, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, feq, self.feq, is_blocking=True)
-
-        u = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, u, self.u, is_blocking=True)
-
-        v = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, v, self.v, is_blocking=True)
-
-        rho = np.zeros((self.nx, self.ny, self.num_populations + 1), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, rho, self.rho, is_blocking=True)
-
-        results={}
-        results['f'] = f
-        results['u'] = u
-        results['v'] = v
-        results['rho'] = rho
-        results['feq'] = feq
-        return results
+        return field_access.Lazy_Fields(self.get_field, ['f', 'u', 'v', 'rho', 'feq'])
 
     def get_nondim_fields(self):
         """
@@ -528,8 +526,8 @@ class Expansion(object):
         """
         fields = self.get_fields()
 
-        fields['u'] *= self.delta_x/self.delta_t
-        fields['v'] *= self.delta_x/self.delta_t
+        fields.scale('u', self.delta_x/self.delta_t)
+        fields.scale('v', self.delta_x/self.delta_t)
 
         return fields
 
@@ -540,7 +538,7 @@ class Expansion(object):
         """
         fields = self.get_nondim_fields()
 
-        fields['u'] *= (self.L/self.T)
-        fields['v'] *= (self.L/self.T)
+        fields.scale('u', self.L/self.T)
+        fields.scale('v', self.L/self.T)
 
         return fields
\ No newline at end of file
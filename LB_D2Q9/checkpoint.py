@@ -0,0 +1,313 @@
+"""
+Checkpoint/restart of simulation state that lives on the OpenCL device.
+
+A checkpoint is a single binary file with the layout
+
+    [magic (8 bytes)][version (uint32)][header length (uint32)][JSON header][padding][field 0][field 1]...
+
+The JSON header records, for every field, its byte offset relative to the start of the data section and its size,
+together with the step counter, the scalar parameters of the runner, the state of any random number generators and
+the host state the runner needs to continue the same trajectory (see Checkpointable). Every field starts on a page
+boundary, so that loading can memory-map the file and upload each field to the device directly, without an
+intermediate host copy.
+
+Runners get save_checkpoint and load_checkpoint from the Checkpointable mixin.
+"""
+
+import numpy as np
+import os
+import json
+import numbers
+import struct
+import pyopencl as cl
+import pyopencl.array
+
+CHECKPOINT_MAGIC = b'LBCKPT\x00\x00'
+CHECKPOINT_VERSION = 1
+ALIGNMENT = 4096 # Fields are page aligned so that they can be memory-mapped efficiently
+
+_prefix = struct.Struct('<8sII')
+
+
+def align_up(num_bytes, alignment=ALIGNMENT):
+    """Round num_bytes up to the nearest multiple of alignment."""
+    return ((num_bytes + alignment - 1) // alignment) * alignment
+
+
+def get_attribute(sim, name):
+    """
+    Returns the attribute name of sim. Dotted names reach into the objects sim owns, and integer parts index lists,
+    i.e. 'poisson_solver.charge' or 'rho_history.0'.
+    """
+    value = sim
+    for part in name.split('.'):
+        if isinstance(value, list):
+            value = value[int(part)]
+        else:
+            value = getattr(value, part)
+    return value
+
+
+def get_field_layout(sizes):
+    """
+    :param sizes: The size in bytes of every field, in order
+    :return: A tuple (offsets, total size) of the fields in the data section, every field starting on a page boundary
+    """
+    offsets = []
+    data_offset = 0
+    for num_bytes in sizes:
+        offsets.append(data_offset)
+        data_offset += align_up(num_bytes)
+    return offsets, data_offset
+
+
+def write_header(checkpoint_file, header):
+    """
+    Writes the prefix and the JSON header to the start of an open checkpoint file.
+
+    :return: The byte offset of the data section
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    checkpoint_file.write(_prefix.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, len(header_bytes)))
+    checkpoint_file.write(header_bytes)
+    return align_up(_prefix.size + len(header_bytes))
+
+
+def get_device_buffer(device_field):
+    """
+    Returns the underlying cl.Buffer and its size in bytes. Runners store their fields either as raw cl.Buffers or
+    as cl.array.Arrays; both are handled here.
+    """
+    if isinstance(device_field, cl.array.Array):
+        return device_field.data, device_field.nbytes
+    else:
+        return device_field, device_field.size
+
+
+def get_parameters(sim):
+    """Returns a dictionary of all scalar (number or string) attributes of the runner."""
+    parameters = {}
+    for name, value in sim.__dict__.items():
+        if isinstance(value, (bool, np.bool_)):
+            parameters[name] = bool(value)
+        elif isinstance(value, numbers.Number) and not isinstance(value, complex):
+            if isinstance(value, np.generic):
+                value = value.item()
+            parameters[name] = value
+        elif isinstance(value, basestring):
+            parameters[name] = value
+    return parameters
+
+
+def get_rng_state(sim):
+    """Returns the state of the host (numpy) and device (Philox) random number generators."""
+    rng_state = {}
+
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    rng_state['numpy'] = [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+    random_generator = getattr(sim, 'random_generator', None)
+    if random_generator is not None:
+        rng_state['device'] = {
+            'key': [int(k) for k in random_generator.key],
+            'counter': [int(c) for c in random_generator.counter]
+        }
+
+    return rng_state
+
+
+def set_rng_state(sim, rng_state):
+    """Restores the random number generators saved by get_rng_state."""
+    if 'numpy' in rng_state:
+        name, keys, pos, has_gauss, cached_gaussian = rng_state['numpy']
+        np.random.set_state((str(name), np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+    random_generator = getattr(sim, 'random_generator', None)
+    if (random_generator is not None) and ('device' in rng_state):
+        random_generator.key = list(rng_state['device']['key'])
+        random_generator.counter = list(rng_state['device']['counter'])
+
+
+def save_checkpoint(sim, path, field_names, step=0, state=None):
+    """
+    Writes the device fields of a runner to disk. The checkpoint is first written to a temporary file that is then
+    renamed onto path, so a run that is killed mid-write never leaves a corrupt checkpoint behind.
+
+    :param sim: The runner to save. Must have a queue and all of the attributes in field_names.
+    :param path: The file to write the checkpoint to.
+    :param field_names: A list of the attributes of sim to save, i.e. ['f', 'rho', 'u', 'v']. See get_attribute.
+    :param step: The number of steps the runner has taken.
+    :param state: A JSON serialisable dictionary of host state to store in the header
+    """
+
+    # Figure out where everything goes first
+    device_fields = [get_attribute(sim, name) for name in field_names]
+    sizes = [get_device_buffer(device_field)[1] for device_field in device_fields]
+    offsets, data_size = get_field_layout(sizes)
+
+    field_info = []
+    for name, device_field, offset, num_bytes in zip(field_names, device_fields, offsets, sizes):
+        info = {'name': name, 'offset': offset, 'nbytes': num_bytes}
+        if isinstance(device_field, cl.array.Array):
+            info['dtype'] = device_field.dtype.str
+            info['shape'] = [int(s) for s in device_field.shape]
+            info['order'] = 'F' if device_field.flags.f_contiguous else 'C'
+        field_info.append(info)
+
+    header = {
+        'version': CHECKPOINT_VERSION,
+        'class': type(sim).__name__,
+        'step': int(step),
+        'fields': field_info,
+        'parameters': get_parameters(sim),
+        'rng': get_rng_state(sim),
+        'state': {} if state is None else state
+    }
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as checkpoint_file:
+        data_start = write_header(checkpoint_file, header)
+
+        for info, device_field in zip(field_info, device_fields):
+            buf, num_bytes = get_device_buffer(device_field)
+
+            host = np.empty(num_bytes, dtype=np.uint8)
+            cl.enqueue_copy(sim.queue, host, buf, is_blocking=True)
+
+            checkpoint_file.seek(data_start + info['offset'])
+            host.tofile(checkpoint_file)
+
+        # Pad the file so that the last field can be memory mapped in full
+        checkpoint_file.truncate(data_start + data_size)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+    os.rename(temp_path, path)
+
+
+def read_header(path):
+    """
+    Reads the header of a checkpoint.
+
+    :return: A tuple of (header dictionary, byte offset of the data section)
+    """
+    with open(path, 'rb') as checkpoint_file:
+        magic, version, header_length = _prefix.unpack(checkpoint_file.read(_prefix.size))
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError(path + ' is not a checkpoint file.')
+        if version > CHECKPOINT_VERSION:
+            raise ValueError('Checkpoint version ' + str(version) + ' is newer than this code supports.')
+        header = json.loads(checkpoint_file.read(header_length).decode('utf-8'))
+
+    return header, align_up(_prefix.size + header_length)
+
+
+def load_checkpoint(sim, path, field_names=None):
+    """
+    Memory-maps a checkpoint written by save_checkpoint and uploads its fields directly into the existing device
+    buffers of sim. The runner must already be constructed with the same grid as the checkpoint.
+
+    :param sim: The runner to restore.
+    :param path: The checkpoint file.
+    :param field_names: The fields to restore. If None, every field in the checkpoint is restored.
+    :return: The checkpoint header, i.e. header['step'] is the saved step counter.
+    """
+
+    header, data_start = read_header(path)
+    saved_fields = dict((info['name'], info) for info in header['fields'])
+
+    if field_names is None:
+        field_names = [info['name'] for info in header['fields']]
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    events = []
+    for name in field_names:
+        if name not in saved_fields:
+            raise ValueError('Field ' + name + ' is not in the checkpoint ' + path)
+        info = saved_fields[name]
+
+        buf, num_bytes = get_device_buffer(get_attribute(sim, name))
+        if num_bytes != info['nbytes']:
+            raise ValueError('Field ' + name + ' has ' + str(num_bytes) + ' bytes on the device but ' +
+                             str(info['nbytes']) + ' bytes in the checkpoint. Is the grid the same?')
+
+        start = data_start + info['offset']
+        events.append(cl.enqueue_copy(sim.queue, buf, data[start:start + num_bytes], is_blocking=False))
+
+    if len(events) > 0:
+        cl.wait_for_events(events)
+    del data
+
+    set_rng_state(sim, header['rng'])
+
+    return header
+
+
+class Checkpointable(object):
+    """
+    Gives a runner save_checkpoint and load_checkpoint.
+
+    The runner lists its device fields in checkpoint_fields and counts its steps in the attribute named by
+    checkpoint_step_attribute. Fields that are not allocated (None) are skipped. The objects the runner owns that carry
+    state of their own, i.e. a Poisson solver and its resolve schedule, are named in checkpoint_children; they are
+    Checkpointable themselves and are saved into the same file. Host state beyond the fields is returned by
+    get_checkpoint_state as a JSON serialisable dictionary and handed back to set_checkpoint_state before the fields
+    are loaded, so that it can allocate any field that the restored state needs.
+    """
+
+    checkpoint_fields = []
+    checkpoint_children = []
+    checkpoint_step_attribute = 'step_count'
+
+    def get_checkpoint_children(self):
+        """:return: A list of (name, child) of the children that exist."""
+        children = []
+        for name in self.checkpoint_children:
+            child = getattr(self, name, None)
+            if child is not None:
+                children.append((name, child))
+        return children
+
+    def get_checkpoint_fields(self):
+        """:return: The names of every device field to save, including those of the children."""
+        names = [name for name in self.checkpoint_fields if get_attribute(self, name) is not None]
+        for child_name, child in self.get_checkpoint_children():
+            names += [child_name + '.' + name for name in child.get_checkpoint_fields()]
+        return names
+
+    def get_checkpoint_state(self):
+        """:return: The host state to restore with the fields"""
+        state = {}
+        for name, child in self.get_checkpoint_children():
+            state[name] = child.get_checkpoint_state()
+        return state
+
+    def set_checkpoint_state(self, state):
+        for name, child in self.get_checkpoint_children():
+            if name in state:
+                child.set_checkpoint_state(state[name])
+
+    def save_checkpoint(self, path):
+        """
+        Saves the state of the simulation on the device, the step counter, the parameters, the state of the random
+        number generators and of any solver the runner owns to a single file.
+
+        :param path: The file to write the checkpoint to.
+        """
+        save_checkpoint(self, path, self.get_checkpoint_fields(), step=getattr(self, self.checkpoint_step_attribute),
+                        state=self.get_checkpoint_state())
+
+    def load_checkpoint(self, path):
+        """
+        Restores a checkpoint written by save_checkpoint. The runner must already be set up the same way, i.e. with
+        the same grid and the same forces.
+
+        :param path: The checkpoint file to load.
+        :return: The checkpoint header
+        """
+        header = read_header(path)[0]
+        self.set_checkpoint_state(header.get('state', {}))
+        header = load_checkpoint(self, path, self.get_checkpoint_fields())
+        setattr(self, self.checkpoint_step_attribute, header['step'])
+        return header
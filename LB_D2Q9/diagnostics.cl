@@ -0,0 +1,149 @@
+// Fused reductions used to monitor the health of a simulation. Compiled with -D NUM_TYPE=float or -D NUM_TYPE=double
+// (plus -D USE_DOUBLE for the latter) so that the same code serves single and double precision runners.
+
+#ifdef USE_DOUBLE
+    #ifdef cl_khr_fp64
+        #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    #elif defined(cl_amd_fp64)
+        #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+    #else
+        #error "Double precision floating point not supported by OpenCL implementation."
+    #endif
+#endif
+
+// The layout of the diagnostics of each population
+#define DIAG_MASS 0
+#define DIAG_MOMENTUM_X 1
+#define DIAG_MOMENTUM_Y 2
+#define DIAG_MAX_SPEED 3
+#define DIAG_RHO_MIN 4
+#define DIAG_RHO_MAX 5
+#define DIAG_NUM_NONFINITE 6
+#define NUM_DIAGNOSTICS 7
+
+void
+combine_diagnostics(__local NUM_TYPE *a, __local NUM_TYPE *b)
+{
+    // Combines the partial diagnostics in b into a.
+    a[DIAG_MASS] += b[DIAG_MASS];
+    a[DIAG_MOMENTUM_X] += b[DIAG_MOMENTUM_X];
+    a[DIAG_MOMENTUM_Y] += b[DIAG_MOMENTUM_Y];
+    a[DIAG_MAX_SPEED] = fmax(a[DIAG_MAX_SPEED], b[DIAG_MAX_SPEED]);
+    a[DIAG_RHO_MIN] = fmin(a[DIAG_RHO_MIN], b[DIAG_RHO_MIN]);
+    a[DIAG_RHO_MAX] = fmax(a[DIAG_RHO_MAX], b[DIAG_RHO_MAX]);
+    a[DIAG_NUM_NONFINITE] += b[DIAG_NUM_NONFINITE];
+}
+
+void
+reduce_local(__local NUM_TYPE *local_diag, const int lid, const int local_size)
+{
+    // Tree reduction over the work group; local_size must be a power of two.
+    for(int offset = local_size/2; offset > 0; offset /= 2){
+        barrier(CLK_LOCAL_MEM_FENCE);
+        if (lid < offset){
+            combine_diagnostics(&local_diag[lid*NUM_DIAGNOSTICS], &local_diag[(lid + offset)*NUM_DIAGNOSTICS]);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+__kernel void
+compute_diagnostics(
+    __global __read_only NUM_TYPE *rho_global,
+    __global __read_only NUM_TYPE *u_global,
+    __global __read_only NUM_TYPE *v_global,
+    __global NUM_TYPE *partial_global,
+    __local NUM_TYPE *local_diag,
+    const int num_nodes,
+    const int velocity_stride)
+{
+    // First stage: every work group reduces a strided share of the nodes of one population (dimension 1) in a
+    // single pass over rho, u and v and writes one partial result.
+    const int lid = get_local_id(0);
+    const int local_size = get_local_size(0);
+    const int group = get_group_id(0);
+    const int num_groups = get_num_groups(0);
+    const int population = get_global_id(1);
+
+    const int rho_offset = population*num_nodes;
+    const int velocity_offset = population*velocity_stride;
+
+    NUM_TYPE mass = 0;
+    NUM_TYPE momentum_x = 0;
+    NUM_TYPE momentum_y = 0;
+    NUM_TYPE max_speed = 0;
+    NUM_TYPE rho_min = INFINITY;
+    NUM_TYPE rho_max = -INFINITY;
+    NUM_TYPE num_nonfinite = 0;
+
+    for(int i = get_global_id(0); i < num_nodes; i += local_size*num_groups){
+        const NUM_TYPE rho = rho_global[rho_offset + i];
+        const NUM_TYPE u = u_global[velocity_offset + i];
+        const NUM_TYPE v = v_global[velocity_offset + i];
+
+        if (isfinite(rho) && isfinite(u) && isfinite(v)){
+            mass += rho;
+            momentum_x += rho*u;
+            momentum_y += rho*v;
+            max_speed = fmax(max_speed, sqrt(u*u + v*v));
+            rho_min = fmin(rho_min, rho);
+            rho_max = fmax(rho_max, rho);
+        }
+        else num_nonfinite += 1;
+    }
+
+    __local NUM_TYPE *my_diag = &local_diag[lid*NUM_DIAGNOSTICS];
+    my_diag[DIAG_MASS] = mass;
+    my_diag[DIAG_MOMENTUM_X] = momentum_x;
+    my_diag[DIAG_MOMENTUM_Y] = momentum_y;
+    my_diag[DIAG_MAX_SPEED] = max_speed;
+    my_diag[DIAG_RHO_MIN] = rho_min;
+    my_diag[DIAG_RHO_MAX] = rho_max;
+    my_diag[DIAG_NUM_NONFINITE] = num_nonfinite;
+
+    reduce_local(local_diag, lid, local_size);
+
+    if (lid < NUM_DIAGNOSTICS){
+        partial_global[(population*num_groups + group)*NUM_DIAGNOSTICS + lid] = local_diag[lid];
+    }
+}
+
+__kernel void
+finish_diagnostics(
+    __global __read_only NUM_TYPE *partial_global,
+    __global NUM_TYPE *result_global,
+    __local NUM_TYPE *local_diag,
+    const int num_partials)
+{
+    // Second stage: a single work group per population combines the partial results of the first stage.
+    const int lid = get_local_id(0);
+    const int local_size = get_local_size(0);
+    const int population = get_global_id(1);
+
+    __local NUM_TYPE *my_diag = &local_diag[lid*NUM_DIAGNOSTICS];
+    my_diag[DIAG_MASS] = 0;
+    my_diag[DIAG_MOMENTUM_X] = 0;
+    my_diag[DIAG_MOMENTUM_Y] = 0;
+    my_diag[DIAG_MAX_SPEED] = 0;
+    my_diag[DIAG_RHO_MIN] = INFINITY;
+    my_diag[DIAG_RHO_MAX] = -INFINITY;
+    my_diag[DIAG_NUM_NONFINITE] = 0;
+
+    for(int i = lid; i < num_partials; i += local_size){
+        // Each work item only touches its own slot here, so no barrier is needed before the tree reduction.
+        __global const NUM_TYPE *partial = &partial_global[(population*num_partials + i)*NUM_DIAGNOSTICS];
+        my_diag[DIAG_MASS] += partial[DIAG_MASS];
+        my_diag[DIAG_MOMENTUM_X] += partial[DIAG_MOMENTUM_X];
+        my_diag[DIAG_MOMENTUM_Y] += partial[DIAG_MOMENTUM_Y];
+        my_diag[DIAG_MAX_SPEED] = fmax(my_diag[DIAG_MAX_SPEED], partial[DIAG_MAX_SPEED]);
+        my_diag[DIAG_RHO_MIN] = fmin(my_diag[DIAG_RHO_MIN], partial[DIAG_RHO_MIN]);
+        my_diag[DIAG_RHO_MAX] = fmax(my_diag[DIAG_RHO_MAX], partial[DIAG_RHO_MAX]);
+        my_diag[DIAG_NUM_NONFINITE] += partial[DIAG_NUM_NONFINITE];
+    }
+
+    reduce_local(local_diag, lid, local_size);
+
+    if (lid < NUM_DIAGNOSTICS){
+        result_global[population*NUM_DIAGNOSTICS + lid] = local_diag[lid];
+    }
+}
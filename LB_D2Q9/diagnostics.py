@@ -0,0 +1,154 @@
+"""
+On-device health checks for any runner.
+
+Diagnostics computes, for every population, the mass, the momentum, the maximum speed, the minimum and maximum
+density and the number of non-finite (NaN/Inf) nodes in a single pass over rho, u and v. The results land in a small
+device buffer; only that buffer (a few numbers per population) is transferred when they are read.
+"""
+
+import numpy as np
+import os
+import weakref
+import pyopencl as cl
+import pyopencl.array
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The layout of the diagnostics of each population; must match diagnostics.cl
+DIAGNOSTIC_NAMES = ['mass', 'momentum_x', 'momentum_y', 'max_speed', 'rho_min', 'rho_max', 'num_nonfinite']
+NUM_DIAGNOSTICS = len(DIAGNOSTIC_NAMES)
+
+# Holds the programs weakly, as they keep their context alive; see memory_pool._allocator_cache
+_program_cache = weakref.WeakValueDictionary()
+
+
+def get_program(context, dtype, source_name='diagnostics.cl'):
+    """
+    Compiles an OpenCL file of this directory that is written in terms of NUM_TYPE for the given floating point type.
+    Programs are shared per context for as long as any user holds on to them.
+    """
+    # A program holds its context, so the address can not be reused by another context while the entry exists
+    key = (context.int_ptr, np.dtype(dtype).str, source_name)
+    program = _program_cache.get(key)
+    if program is None:
+        if np.dtype(dtype) == np.float64:
+            options = '-D NUM_TYPE=double -D USE_DOUBLE'
+        else:
+            options = '-D NUM_TYPE=float'
+        program = cl.Program(context, open(file_dir + '/' + source_name).read()).build(options=options)
+        _program_cache[key] = program
+    return program
+
+
+def get_buffer_and_type(device_field):
+    """Returns the cl.Buffer, type and size in bytes of a field stored as either a cl.Buffer or a cl.array."""
+    if isinstance(device_field, cl.array.Array):
+        return device_field.data, device_field.dtype, device_field.nbytes
+    else:
+        return device_field, np.dtype(np.float32), device_field.size
+
+
+class Diagnostics(object):
+    """
+    Fused reductions over rho, u and v of a runner. Call compute() to enqueue them (no host synchronization) and get()
+    to read the results back. With an interval, sample() only computes every interval steps.
+    """
+
+    def __init__(self, sim, interval=1, local_size=256, num_groups=64):
+        """
+        :param sim: The runner to monitor. Must have context, queue, nx, ny, rho, u and v. rho may hold several
+            populations; u and v may either hold one velocity per population or a single (barycentric) velocity.
+        :param interval: sample() only computes the diagnostics every interval steps.
+        :param local_size: The work group size of the reductions; rounded down to a power of two the device supports.
+        :param num_groups: The number of work groups that share the nodes of each population in the first stage.
+        """
+        self.sim = sim
+        self.interval = int(interval)
+        if self.interval < 1:
+            raise ValueError('The diagnostics interval must be at least one step.')
+
+        self.num_nodes = int(sim.nx) * int(sim.ny)
+
+        rho_buf, self.dtype, rho_bytes = get_buffer_and_type(sim.rho)
+        u_buf, u_type, u_bytes = get_buffer_and_type(sim.u)
+        self.num_populations = rho_bytes // (self.num_nodes * self.dtype.itemsize)
+
+        # Velocities are either per population or shared
+        if u_bytes // (self.num_nodes * u_type.itemsize) == self.num_populations:
+            self.velocity_stride = self.num_nodes
+        else:
+            self.velocity_stride = 0
+
+        max_size = min(local_size, sim.context.devices[0].max_work_group_size)
+        self.local_size = 2**int(np.floor(np.log2(max_size)))
+        self.num_groups = int(max(1, min(num_groups, (self.num_nodes + self.local_size - 1) // self.local_size)))
+
+        self.kernels = get_program(sim.context, self.dtype)
+
+        self.partials = cl.array.empty(sim.queue, (self.num_populations, self.num_groups, NUM_DIAGNOSTICS),
+                                       dtype=self.dtype)
+        self.results = cl.array.zeros(sim.queue, (self.num_populations, NUM_DIAGNOSTICS), dtype=self.dtype)
+        self.local_diag = cl.LocalMemory(self.local_size * NUM_DIAGNOSTICS * self.dtype.itemsize)
+
+        self.last_step = None # The step at which the diagnostics were last computed
+
+    def compute(self):
+        """Enqueues the reductions. Does not wait for them to finish."""
+        sim = self.sim
+        rho_buf = get_buffer_and_type(sim.rho)[0]
+        u_buf = get_buffer_and_type(sim.u)[0]
+        v_buf = get_buffer_and_type(sim.v)[0]
+
+        self.kernels.compute_diagnostics(
+            sim.queue, (self.num_groups * self.local_size, self.num_populations), (self.local_size, 1),
+            rho_buf, u_buf, v_buf, self.partials.data, self.local_diag,
+            np.int32(self.num_nodes), np.int32(self.velocity_stride))
+
+        self.kernels.finish_diagnostics(
+            sim.queue, (self.local_size, self.num_populations), (self.local_size, 1),
+            self.partials.data, self.results.data, self.local_diag,
+            np.int32(self.num_groups))
+
+        self.last_step = getattr(sim, 'step_count', None)
+
+    def sample(self):
+        """
+        Computes the diagnostics if the step counter of the runner is a multiple of interval.
+
+        :return: True if the diagnostics were computed.
+        """
+        if getattr(self.sim, 'step_count', 0) % self.interval == 0:
+            self.compute()
+            return True
+        return False
+
+    def get(self):
+        """
+        Transfers the results of the last compute() to the host.
+
+        :return: A dictionary mapping each name in DIAGNOSTIC_NAMES to an array with one entry per population.
+        """
+        results = self.results.get()
+        diagnostics = {}
+        for i, name in enumerate(DIAGNOSTIC_NAMES):
+            diagnostics[name] = results[:, i]
+        diagnostics['num_nonfinite'] = diagnostics['num_nonfinite'].astype(np.int64)
+        return diagnostics
+
+    def get_max_mach(self, cs=1./np.sqrt(3)):
+        """:return: The maximum Mach number of every population, from the last compute()."""
+        return self.get()['max_speed'] / cs
+
+    def report(self):
+        """Prints the diagnostics of every population and the totals."""
+        diagnostics = self.get()
+        for i in range(self.num_populations):
+            print 'Field:', i
+            for name in DIAGNOSTIC_NAMES:
+                print name, diagnostics[name][i]
+
+        print 'Total mass', np.sum(diagnostics['mass'])
+        print 'Total momentum', np.sum(diagnostics['momentum_x']), np.sum(diagnostics['momentum_y'])
+        print 'Total non-finite nodes', np.sum(diagnostics['num_nonfinite'])
+
+        print
@@ -3,6 +3,10 @@ import os
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 import pyopencl as cl
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import field_access
+from LB_D2Q9 import geometry
+from LB_D2Q9 import obstacles
 
 # Required to draw obstacles
 import skimage as ski
@@ -54,7 +58,7 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Pipe_Flow(object):
+class Pipe_Flow(checkpoint.Checkpointable, field_access.Field_Access):
     """
     Simulates pipe flow using the D2Q9 lattice. Generally used to verify that our simulations were working correctly.
     For usage, see the docs folder.
@@ -143,6 +147,9 @@ class Pipe_Flow(object):
         self.local_u = None
         self.local_v = None
         self.local_rho = None
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v'] # Device fields saved by save_checkpoint
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables
@@ -371,33 +378,15 @@ class Pipe_Flow(object):
 
             self.collide_particles() # Relax the nonequilibrium fields.
 
+            self.step_count += 1
+
 
     def get_fields(self):
         """
-        :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
+        :return: Returns a dictionary of all fields. A field is only transferred from the GPU to the CPU the first
+                 time it is accessed, so reading fields['rho'] does not transfer f.
         """
-        f = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, f, self.f, is_blocking=True)
-
-        feq = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, feq, self.feq, is_blocking=True)
-
-        u = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, u, self.u, is_blocking=True)
-
-        v = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, v, self.v, is_blocking=True)
-
-        rho = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, rho, self.rho, is_blocking=True)
-
-        results={}
-        results['f'] = f
-        results['u'] = u
-        results['v'] = v
-        results['rho'] = rho
-        results['feq'] = feq
-        return results
+        return field_access.Lazy_Fields(self.get_field, ['f', 'u', 'v', 'rho', 'feq'])
 
     def get_nondim_fields(self):
         """
@@ -405,8 +394,8 @@ class Pipe_Flow(object):
         """
         fields = self.get_fields()
 
-        fields['u'] *= self.delta_x/self.delta_t
-        fields['v'] *= self.delta_x/self.delta_t
+        fields.scale('u', self.delta_x/self.delta_t)
+        fields.scale('v', self.delta_x/self.delta_t)
 
         return fields
 
@@ -417,17 +406,16 @@ class Pipe_Flow(object):
         """
         fields = self.get_nondim_fields()
 
-        fields['u'] *= (self.L/self.T)
-        fields['v'] *= (self.L/self.T)
+        fields.scale('u', self.L/self.T)
+        fields.scale('v', self.L/self.T)
 
         return fields
 
 
 class Pipe_Flow_Cylinder(Pipe_Flow):
     """
-    A subclass of the Pipe Flow class that simulates fluid flow around a cylinder. This class can also be "hacked"
-    in its current state to simulate flow around arbitrary obstacles. See
-    https://github.com/latticeboltzmann/2d-lb/blob/master/docs/cs205_movie.ipynb for an example of how to do so.
+    A subclass of the Pipe Flow class that simulates fluid flow around a cylinder. Arbitrary obstacles, i.e. polygons
+    or image masks, are passed as the geometry argument; see LB_D2Q9.geometry.
     """
 
     def set_characteristic_length_time(self):
@@ -448,25 +436,24 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
         self.nx = self.lx + 1 # Total size of grid in x including boundary
         self.ny = self.ly + 1 # Total size of grid in y including boundary
 
-        ## Initialize the obstacle mask
-        self.obstacle_mask_host = np.zeros((self.nx, self.ny), dtype=np.int32, order='F')
-
-        # Initialize the obstacle in the correct place
-        x_cylinder = self.N * self.phys_cylinder_center[0]/self.L
-        y_cylinder = self.N * self.phys_cylinder_center[1]/self.L
+        ## Initialize the obstacle mask. It is rasterised once per resolution and cached with its boundary links.
+        if self.geometry is None:
+            self.geometry = geometry.Circle(np.array(self.phys_cylinder_center)/self.L, self.phys_cylinder_radius/self.L)
+        self.rasterized_geometry = geometry.get_rasterized_geometry(self.geometry, self.nx, self.ny, self.N)
+        self.obstacle_mask_host = self.rasterized_geometry.mask.astype(np.int32, order='F')
 
-        circle = ski.draw.circle(x_cylinder, y_cylinder, self.N)
-        self.obstacle_mask_host[circle[0], circle[1]] = 1
 
-
-    def __init__(self, cylinder_center = None, cylinder_radius=None, **kwargs):
+    def __init__(self, cylinder_center = None, cylinder_radius=None, geometry=None, **kwargs):
         """
-        :param cylinder_center: The center of the cylinder in physical units.
-        :param cylinder_radius: The raidus of the cylinder in physical units.
+        :param cylinder_center: The center of the cylinder in physical units. Unused if geometry is given.
+        :param cylinder_radius: The raidus of the cylinder in physical units. Also sets the characteristic length.
+        :param geometry: The obstacle, any shape of LB_D2Q9.geometry in units of the cylinder radius, i.e. a Polygon
+            or an Image_Mask. Defaults to the Circle given by cylinder_center and cylinder_radius.
         :param kwargs: All keyword arguments required to initialize the pipe-flow class.
         """
 
-        assert (cylinder_center is not None) # If the cylinder does not have a center, this code will explode
+        # If the cylinder does not have a center, this code will explode
+        assert (cylinder_center is not None) or (geometry is not None)
         assert (cylinder_radius is not None) # If there are no obstacles, this will definitely not run.
 
         self.phys_cylinder_center = cylinder_center # Center of the cylinder in physical units
@@ -474,6 +461,16 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
 
         self.obstacle_mask_host = None # A boolean mask of the location of the obstacle
         self.obstacle_mask = None   # A buffer of the boolean mask of the obstacle
+        self.geometry = geometry # The obstacle in units of the cylinder radius
+        self.rasterized_geometry = None # The cached obstacle; see LB_D2Q9.geometry
+        # The population swaps of bounceback on the surface of the obstacle; see obstacles.get_bounceback_pairs
+        self.num_bounceback_links = None
+        self.bounceback_nodes = None
+        self.bounceback_directions = None
+        self.bounceback_opposites = None
+        self.bounceback_local_size = (64,)
+        self.bounceback_global_size = None
+        self.link_populations = None # Both populations of every swap, kept out of the collision
         super(Pipe_Flow_Cylinder, self).__init__(**kwargs) # Initialize the superclass
 
     def init_hydro(self):
@@ -486,6 +483,27 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
         self.obstacle_mask = cl.Buffer(self.context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR,
                                        hostbuf=self.obstacle_mask_host)
 
+        # Preprocess the mask into the boundary links, so that bounceback does not visit the inside of the obstacle.
+        # They are cached with the geometry unless the mask was replaced by hand, as in the notebooks.
+        if (self.rasterized_geometry is not None and
+                np.array_equal(self.obstacle_mask_host != 0, self.rasterized_geometry.mask)):
+            x, y, directions, opposites = self.rasterized_geometry.get_bounceback_pairs()
+        else:
+            x, y, directions, opposites = obstacles.get_bounceback_pairs(self.obstacle_mask_host, cx, cy)
+        self.num_bounceback_links = np.int32(x.shape[0])
+        nodes = (y * self.nx + x).astype(np.int32)
+        if self.num_bounceback_links == 0: # Buffers can not be empty
+            nodes = directions = opposites = np.zeros(1, dtype=np.int32)
+
+        const_flags = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
+        self.bounceback_nodes = cl.Buffer(self.context, const_flags, hostbuf=nodes)
+        self.bounceback_directions = cl.Buffer(self.context, const_flags, hostbuf=directions)
+        self.bounceback_opposites = cl.Buffer(self.context, const_flags, hostbuf=opposites)
+        self.bounceback_global_size = get_divisible_global((max(1, self.num_bounceback_links),),
+                                                           self.bounceback_local_size)
+        self.link_populations = cl.Buffer(self.context, cl.mem_flags.READ_WRITE,
+                                          2*max(1, self.num_bounceback_links)*np.dtype(np.float32).itemsize)
+
         # Based on where the obstacle mask is, set velocity to zero, as appropriate.
         self.kernels.set_zero_velocity_in_obstacle(self.queue, self.two_d_global_size, self.two_d_local_size,
                                                    self.obstacle_mask, self.u, self.v,
@@ -506,10 +524,36 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
         Overrides the move_bcs method in Pipe_Flow
         """
         super(Pipe_Flow_Cylinder, self).move_bcs()
-        # Now bounceback on the obstacle
-        self.kernels.bounceback_in_obstacle(self.queue, self.two_d_global_size, self.two_d_local_size,
-                                            self.obstacle_mask, self.f,
-                                            np.int32(self.nx), np.int32(self.ny)).wait()
+        # Now bounceback on the obstacle, over its boundary links only
+        if self.num_bounceback_links > 0:
+            self.kernels.bounceback_links(self.queue, self.bounceback_global_size, self.bounceback_local_size,
+                                          self.bounceback_nodes, self.bounceback_directions, self.bounceback_opposites,
+                                          self.f,
+                                          np.int32(self.nx), np.int32(self.ny),
+                                          self.num_bounceback_links).wait()
+
+    def copy_link_populations(self, restore):
+        """
+        Saves the populations of the bounceback pairs to self.link_populations, or writes them back into f.
+
+        :param restore: If True, write the saved populations back into f.
+        """
+        self.kernels.copy_link_populations(self.queue, self.bounceback_global_size, self.bounceback_local_size,
+                                           self.bounceback_nodes, self.bounceback_directions,
+                                           self.bounceback_opposites, self.f, self.link_populations,
+                                           np.int32(self.nx), np.int32(self.ny),
+                                           self.num_bounceback_links, np.int32(restore)).wait()
+
+    def collide_particles(self):
+        """
+        Overrides the collide_particles method in Pipe_Flow. The populations of the bounceback pairs keep the values
+        they streamed in with, so that the obstacle returns exactly what arrived from the fluid.
+        """
+        if self.num_bounceback_links > 0:
+            self.copy_link_populations(False)
+        super(Pipe_Flow_Cylinder, self).collide_particles()
+        if self.num_bounceback_links > 0:
+            self.copy_link_populations(True)
 
 ### Matt stuff ###
 
@@ -1,5 +1,6 @@
 import numpy as np
 import skimage as ski
+from LB_D2Q9 import geometry
 
 ##########################
 ##### D2Q9 parameters ####
@@ -381,9 +382,8 @@ class Pipe_Flow(object):
 
 class Pipe_Flow_Cylinder(Pipe_Flow):
     """
-    A subclass of the Pipe Flow class that simulates fluid flow around a cylinder. This class can also be "hacked"
-    in its current state to simulate flow around arbitrary obstacles. See
-    https://github.com/latticeboltzmann/2d-lb/blob/master/docs/cs205_movie.ipynb for an example of how to do so.
+    A subclass of the Pipe Flow class that simulates fluid flow around a cylinder. Arbitrary obstacles, i.e. polygons
+    or image masks, are passed as the geometry argument; see LB_D2Q9.geometry.
     """
 
     def set_characteristic_length_time(self):
@@ -404,32 +404,37 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
         self.nx = self.lx + 1 # Total size of grid in x including boundary
         self.ny = self.ly + 1 # Total size of grid in y including boundary
 
-        ## Initialize the obstacle mask
-        self.obstacle_mask = np.zeros((self.nx, self.ny), dtype=np.bool, order='F')
+        ## Initialize the obstacle mask. It is rasterised once per resolution and cached with its boundary links.
+        if self.geometry is None:
+            self.geometry = geometry.Circle(np.array(self.phys_cylinder_center)/self.L, self.phys_cylinder_radius/self.L)
+        self.rasterized_geometry = geometry.get_rasterized_geometry(self.geometry, self.nx, self.ny, self.N)
+        self.obstacle_mask = np.asfortranarray(self.rasterized_geometry.mask)
 
-        # Initialize the obstacle in the correct place
-        x_cylinder = self.N * self.phys_cylinder_center[0]/self.L
-        y_cylinder = self.N * self.phys_cylinder_center[1]/self.L
-
-        circle = ski.draw.circle(x_cylinder, y_cylinder, self.N)
-        self.obstacle_mask[circle[0], circle[1]] = True
-
-    def __init__(self, cylinder_center = None, cylinder_radius=None, **kwargs):
+    def __init__(self, cylinder_center = None, cylinder_radius=None, geometry=None, **kwargs):
         """
-        :param cylinder_center: The center of the cylinder in physical units.
-        :param cylinder_radius: The raidus of the cylinder in physical units.
+        :param cylinder_center: The center of the cylinder in physical units. Unused if geometry is given.
+        :param cylinder_radius: The raidus of the cylinder in physical units. Also sets the characteristic length.
+        :param geometry: The obstacle, any shape of LB_D2Q9.geometry in units of the cylinder radius, i.e. a Polygon
+            or an Image_Mask. Defaults to the Circle given by cylinder_center and cylinder_radius.
         :param kwargs: All keyword arguments required to initialize the pipe-flow class.
         """
 
-        assert (cylinder_center is not None) # If the cylinder does not have a center, this code will explode
+        # If the cylinder does not have a center, this code will explode
+        assert (cylinder_center is not None) or (geometry is not None)
         assert (cylinder_radius is not None) # If there are no obstacles, this will definitely not run.
 
         self.phys_cylinder_center = cylinder_center # Center of the cylinder in physical units
         self.phys_cylinder_radius = cylinder_radius # Radius of the cylinder in physical units
 
         self.obstacle_mask = None # A boolean mask of the location of the obstacle
+        self.geometry = geometry # The obstacle in units of the cylinder radius
+        self.rasterized_geometry = None # The cached obstacle; see LB_D2Q9.geometry
         super(Pipe_Flow_Cylinder, self).__init__(**kwargs) # Initialize the superclass
-        self.obstacle_pixels = np.where(self.obstacle_mask) # A list of x and y coordinates of the obstacle
+
+        # The population swaps of bounceback, on the surface of the obstacle only; see obstacles.get_bounceback_pairs.
+        # They are cached with the geometry.
+        self.bounceback_x, self.bounceback_y, self.bounceback_directions, self.bounceback_opposites = \
+            self.rasterized_geometry.get_bounceback_pairs()
 
     def init_hydro(self):
         """
@@ -455,41 +460,33 @@ class Pipe_Flow_Cylinder(Pipe_Flow):
         """
         super(Pipe_Flow_Cylinder, self).move_bcs()
 
-        # Now bounceback on the obstacle
-        x_list = self.obstacle_pixels[0]
-        y_list = self.obstacle_pixels[1]
-        num_pixels = y_list.shape[0]
+        # Now bounceback on the obstacle: swap every pair of opposite populations that touches a boundary link
+        x = self.bounceback_x
+        y = self.bounceback_y
+        directions = self.bounceback_directions
+        opposites = self.bounceback_opposites
 
         f = self.f
 
-        for i in range(num_pixels):
-            x = x_list[i]
-            y = y_list[i]
-
-            old_f0 = f[0, x, y]
-            old_f1 = f[1, x, y]
-            old_f2 = f[2, x, y]
-            old_f3 = f[3, x, y]
-            old_f4 = f[4, x, y]
-            old_f5 = f[5, x, y]
-            old_f6 = f[6, x, y]
-            old_f7 = f[7, x, y]
-            old_f8 = f[8, x, y]
-
-            # Bounce back everywhere!
-            # left right
-            f[1, x, y] = old_f3
-            f[3, x, y] = old_f1
-            # up down
-            f[2, x, y] = old_f4
-            f[4, x, y] = old_f2
-            # up-right
-            f[5, x, y] = old_f7
-            f[7, x, y] = old_f5
-
-            # up-left
-            f[6, x, y] = old_f8
-            f[8, x, y] = old_f6
+        old_f = f[directions, x, y] # A copy, as this is fancy indexing
+        f[directions, x, y] = f[opposites, x, y]
+        f[opposites, x, y] = old_f
+
+    def collide_particles(self):
+        """
+        Overrides the collide_particles method in Pipe_Flow. The obstacle does not collide: the populations of the
+        bounceback pairs keep the values they streamed in with, so that bounceback returns exactly what arrived from
+        the fluid and nothing from inside the obstacle leaks out through the density of its surface nodes.
+        """
+        x = self.bounceback_x
+        y = self.bounceback_y
+        arrived_directions = self.f[self.bounceback_directions, x, y]
+        arrived_opposites = self.f[self.bounceback_opposites, x, y]
+
+        super(Pipe_Flow_Cylinder, self).collide_particles()
+
+        self.f[self.bounceback_directions, x, y] = arrived_directions
+        self.f[self.bounceback_opposites, x, y] = arrived_opposites
 
 ### Matt Stuff ###
 
@@ -0,0 +1,234 @@
+"""
+Selective transfer of fields from the GPU to the CPU.
+
+read_field copies a single field, optionally restricted to a rectangular region of the grid and decimated by a
+stride, using rectangular buffer reads so that only the requested rows cross the bus. Lazy_Fields is a dictionary
+that only transfers a field the first time it is accessed; the get_fields methods of the runners return one.
+Runners get get_field from the Field_Access mixin and only declare the shapes of their fields.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+
+
+def get_bounds(region, nx, ny):
+    """
+    Converts a region into bounds on the grid.
+
+    :param region: None (the whole grid) or a tuple of (x_slice, y_slice), i.e. (slice(10, 50), slice(None))
+    :return: A tuple of (x0, width, y0, height)
+    """
+    if region is None:
+        return 0, nx, 0, ny
+
+    x_slice, y_slice = region
+    x0, x1, x_step = x_slice.indices(nx)
+    y0, y1, y_step = y_slice.indices(ny)
+    if x_step != 1 or y_step != 1:
+        raise ValueError('Region slices may not have a step; use stride to decimate.')
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('The region ' + str(region) + ' is empty.')
+
+    return x0, x1 - x0, y0, y1 - y0
+
+
+def read_field(queue, device_field, shape, dtype=np.float32, out=None, region=None, stride=None):
+    """
+    Transfers a field stored in Fortran order with shape (nx, ny, ...) from the GPU to the CPU.
+
+    :param queue: The queue to enqueue the transfer on.
+    :param device_field: A cl.Buffer or cl.array.Array holding the field.
+    :param shape: The full shape of the field, (nx, ny) or (nx, ny, ...).
+    :param dtype: The type of the field.
+    :param out: An optional array to write the result into. Must have the shape of the result.
+    :param region: A tuple of (x_slice, y_slice) selecting a rectangle of the grid. None selects everything.
+    :param stride: An integer or a tuple (sx, sy). Only every sx'th node in x and sy'th node in y is returned.
+    :return: The requested field as a Fortran ordered array (out, if it was given).
+    """
+    if isinstance(device_field, cl.array.Array):
+        buf = device_field.data
+    else:
+        buf = device_field
+
+    dtype = np.dtype(dtype)
+    item_size = dtype.itemsize
+    nx, ny = shape[0], shape[1]
+    extra_shape = tuple(shape[2:])
+    num_slices = int(np.prod(extra_shape))
+
+    if stride is None:
+        sx, sy = 1, 1
+    elif np.isscalar(stride):
+        sx, sy = int(stride), int(stride)
+    else:
+        sx, sy = int(stride[0]), int(stride[1])
+    if sx < 1 or sy < 1:
+        raise ValueError('The stride must be at least one.')
+
+    x0, width, y0, height = get_bounds(region, nx, ny)
+    num_rows = (height + sy - 1) // sy
+    result_shape = ((width + sx - 1) // sx, num_rows) + extra_shape
+
+    if out is not None:
+        if tuple(out.shape) != result_shape:
+            raise ValueError('out has shape ' + str(out.shape) + ' but the result has shape ' + str(result_shape))
+        if out.dtype != dtype:
+            raise ValueError('out has type ' + str(out.dtype) + ' but the field has type ' + str(dtype))
+
+    # Copy straight into out if we can; otherwise into a temporary that is decimated in x afterwards.
+    if sx == 1 and (out is not None) and out.flags.f_contiguous:
+        host = out
+    else:
+        host = np.empty((width, num_rows) + extra_shape, dtype=dtype, order='F')
+
+    if region is None and sy == 1:
+        cl.enqueue_copy(queue, host, buf, is_blocking=True)
+    elif sy == 1:
+        # One rectangular read covering every slice
+        cl.enqueue_copy(queue, host, buf,
+                        buffer_origin=(x0*item_size, y0, 0), host_origin=(0, 0, 0),
+                        region=(width*item_size, height, num_slices),
+                        buffer_pitches=(nx*item_size, nx*ny*item_size),
+                        host_pitches=(width*item_size, width*height*item_size),
+                        is_blocking=True)
+    else:
+        # Decimate in y by stepping sy rows per host row. The slice offset is folded into the origin, as nx*ny is not
+        # in general a multiple of the (strided) row pitch.
+        row_pitch = nx*sy*item_size
+        events = []
+        for k in range(num_slices):
+            origin = (x0 + y0*nx + k*nx*ny)*item_size
+            events.append(cl.enqueue_copy(queue, host, buf,
+                                          buffer_origin=(origin, 0, 0), host_origin=(0, 0, k),
+                                          region=(width*item_size, num_rows, 1),
+                                          buffer_pitches=(row_pitch, num_rows*row_pitch),
+                                          host_pitches=(width*item_size, width*num_rows*item_size),
+                                          is_blocking=False))
+        cl.wait_for_events(events)
+
+    if host is out:
+        return out
+
+    if sx != 1:
+        host = np.asfortranarray(host[::sx])
+    if out is None:
+        return host
+    out[...] = host
+    return out
+
+
+# The fields of a single population D2Q9 runner. Strings name attributes of the runner; see Field_Access.
+D2Q9_FIELD_SHAPES = {
+    'f': ('nx', 'ny', 9),
+    'feq': ('nx', 'ny', 9),
+    'u': ('nx', 'ny'),
+    'v': ('nx', 'ny'),
+    'rho': ('nx', 'ny')
+}
+
+
+def get_field(sim, name, out=None, region=None, stride=None):
+    """
+    Transfers a single field of a runner from the GPU to the CPU. Only the requested part of the field is transferred.
+
+    :param sim: The runner. Must have a queue, the field as an attribute and get_field_shapes.
+    :param name: The field to transfer, i.e. 'rho'
+    :param out: An optional Fortran ordered array to write the field into, avoiding an allocation.
+    :param region: A tuple of (x_slice, y_slice) selecting part of the grid, i.e. (slice(0, 50), slice(None)).
+    :param stride: An integer or (sx, sy); only every sx'th node in x and sy'th node in y is transferred.
+    :return: The field as a Fortran ordered numpy array.
+    """
+    field_shapes = sim.get_field_shapes()
+    if name not in field_shapes:
+        raise ValueError('Unknown field ' + str(name) + '. Choose one of ' + str(sorted(field_shapes.keys())))
+
+    return read_field(sim.queue, getattr(sim, name), field_shapes[name], out=out, region=region, stride=stride)
+
+
+class Field_Access(object):
+    """
+    Gives a runner get_field. The runner declares the shape of each of its float32 fields in field_shapes; entries
+    that are strings name attributes of the runner, i.e. ('nx', 'ny', 9), and are looked up when a field is read.
+    Runners whose shapes are not of that form override get_field_shapes instead.
+    """
+
+    field_shapes = D2Q9_FIELD_SHAPES
+
+    def get_field_shapes(self):
+        """:return: A dictionary of the shape of every field"""
+        shapes = {}
+        for name, shape in self.field_shapes.items():
+            shapes[name] = tuple(getattr(self, n) if isinstance(n, basestring) else n for n in shape)
+        return shapes
+
+    def get_field(self, name, out=None, region=None, stride=None):
+        """
+        Transfers a single field from the GPU to the CPU. Only the requested part of the field is transferred.
+
+        :param name: The field to transfer; one of the keys of field_shapes, i.e. 'rho'.
+        :param out: An optional Fortran ordered float32 array to write the field into, avoiding an allocation.
+        :param region: A tuple of (x_slice, y_slice) selecting part of the grid, i.e. (slice(0, 50), slice(None)).
+        :param stride: An integer or (sx, sy); only every sx'th node in x and sy'th node in y is transferred.
+        :return: The field as a Fortran ordered numpy array.
+        """
+        return get_field(self, name, out=out, region=region, stride=stride)
+
+
+class Lazy_Fields(object):
+    """
+    A read-only view of the fields of a runner that behaves like a dictionary. A field is transferred from the GPU
+    the first time it is accessed and cached afterwards. Scale factors (i.e. to non-dimensionalize u and v) can be
+    attached before the field is transferred with scale.
+    """
+
+    def __init__(self, get_field, names):
+        """
+        :param get_field: A function taking the name of a field and returning it as a numpy array.
+        :param names: The names of the available fields.
+        """
+        self.get_field = get_field
+        self.names = list(names)
+        self.cache = {}
+        self.scales = {}
+
+    def scale(self, name, factor):
+        """Multiplies the field name by factor, either now (if already transferred) or when it is transferred."""
+        if name in self.cache:
+            self.cache[name] *= factor
+        else:
+            self.scales[name] = self.scales.get(name, 1.) * factor
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            if name not in self.names:
+                raise KeyError(name)
+            field = self.get_field(name)
+            if name in self.scales:
+                field *= self.scales.pop(name)
+            self.cache[name] = field
+        return self.cache[name]
+
+    def __setitem__(self, name, value):
+        if name not in self.names:
+            self.names.append(name)
+        self.scales.pop(name, None)
+        self.cache[name] = value
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def values(self):
+        return [self[name] for name in self.names]
@@ -0,0 +1,263 @@
+"""
+Obstacle geometries, rasterised once per resolution and cached.
+
+Geometries are described in units of the characteristic length L of a runner, so that a node (x, y) of a runner of
+resolution N sits at (x/N, y/N). get_rasterized_geometry rasterises a geometry onto an (nx, ny) lattice of resolution
+N and derives the tables the runners need from the mask: the bounceback pairs of the full-grid runners and the
+fluid-node tables of the sparse runner (see LB_D2Q9.obstacles). The result is kept in a compressed file in cache_dir,
+with the mask packed to one bit per node, so that constructing a runner again, or sweeping the resolution repeatedly,
+does not rasterise or preprocess anything twice. The MEMORY_CACHE_SIZE most recently used geometries are also kept in
+memory.
+"""
+
+import numpy as np
+import collections
+import hashlib
+import os
+import tempfile
+from LB_D2Q9 import obstacles
+
+# Required to draw polygons and read images
+import skimage as ski
+import skimage.color
+import skimage.draw
+import skimage.io
+
+# Bump when the rasterisation or the layout of the cached files changes
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.environ.get('LB_D2Q9_GEOMETRY_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'LB_D2Q9', 'geometry'))
+
+# The number of rasterised geometries kept in memory; the least recently used one is dropped first
+MEMORY_CACHE_SIZE = 8
+
+_memory_cache = collections.OrderedDict()
+
+
+def get_node_coordinates(nx, ny, N):
+    """:return: Two (nx, ny) arrays with the position of every node in units of the characteristic length."""
+    x = np.arange(nx, dtype=np.double) / N
+    y = np.arange(ny, dtype=np.double) / N
+    return np.meshgrid(x, y, indexing='ij')
+
+
+class Circle(object):
+    """A disk; the nodes strictly inside the circle are solid."""
+
+    def __init__(self, center, radius):
+        """
+        :param center: The center (x, y), in units of the characteristic length
+        :param radius: The radius, in units of the characteristic length
+        """
+        self.center = (float(center[0]), float(center[1]))
+        self.radius = float(radius)
+        if self.radius <= 0:
+            raise ValueError('The radius of a circle must be positive.')
+
+    def get_key(self):
+        return 'Circle(%r, %r, %r)' % (self.center[0], self.center[1], self.radius)
+
+    def rasterize(self, nx, ny, N):
+        # In lattice units, so that nodes exactly on the circle stay fluid as they did with skimage.draw.circle;
+        # dividing the node positions by N first rounds some of them inside.
+        x, y = get_node_coordinates(nx, ny, 1)
+        return (x - N*self.center[0])**2 + (y - N*self.center[1])**2 < (N*self.radius)**2
+
+
+class Polygon(object):
+    """A simple polygon; the nodes inside it are solid."""
+
+    def __init__(self, vertices):
+        """
+        :param vertices: A sequence of (x, y) vertices, in units of the characteristic length
+        """
+        self.vertices = np.array(vertices, dtype=np.double)
+        if (self.vertices.ndim != 2) or (self.vertices.shape[1] != 2) or (self.vertices.shape[0] < 3):
+            raise ValueError('A polygon needs at least three (x, y) vertices.')
+
+    def get_key(self):
+        return 'Polygon(%r)' % (self.vertices.tolist(),)
+
+    def rasterize(self, nx, ny, N):
+        mask = np.zeros((nx, ny), dtype=np.bool_)
+        rows, cols = ski.draw.polygon(N * self.vertices[:, 0], N * self.vertices[:, 1], shape=(nx, ny))
+        mask[rows, cols] = True
+        return mask
+
+
+class Image_Mask(object):
+    """
+    An obstacle read from an image (i.e. the .tif masks in docs) or an array, stretched over a rectangle of the
+    domain. Nodes are sampled from the nearest pixel.
+    """
+
+    def __init__(self, image, extent, threshold=0.5, invert=False):
+        """
+        :param image: A filename, or an (image_nx, image_ny) array indexed by (x, y). When read from a file, the
+            image is converted to greyscale in [0, 1] and its top row becomes the largest y.
+        :param extent: The rectangle (x0, y0, width, height) the image covers, in units of the characteristic length
+        :param threshold: Pixels brighter than threshold are solid
+        :param invert: If True, pixels darker than threshold are solid instead
+        """
+        if isinstance(image, basestring):
+            image = ski.io.imread(image)
+            if image.ndim == 3:
+                image = ski.color.rgb2gray(image[:, :, :3])
+            elif image.dtype.kind in 'ui':
+                image = image / float(np.iinfo(image.dtype).max)
+            image = image[::-1, :].T
+        self.image = np.asarray(image, dtype=np.double)
+        if self.image.ndim != 2:
+            raise ValueError('An image mask must be two dimensional.')
+
+        self.extent = tuple(float(value) for value in extent)
+        if (len(self.extent) != 4) or (self.extent[2] <= 0) or (self.extent[3] <= 0):
+            raise ValueError('The extent must be (x0, y0, width, height) with a positive width and height.')
+        self.threshold = float(threshold)
+        self.invert = bool(invert)
+
+    def get_key(self):
+        image_hash = hashlib.sha1(np.ascontiguousarray(self.image).tostring()).hexdigest()
+        return 'Image_Mask(%s, %r, %r, %r, %r)' % (image_hash, self.image.shape, self.extent, self.threshold,
+                                                   self.invert)
+
+    def rasterize(self, nx, ny, N):
+        x, y = get_node_coordinates(nx, ny, N)
+        x0, y0, width, height = self.extent
+        image_nx, image_ny = self.image.shape
+
+        pixel_x = np.floor((x - x0) / width * image_nx).astype(np.int64)
+        pixel_y = np.floor((y - y0) / height * image_ny).astype(np.int64)
+        inside = (pixel_x >= 0) & (pixel_x < image_nx) & (pixel_y >= 0) & (pixel_y < image_ny)
+
+        solid_pixels = self.image < self.threshold if self.invert else self.image > self.threshold
+        mask = np.zeros((nx, ny), dtype=np.bool_)
+        mask[inside] = solid_pixels[pixel_x[inside], pixel_y[inside]]
+        return mask
+
+
+class Union(object):
+    """Several geometries at once; a node is solid if it is solid in any of them."""
+
+    def __init__(self, geometries):
+        self.geometries = list(geometries)
+        if len(self.geometries) == 0:
+            raise ValueError('A union needs at least one geometry.')
+
+    def get_key(self):
+        return 'Union(' + ', '.join(geometry.get_key() for geometry in self.geometries) + ')'
+
+    def rasterize(self, nx, ny, N):
+        mask = np.zeros((nx, ny), dtype=np.bool_)
+        for geometry in self.geometries:
+            mask |= geometry.rasterize(nx, ny, N)
+        return mask
+
+
+class Rasterized_Geometry(object):
+    """
+    A geometry rasterised onto one lattice, with its derived tables. The mask is stored packed, one bit per node, and
+    unpacked on access.
+    """
+
+    TABLE_NAMES = ['bounceback_x', 'bounceback_y', 'bounceback_directions', 'bounceback_opposites',
+                   'fluid_nodes', 'neighbours']
+
+    def __init__(self, nx, ny, packed_mask, periodic, tables):
+        """
+        :param packed_mask: The mask, raveled in Fortran order and packed with np.packbits
+        :param periodic: The periodicity the fluid-node tables were built with
+        :param tables: A dictionary holding every array in TABLE_NAMES
+        """
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.packed_mask = packed_mask
+        self.periodic = tuple(bool(value) for value in periodic)
+
+        self.bounceback_x = tables['bounceback_x']
+        self.bounceback_y = tables['bounceback_y']
+        self.bounceback_directions = tables['bounceback_directions']
+        self.bounceback_opposites = tables['bounceback_opposites']
+        self.fluid_nodes = tables['fluid_nodes']
+        self.neighbours = tables['neighbours']
+
+    @classmethod
+    def from_mask(cls, mask, periodic):
+        """Builds the tables of a boolean (nx, ny) mask."""
+        nx, ny = mask.shape
+        pairs = obstacles.get_bounceback_pairs(mask)
+        fluid_nodes, neighbours = obstacles.get_fluid_node_tables(mask, periodic=periodic)
+
+        tables = dict(zip(cls.TABLE_NAMES, list(pairs) + [fluid_nodes, neighbours]))
+        return cls(nx, ny, np.packbits(mask.ravel(order='F')), periodic, tables)
+
+    @property
+    def mask(self):
+        """The (nx, ny) boolean mask, True on solid nodes."""
+        bits = np.unpackbits(self.packed_mask)[:self.nx * self.ny]
+        return bits.reshape((self.nx, self.ny), order='F').astype(np.bool_)
+
+    def get_bounceback_pairs(self):
+        """:return: The tuple (x, y, directions, opposites) of obstacles.get_bounceback_pairs"""
+        return self.bounceback_x, self.bounceback_y, self.bounceback_directions, self.bounceback_opposites
+
+    def save(self, path):
+        """Writes the geometry to path atomically, so that concurrent runs never read a partial file."""
+        directory = os.path.dirname(path)
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temp_file:
+            arrays = dict((name, getattr(self, name)) for name in self.TABLE_NAMES)
+            np.savez_compressed(temp_file, nx=self.nx, ny=self.ny, packed_mask=self.packed_mask,
+                                periodic=np.array(self.periodic), **arrays)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            tables = dict((name, data[name]) for name in cls.TABLE_NAMES)
+            return cls(data['nx'], data['ny'], data['packed_mask'], data['periodic'], tables)
+
+
+def get_rasterized_geometry(geometry, nx, ny, N, periodic=(False, False), cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Rasterises geometry onto an (nx, ny) lattice of resolution N and builds its tables, or loads them from the cache.
+
+    :param geometry: A Circle, Polygon, Image_Mask or Union
+    :param nx: The number of nodes in x
+    :param ny: The number of nodes in y
+    :param N: The number of nodes per characteristic length
+    :param periodic: The periodicity (in x, in y) of the runner, which the fluid-node tables depend on
+    :param cache_dir: The directory of the cached files; None disables the cache on disk.
+    :return: A Rasterized_Geometry
+    """
+    periodic = tuple(bool(value) for value in periodic)
+    key = '%d|%s|%d|%d|%r|%r' % (CACHE_VERSION, geometry.get_key(), nx, ny, float(N), periodic)
+    if key in _memory_cache:
+        rasterized = _memory_cache.pop(key)
+        _memory_cache[key] = rasterized # Now the most recently used
+        return rasterized
+
+    path = None
+    rasterized = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.npz')
+        if os.path.exists(path):
+            rasterized = Rasterized_Geometry.load(path)
+
+    if rasterized is None:
+        mask = geometry.rasterize(int(nx), int(ny), N)
+        rasterized = Rasterized_Geometry.from_mask(mask, periodic)
+        if path is not None:
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError: # Created by another run in the meantime
+                    if not os.path.isdir(cache_dir):
+                        raise
+            rasterized.save(path)
+
+    _memory_cache[key] = rasterized
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return rasterized
@@ -0,0 +1,41 @@
+// Device-side initialisation of the populations of a runner. Compiled with -D NUM_TYPE=float or -D NUM_TYPE=double
+// (plus -D USE_DOUBLE for the latter), like diagnostics.cl.
+
+#ifdef USE_DOUBLE
+    #ifdef cl_khr_fp64
+        #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    #elif defined(cl_amd_fp64)
+        #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+    #else
+        #error "Double precision floating point not supported by OpenCL implementation."
+    #endif
+#endif
+
+__kernel void
+perturb_populations(
+    __global NUM_TYPE *f_global,
+    __global __read_only NUM_TYPE *feq_global,
+    __global __read_only NUM_TYPE *noise_global,
+    const NUM_TYPE amplitude,
+    const int field_index,
+    const int nx, const int ny,
+    const int num_fields,
+    const int num_jumpers)
+{
+    // f = feq*(1 + amplitude*noise) for every jumper of one field. noise holds one normal deviate per node and
+    // jumper, (nx, ny, num_jumpers). The other fields of f are not touched.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        const int three_d_index = field_index*nx*ny + two_d_index;
+
+        for(int jump_id = 0; jump_id < num_jumpers; jump_id++){
+            const int four_d_index = jump_id*num_fields*nx*ny + three_d_index;
+            const NUM_TYPE noise = noise_global[jump_id*nx*ny + two_d_index];
+
+            f_global[four_d_index] = feq_global[four_d_index]*(1 + amplitude*noise);
+        }
+    }
+}
@@ -0,0 +1,113 @@
+"""
+Device-side initialisation of the fields of a runner.
+
+Initializer.set_field_slice overwrites one population of an (nx, ny, num_fields) field in place, from a scalar, a host
+array or an analytic profile written as an OpenCL expression of x and y. Initializer.perturb_populations sets
+f = feq*(1 + amplitude*noise) for one population, with the noise drawn on the device. Neither reallocates the runner's
+buffers, so kernel arguments that refer to them stay valid, and at most one (nx, ny) slice crosses the bus.
+"""
+
+import numpy as np
+import weakref
+import pyopencl as cl
+import pyopencl.array
+import pyopencl.clrandom
+import pyopencl.elementwise
+from LB_D2Q9 import diagnostics
+
+# Holds the kernels weakly, as they keep their context alive; see memory_pool._allocator_cache
+_profile_cache = weakref.WeakValueDictionary()
+
+
+def get_profile_kernel(context, dtype, expression):
+    """
+    Compiles a kernel writing expression, a function of the integer node coordinates x and y and of nx and ny, into one
+    population of a field. Kernels are shared per context, type and expression while they are in use.
+    """
+    key = (context.int_ptr, np.dtype(dtype).str, expression)
+    kernel = _profile_cache.get(key)
+    if kernel is None:
+        if np.dtype(dtype) == np.float64:
+            c_type = 'double'
+            preamble = '#pragma OPENCL EXTENSION cl_khr_fp64 : enable'
+        else:
+            c_type = 'float'
+            preamble = ''
+        kernel = cl.elementwise.ElementwiseKernel(
+            context,
+            c_type + ' *field, const int offset, const int nx, const int ny',
+            'const int x = i % nx; const int y = i / nx; field[offset + i] = (' + c_type + ')(' + expression + ')',
+            name='set_profile', preamble=preamble)
+        _profile_cache[key] = kernel
+    return kernel
+
+
+class Initializer(object):
+    """
+    Writes initial conditions straight into the device fields of a runner. Owns the device random number generator
+    used for the perturbations; runners expose it as sim.random_generator so that checkpoints save its state.
+    """
+
+    def __init__(self, sim):
+        """
+        :param sim: The runner to initialize. Must have context, queue, nx, ny, two_d_global_size and
+            two_d_local_size.
+        """
+        self.sim = sim
+        self.nx = int(sim.nx)
+        self.ny = int(sim.ny)
+        self.random_generator = cl.clrandom.PhiloxGenerator(sim.context)
+        self.noise = None # (nx, ny, num_jumpers) normal deviates; allocated by the first perturbation
+
+    def set_field_slice(self, field, field_index, values):
+        """
+        Overwrites field[:, :, field_index] in place.
+
+        :param field: A Fortran ordered (nx, ny, num_fields) field; a cl.array or a cl.Buffer.
+        :param field_index: The population to overwrite
+        :param values: A scalar, an (nx, ny) host array, or a string holding an OpenCL expression of the node
+            coordinates x and y (and of nx and ny), i.e. '1 + 0.01*sin(2*M_PI*x/nx)'.
+        """
+        queue = self.sim.queue
+        buf, dtype, num_bytes = diagnostics.get_buffer_and_type(field)
+        num_nodes = self.nx*self.ny
+        offset = int(field_index)*num_nodes
+
+        if isinstance(values, basestring):
+            kernel = get_profile_kernel(self.sim.context, dtype, values)
+            flat_field = cl.array.Array(queue, (num_bytes // dtype.itemsize,), dtype, data=buf)
+            kernel(flat_field, np.int32(offset), np.int32(self.nx), np.int32(self.ny),
+                   range=slice(num_nodes), queue=queue).wait()
+        else:
+            host = np.empty((self.nx, self.ny), dtype=dtype, order='F')
+            host[...] = values
+            cl.enqueue_copy(queue, buf, host, device_offset=offset*dtype.itemsize, is_blocking=True)
+
+    def perturb_populations(self, f, feq, field_index, num_fields, num_jumpers, amplitude):
+        """
+        Sets every jumper of one population of f to feq*(1 + amplitude*noise), where noise is a standard normal
+        deviate drawn on the device.
+
+        :param f: The (nx, ny, num_fields, num_jumpers) populations; a cl.array or a cl.Buffer.
+        :param feq: The equilibrium populations, of the same layout as f.
+        :param field_index: The population to set
+        :param num_fields: The number of populations stored in f
+        :param num_jumpers: The number of jumpers of the lattice
+        :param amplitude: The relative amplitude of the noise. With zero, f is set to feq.
+        """
+        queue = self.sim.queue
+        f_buf, dtype, f_bytes = diagnostics.get_buffer_and_type(f)
+        feq_buf = diagnostics.get_buffer_and_type(feq)[0]
+
+        if (self.noise is None) or (self.noise.dtype != dtype) or (self.noise.shape[2] != int(num_jumpers)):
+            self.noise = cl.array.zeros(queue, (self.nx, self.ny, int(num_jumpers)), dtype=dtype, order='F',
+                                        allocator=getattr(self.sim, 'allocator', None))
+        if amplitude != 0:
+            self.random_generator.fill_normal(self.noise, queue=queue)
+
+        program = diagnostics.get_program(self.sim.context, dtype, 'initialization.cl')
+        program.perturb_populations(queue, self.sim.two_d_global_size, self.sim.two_d_local_size,
+                                    f_buf, feq_buf, self.noise.data,
+                                    dtype.type(amplitude), np.int32(field_index),
+                                    np.int32(self.nx), np.int32(self.ny),
+                                    np.int32(num_fields), np.int32(num_jumpers)).wait()
@@ -0,0 +1,89 @@
+"""
+A shared pyopencl.tools.MemoryPool for the cl.array fields of the runners.
+
+cl.array results (arithmetic, copies, astype, reductions) use the allocator of the arrays they are computed from, so
+passing allocator=get_allocator(queue) when a runner creates its fields makes the temporaries of expressions
+evaluated every step, i.e. (sim.u**2 + sim.v**2)**.5, reuse blocks freed by earlier steps instead of allocating new
+device buffers. One pool is shared by every runner and solver of a context, for as long as any of them (or any array
+allocated from it) is alive. The allocator counts allocations, so stats() can be used to spot expressions that
+allocate every step.
+
+The pool allocates through an ImmediateAllocator, which makes the device commit the memory at once: an allocation
+that runs out of memory then fails in the pool, which frees the blocks it holds and retries, instead of failing later
+in a kernel launch.
+"""
+
+import weakref
+import pyopencl as cl
+import pyopencl.tools
+
+# Holds the allocators weakly: the pool keeps its context alive, so a cache keyed weakly by the context would never
+# let either go. Once nothing uses an allocator any more, it, its pool and its context are freed.
+_allocator_cache = weakref.WeakValueDictionary()
+
+
+def get_allocator(queue):
+    """
+    Returns the Pool_Allocator shared by everything that runs in the context of the given queue. The allocator is
+    created with the queue of its first user, which it uses only to commit new allocations.
+    """
+    # The allocator holds the context, so its address can not be reused by another context while the entry exists
+    key = queue.context.int_ptr
+    allocator = _allocator_cache.get(key)
+    if allocator is None:
+        allocator = Pool_Allocator(queue)
+        _allocator_cache[key] = allocator
+    return allocator
+
+
+class Pool_Allocator(object):
+    """
+    Allocates device memory from a MemoryPool and keeps statistics. Pass it as allocator= to cl.array creation.
+    """
+
+    def __init__(self, queue):
+        self.pool = cl.tools.MemoryPool(cl.tools.ImmediateAllocator(queue))
+
+        self.num_allocations = 0 # Every allocation served, from the pool or not
+        self.high_water_blocks = 0 # The largest number of blocks in use at once
+        self.high_water_bytes = 0 # The largest number of bytes in use at once; only if the pool reports them
+
+        self.num_steps = 0
+        self.step_mark = 0 # num_allocations when end_step was last called
+        self.allocations_last_step = 0
+
+    def __call__(self, size):
+        buf = self.pool.allocate(size)
+
+        self.num_allocations += 1
+        self.high_water_blocks = max(self.high_water_blocks, self.pool.active_blocks)
+        active_bytes = getattr(self.pool, 'active_bytes', None) # Only reported by newer versions of pyopencl
+        if active_bytes is not None:
+            self.high_water_bytes = max(self.high_water_bytes, active_bytes)
+
+        return buf
+
+    def end_step(self):
+        """Called by the runners after every step, so that allocations can be counted per step."""
+        self.allocations_last_step = self.num_allocations - self.step_mark
+        self.step_mark = self.num_allocations
+        self.num_steps += 1
+
+    def free_held(self):
+        """Returns the blocks the pool holds on to, but that are not in use, to the device."""
+        self.pool.free_held()
+
+    def stats(self):
+        """
+        :return: A dictionary with the number of blocks in use and held by the pool, their high-water marks, the total
+            number of allocations and the number of allocations of the last step.
+        """
+        return {
+            'active_blocks': self.pool.active_blocks,
+            'held_blocks': self.pool.held_blocks,
+            'high_water_blocks': self.high_water_blocks,
+            'high_water_bytes': self.high_water_bytes,
+            'num_allocations': self.num_allocations,
+            'allocations_last_step': self.allocations_last_step,
+            'num_steps': self.num_steps
+        }
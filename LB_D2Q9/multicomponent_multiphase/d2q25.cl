@@ -0,0 +1,145 @@
+#ifdef cl_khr_fp64
+    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#elif defined(cl_amd_fp64)
+    #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+#else
+    #error "Double precision floating point not supported by OpenCL implementation."
+#endif
+
+// Kernels specialised to the D2Q25 lattice of Simulation_RunnerD2Q25. The velocities and weights are passed in as
+// build options (D2Q25_CX, D2Q25_CY, D2Q25_W) from the runner's own tables, so they are compile time constants and
+// the loops over the 25 jumpers unroll completely. Indices follow multi.cl:
+// f[jump_id*num_populations*nx*ny + field*nx*ny + y*nx + x].
+
+#define NUM_JUMPERS 25
+#define HALO 3 // The longest velocity component
+
+__constant int cx_arr[NUM_JUMPERS] = {D2Q25_CX};
+__constant int cy_arr[NUM_JUMPERS] = {D2Q25_CY};
+__constant double w_arr[NUM_JUMPERS] = {D2Q25_W};
+
+__kernel void
+move_d2q25(
+    __global __read_only double *f_global,
+    __global __write_only double *f_streamed_global,
+    const int nx, const int ny,
+    __constant int *field_table,
+    const int num_populations,
+    const int periodic)
+{
+    /* Pull streaming: every node gathers its 25 jumpers. With periodic == 0, jumpers that would come from outside
+    the domain are not written, as in move of multi.cl. */
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int slice_size = num_populations*nx*ny;
+        const int two_d_index = y*nx + x;
+
+        // Nodes further than HALO from the edges never wrap around, so every source is a fixed offset
+        const int interior = (x >= HALO) && (x < nx - HALO) && (y >= HALO) && (y < ny - HALO);
+
+        #pragma unroll
+        for(int jump_id = 0; jump_id < NUM_JUMPERS; jump_id++){
+            const int cur_cx = cx_arr[jump_id];
+            const int cur_cy = cy_arr[jump_id];
+            const int slice = jump_id*slice_size + cur_field*nx*ny;
+
+            if (interior){
+                f_streamed_global[slice + two_d_index] = f_global[slice + two_d_index - cur_cy*nx - cur_cx];
+            }
+            else{
+                int source_x = x - cur_cx;
+                int source_y = y - cur_cy;
+
+                if (periodic){
+                    if (source_x >= nx) source_x -= nx;
+                    if (source_x < 0) source_x += nx;
+
+                    if (source_y >= ny) source_y -= ny;
+                    if (source_y < 0) source_y += ny;
+                }
+
+                if ((source_x >= 0) && (source_x < nx) && (source_y >= 0) && (source_y < ny)){
+                    f_streamed_global[slice + two_d_index] = f_global[slice + source_y*nx + source_x];
+                }
+            }
+        }
+    }
+}
+
+__kernel void
+collide_d2q25(
+    __global double *f_global,
+    __global __write_only double *feq_global,
+    __global __read_only double *rho_global,
+    __global __read_only double *u_bary_global,
+    __global __read_only double *v_bary_global,
+    __global __read_only double *Gx_global,
+    __global __read_only double *Gy_global,
+    __constant double *omega_table,
+    const int nx, const int ny,
+    __constant int *field_table,
+    const int num_populations,
+    const double cs)
+{
+    /* update_feq_fluid followed by collide_particles_fluid of multi.cl in one pass. The terms of the equilibrium
+    and of the forcing that do not depend on the direction are evaluated once per node; feq is still written out
+    so that it stays available. */
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
+    const double omega = omega_table[cur_field];
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        const int three_d_index = cur_field*ny*nx + two_d_index;
+        const int slice_size = num_populations*nx*ny;
+
+        const double rho = rho_global[three_d_index];
+        const double u = u_bary_global[two_d_index];
+        const double v = v_bary_global[two_d_index];
+        const double Gx = Gx_global[three_d_index];
+        const double Gy = Gy_global[three_d_index];
+
+        const double cs2 = cs*cs;
+        const double inv_cs2 = 1./cs2;
+        const double inv_cs4 = inv_cs2*inv_cs2;
+        const double inv_cs6 = inv_cs4*inv_cs2;
+
+        const double u_squared = u*u + v*v;
+        const double u_dot_F = Gx*u + Gy*v;
+        const double feq_base = 1. - u_squared*inv_cs2/2.;
+        const double force_prefactor = 1 - .5*omega;
+
+        #pragma unroll
+        for(int jump_id = 0; jump_id < NUM_JUMPERS; jump_id++){
+            const int four_d_index = jump_id*slice_size + three_d_index;
+            const int cur_cx = cx_arr[jump_id];
+            const int cur_cy = cy_arr[jump_id];
+            const double w = w_arr[jump_id];
+
+            const double c_dot_u = cur_cx*u + cur_cy*v;
+            const double c_dot_F = cur_cx*Gx + cur_cy*Gy;
+
+            const double feq = w*rho*(
+                feq_base
+                + c_dot_u*inv_cs2
+                + c_dot_u*c_dot_u*inv_cs4/2.
+                + c_dot_u*(c_dot_u*c_dot_u - 3*cs2*u_squared)*inv_cs6/6.
+            );
+
+            const double Fi = force_prefactor*w*(
+                c_dot_F*inv_cs2
+                + c_dot_F*c_dot_u*inv_cs4
+                - u_dot_F*inv_cs2
+            );
+
+            feq_global[four_d_index] = feq;
+            f_global[four_d_index] = f_global[four_d_index]*(1 - omega) + omega*feq + Fi;
+        }
+    }
+}
@@ -0,0 +1,263 @@
+"""
+Generates a single OpenCL kernel that evaluates every registered body force of a Simulation_Runner.
+
+Each add_*_force method of the runner records a description (a hashable tuple) of its force next to the kernel it
+registers. From these descriptions, generate_force_source writes one kernel that
+    * loads, per work group, every pseudopotential tile it needs (one slot of the runner's psi buffer with a halo) into
+      local memory once, no matter how many interactions use it,
+    * starts every fluid with a static (position-only) force from rho times its precomputed force per density,
+    * accumulates every force contribution for every fluid in registers, with all constants baked into the code, and
+    * writes Gx and Gy exactly once per node and fluid (which also replaces zeroing them beforehand).
+The tiles must fit into the local memory of the device. If they do not, the forces are split over several kernels
+that each fit: the first writes Gx and Gy, the others add to them. Compiled programs can be cached by generated
+source in a dictionary owned by the runner, so rebuilding the same force list is free and the programs (which hold
+the context) go away with the runner.
+"""
+
+import numpy as np
+import pyopencl as cl
+
+BC_CODES = ['periodic', 'zero_gradient']
+
+
+def literal(value):
+    """A double precision OpenCL literal."""
+    return repr(float(value))
+
+
+def get_bc_code(bc, variable, n):
+    if bc == 'periodic':
+        return ('if (' + variable + ' >= ' + n + ') ' + variable + ' -= ' + n + '; '
+                'if (' + variable + ' < 0) ' + variable + ' += ' + n + ';')
+    elif bc == 'zero_gradient':
+        return ('if (' + variable + ' >= ' + n + ') ' + variable + ' = ' + n + ' - 1; '
+                'if (' + variable + ' < 0) ' + variable + ' = 0;')
+    else:
+        raise ValueError('Specified boundary condition does not exist')
+
+
+def get_tiles(force_specs, psi_slots):
+    """
+    :return: A tuple (the distinct (psi slot, bc) tiles the forces read, the halo of their stencils)
+    """
+    tiles = []
+    halo = 0
+    for spec in force_specs:
+        if spec[0] == 'interaction':
+            fluid_1, fluid_2, G_int, bc, potential, parameters, stencil = spec[1:]
+            for fluid in (fluid_1, fluid_2):
+                key = (psi_slots.index((fluid, potential, parameters)), bc)
+                if key not in tiles:
+                    tiles.append(key)
+            halo = max([halo] + [max(abs(cx), abs(cy)) for w, cx, cy in stencil])
+    return tiles, halo
+
+
+def get_local_memory_size(tiles, halo, local_size):
+    """:return: The bytes of local memory the tiles of one work group take."""
+    tile_size = (local_size[0] + 2*halo) * (local_size[1] + 2*halo)
+    return len(tiles) * tile_size * np.dtype(np.double).itemsize
+
+
+def split_force_specs(force_specs, psi_slots, local_size, max_local_memory):
+    """
+    Greedily groups consecutive forces so that the tiles of every group fit into max_local_memory bytes.
+
+    :return: A list of tuples of force descriptions, or None if a single force needs more local memory than that.
+    """
+    groups = [[]]
+    for spec in force_specs:
+        tiles, halo = get_tiles(groups[-1] + [spec], psi_slots)
+        if get_local_memory_size(tiles, halo, local_size) <= max_local_memory:
+            groups[-1].append(spec)
+            continue
+        tiles, halo = get_tiles([spec], psi_slots)
+        if get_local_memory_size(tiles, halo, local_size) > max_local_memory:
+            return None
+        groups.append([spec])
+    return [tuple(group) for group in groups]
+
+
+def generate_force_source(force_specs, psi_slots, static_fluids, num_populations, local_size, accumulate=False):
+    """
+    :param force_specs: The force descriptions recorded by the runner:
+        ('interaction', fluid_1, fluid_2, G_int, bc, potential, potential_parameters, stencil) where stencil is a
+            tuple of (weight, cx, cy)
+    :param psi_slots: The (fluid, potential, potential_parameters) of every slot of the runner's psi buffer, which
+        holds the pseudopotentials evaluated once per step by Simulation_Runner.update_psi.
+    :param static_fluids: The fluids with a static force, whose force per density is read from static_Gx and
+        static_Gy; see Simulation_Runner.add_static_force.
+    :param num_populations: The number of fluids of the runner; Gx and Gy are written for all of them.
+    :param local_size: The 2d local size the kernel will be launched with.
+    :param accumulate: If True, the forces are added to Gx and Gy of the fluids they act on instead of overwriting
+        them, and static forces are left out; used for every kernel but the first of a split force list.
+    :return: A tuple (OpenCL source, number of local memory tiles, tile size in values)
+    """
+    # One tile per distinct (psi slot, bc) combination
+    tiles, halo = get_tiles(force_specs, psi_slots)
+
+    buf_nx = local_size[0] + 2*halo
+    buf_ny = local_size[1] + 2*halo
+
+    lines = []
+    lines.append('#ifdef cl_khr_fp64')
+    lines.append('    #pragma OPENCL EXTENSION cl_khr_fp64 : enable')
+    lines.append('#elif defined(cl_amd_fp64)')
+    lines.append('    #pragma OPENCL EXTENSION cl_amd_fp64 : enable')
+    lines.append('#endif')
+    lines.append('')
+    lines.append('#define HALO %d' % halo)
+    lines.append('#define BUF_NX %d' % buf_nx)
+    lines.append('#define BUF_NY %d' % buf_ny)
+    lines.append('#define BUF_SIZE (BUF_NX*BUF_NY)')
+    lines.append('')
+    lines.append('__kernel void')
+    lines.append('fused_forces(__global __read_only double *rho_global,')
+    lines.append('             __global __read_only double *psi_global,')
+    lines.append('             __global __read_only double *static_Gx_global,')
+    lines.append('             __global __read_only double *static_Gy_global,')
+    lines.append('             __global double *Gx_global,')
+    lines.append('             __global double *Gy_global,')
+    lines.append('             __local double *tiles,')
+    lines.append('             const int nx, const int ny)')
+    lines.append('{')
+    lines.append('    const int x = get_global_id(0);')
+    lines.append('    const int y = get_global_id(1);')
+    lines.append('    const int two_d_index = y*nx + x;')
+
+    if len(tiles) > 0:
+        lines.append('')
+        lines.append('    // Load every pseudopotential tile, with its halo, once per work group')
+        lines.append('    const int buf_corner_x = x - get_local_id(0) - HALO;')
+        lines.append('    const int buf_corner_y = y - get_local_id(1) - HALO;')
+        lines.append('    const int buf_x = get_local_id(0) + HALO;')
+        lines.append('    const int buf_y = get_local_id(1) + HALO;')
+        lines.append('    const int idx_1D = get_local_id(1)*get_local_size(0) + get_local_id(0);')
+        lines.append('    const int num_local = get_local_size(0)*get_local_size(1);')
+        lines.append('    const int center = buf_y*BUF_NX + buf_x;')
+        lines.append('')
+        lines.append('    for (int i = idx_1D; i < BUF_SIZE; i += num_local){')
+        lines.append('        const int row = i / BUF_NX;')
+        lines.append('        const int col = i - row*BUF_NX;')
+        for bc in BC_CODES:
+            tile_indices = [t for t, key in enumerate(tiles) if key[1] == bc]
+            if len(tile_indices) == 0:
+                continue
+            lines.append('        {')
+            lines.append('            int temp_x = buf_corner_x + col;')
+            lines.append('            int temp_y = buf_corner_y + row;')
+            lines.append('            ' + get_bc_code(bc, 'temp_x', 'nx'))
+            lines.append('            ' + get_bc_code(bc, 'temp_y', 'ny'))
+            for t in tile_indices:
+                slot = tiles[t][0]
+                lines.append('            tiles[%d*BUF_SIZE + i] = psi_global[%d*nx*ny + temp_y*nx + temp_x];' %
+                             (t, slot))
+            lines.append('        }')
+        lines.append('    }')
+        lines.append('    barrier(CLK_LOCAL_MEM_FENCE);')
+
+    lines.append('')
+    if accumulate:
+        written_fluids = sorted(set(f for spec in force_specs if spec[0] == 'interaction' for f in spec[1:3]))
+    else:
+        written_fluids = range(num_populations)
+
+    lines.append('    if ((x < nx) && (y < ny)){')
+    for fluid in written_fluids:
+        if accumulate:
+            lines.append('        double Fx_%d = Gx_global[%d*nx*ny + two_d_index];' % (fluid, fluid))
+            lines.append('        double Fy_%d = Gy_global[%d*nx*ny + two_d_index];' % (fluid, fluid))
+        elif fluid in static_fluids:
+            lines.append('        const double rho_%d = rho_global[%d*nx*ny + two_d_index];' % (fluid, fluid))
+            for axis in ('x', 'y'):
+                lines.append('        double F%s_%d = static_G%s_global[%d*nx*ny + two_d_index]*rho_%d;' %
+                             (axis, fluid, axis, fluid, fluid))
+        else:
+            lines.append('        double Fx_%d = 0;' % fluid)
+            lines.append('        double Fy_%d = 0;' % fluid)
+
+    for num, spec in enumerate(force_specs):
+        lines.append('')
+        lines.append('        // Force %d: %s' % (num, spec[0]))
+        lines.append('        {')
+        if spec[0] == 'interaction':
+            fluid_1, fluid_2, G_int, bc, potential, parameters, stencil = spec[1:]
+            tile_1 = tiles.index((psi_slots.index((fluid_1, potential, parameters)), bc))
+            tile_2 = tiles.index((psi_slots.index((fluid_2, potential, parameters)), bc))
+            lines.append('            __local double *psi_1 = tiles + %d*BUF_SIZE;' % tile_1)
+            lines.append('            __local double *psi_2 = tiles + %d*BUF_SIZE;' % tile_2)
+            lines.append('            double sum_x_1 = 0; double sum_y_1 = 0;')
+            lines.append('            double sum_x_2 = 0; double sum_y_2 = 0;')
+            for w, cx, cy in stencil:
+                if cx == 0 and cy == 0:
+                    continue
+                offset = '%d*BUF_NX + %d' % (cy, cx)
+                lines.append('            {')
+                lines.append('                const double p_1 = psi_1[center + %s];' % offset)
+                lines.append('                const double p_2 = psi_2[center + %s];' % offset)
+                for axis, c in (('x', cx), ('y', cy)):
+                    if c != 0:
+                        weight = literal(w*c)
+                        lines.append('                sum_%s_1 += %s*p_2;' % (axis, weight))
+                        lines.append('                sum_%s_2 += %s*p_1;' % (axis, weight))
+                lines.append('            }')
+            G = literal(G_int)
+            lines.append('            Fx_%d += -(%s*psi_1[center])*sum_x_1;' % (fluid_1, G))
+            lines.append('            Fy_%d += -(%s*psi_1[center])*sum_y_1;' % (fluid_1, G))
+            lines.append('            Fx_%d += -(%s*psi_2[center])*sum_x_2;' % (fluid_2, G))
+            lines.append('            Fy_%d += -(%s*psi_2[center])*sum_y_2;' % (fluid_2, G))
+        else:
+            raise ValueError('Unknown force ' + str(spec[0]))
+        lines.append('        }')
+
+    lines.append('')
+    for fluid in written_fluids:
+        lines.append('        Gx_global[%d*nx*ny + two_d_index] = Fx_%d;' % (fluid, fluid))
+        lines.append('        Gy_global[%d*nx*ny + two_d_index] = Fy_%d;' % (fluid, fluid))
+    lines.append('    }')
+    lines.append('}')
+    lines.append('')
+
+    return '\n'.join(lines), len(tiles), buf_nx*buf_ny
+
+
+def get_max_local_memory(context):
+    """:return: The bytes of local memory a work group may use on the first device of the context."""
+    return context.devices[0].local_mem_size
+
+
+def get_fused_force_kernel(context, force_specs, psi_slots, static_fluids, num_populations, local_size,
+                           accumulate=False, program_cache=None):
+    """
+    Generates and compiles the fused force kernel of the given forces.
+
+    :param program_cache: An optional dictionary of compiled programs by source, for the given context only
+    :return: A tuple (kernel, cl.LocalMemory holding the tiles)
+    """
+    source, num_tiles, tile_size = generate_force_source(force_specs, psi_slots, static_fluids, num_populations,
+                                                         local_size, accumulate=accumulate)
+    if program_cache is None:
+        program_cache = {}
+    if source not in program_cache:
+        program_cache[source] = cl.Program(context, source).build(options='')
+
+    # A local argument must have a nonzero size even if no tiles are used
+    local_tiles = cl.LocalMemory(max(1, num_tiles * tile_size) * np.dtype(np.double).itemsize)
+    return program_cache[source].fused_forces, local_tiles
+
+
+def get_fused_force_kernels(context, force_specs, psi_slots, static_fluids, num_populations, local_size,
+                            program_cache=None):
+    """
+    Splits the forces into as few fused kernels as the local memory of the device allows; see split_force_specs.
+
+    :param program_cache: An optional dictionary of compiled programs by source; see get_fused_force_kernel
+    :return: A list of (kernel, cl.LocalMemory) to launch in order, or None if a single force does not fit into
+        local memory and the forces have to be evaluated by their own kernels.
+    """
+    groups = split_force_specs(force_specs, psi_slots, local_size, get_max_local_memory(context))
+    if groups is None:
+        return None
+    return [get_fused_force_kernel(context, group, psi_slots, static_fluids, num_populations, local_size,
+                                   accumulate=(num > 0), program_cache=program_cache)
+            for num, group in enumerate(groups)]
@@ -19,11 +19,12 @@ update_feq_fluid(
     __constant int *cy_arr,
     const double cs,
     const int nx, const int ny,
-    const int field_num,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers)
 {
-    //Input should be a 2d workgroup. But, we loop over a 4d array...
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int field_num = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -83,17 +84,19 @@ collide_particles_fluid(
     __global __read_only double *v_bary_global,
     __global __read_only double *Gx_global,
     __global __read_only double *Gy_global,
-    const double omega,
+    __constant double *omega_table,
     __constant double *w_arr,
     __constant int *cx_arr,
     __constant int *cy_arr,
     const int nx, const int ny,
-    const int cur_field,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers,
     const double cs)
 {
-    //Input should be a 2d workgroup! Loop over the third dimension.
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
+    const double omega = omega_table[cur_field];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -284,12 +287,13 @@ update_hydro_fluid(
     __constant int *cx_arr,
     __constant int *cy_arr,
     const int nx, const int ny,
-    const int cur_field,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers
 )
 {
-    //Input should be a 2d workgroup! Loop over the third dimension.
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -333,12 +337,13 @@ move_periodic(__global __read_only double *f_global,
               __constant int *cx,
               __constant int *cy,
               const int nx, const int ny,
-              const int cur_field,
+              __constant int *field_table,
               const int num_populations,
               const int num_jumpers)
 {
     /* Moves you assuming periodic BC's. */
-    //Input should be a 2d workgroup!
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -377,11 +382,12 @@ move(
     __constant int *cx,
     __constant int *cy,
     const int nx, const int ny,
-    const int cur_field,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers)
 {
-    //Input should be a 2d workgroup!
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -412,11 +418,12 @@ __kernel void
 move_open_bcs(
     __global __read_only double *f_global,
     const int nx, const int ny,
-    const int cur_field,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers)
 {
-    //Input should be a 2d workgroup!
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -518,12 +525,13 @@ copy_streamed_onto_f(
     __constant int *cx,
     __constant int *cy,
     const int nx, const int ny,
-    const int cur_field,
+    __constant int *field_table,
     const int num_populations,
     const int num_jumpers)
 {
     /* Moves you assuming periodic BC's. */
-    //Input should be a 2d workgroup!
+    //Input should be a 3d workgroup; the third dimension indexes the fields listed in field_table.
+    const int cur_field = field_table[get_global_id(2)];
     const int x = get_global_id(0);
     const int y = get_global_id(1);
 
@@ -539,94 +547,47 @@ copy_streamed_onto_f(
 }
 
 __kernel void
-add_constant_g_force(
-    const int field_num,
-    const double g_x,
-    const double g_y,
-    __global double *Gx_global,
-    __global double *Gy_global,
-    __global double *rho_global,
-    const int nx, const int ny
-)
+apply_static_forces(
+    __global __read_only double *rho_global,
+    __global __read_only double *static_Gx_global,
+    __global __read_only double *static_Gy_global,
+    __global __write_only double *Gx_global,
+    __global __write_only double *Gy_global,
+    const int nx, const int ny)
 {
-    //Input should be a 2d workgroup! Loop over the third dimension.
+    // Starts the body force of a step from the position-only forces, stored as force per density when they
+    // are registered. Overwrites G, so it also replaces zeroing it.
     const int x = get_global_id(0);
     const int y = get_global_id(1);
+    const int field_num = get_global_id(2);
 
     if ((x < nx) && (y < ny)){
-        int three_d_index = field_num*nx*ny + y*nx + x;
-
-        double rho = rho_global[three_d_index];
+        const int three_d_index = field_num*nx*ny + y*nx + x;
+        const double rho = rho_global[three_d_index];
 
         // Rembmer, force PER density! In *dimensionless* units.
-        Gx_global[three_d_index] += g_x*rho;
-        Gy_global[three_d_index] += g_y*rho;
-
-    }
-}
-
-__kernel void
-add_radial_g_force(
-    const int field_num,
-    const int center_x,
-    const int center_y,
-    const double prefactor,
-    const double radial_scaling,
-    __global double *Gx_global,
-    __global double *Gy_global,
-    __global double *rho_global,
-    const int nx, const int ny
-)
-{
-    //Input should be a 2d workgroup! Loop over the third dimension.
-    const int x = get_global_id(0);
-    const int y = get_global_id(1);
-
-    if ((x < nx) && (y < ny)){
-        int three_d_index = field_num*nx*ny + y*nx + x;
-
-        double rho = rho_global[three_d_index];
-        // Get the current radius and angle
-
-        const double dx = x - center_x;
-        const double dy = y - center_y;
-
-        const double radius_dim = sqrt(dx*dx + dy*dy);
-        const double theta = atan2(dy, dx);
-
-        // Get the unit vector
-        const double rhat_x = cos(theta);
-        const double rhat_y = sin(theta);
-
-        // Get the gravitational acceleration
-        double magnitude = prefactor*((double)pow(radius_dim, radial_scaling));
-        Gx_global[three_d_index] += rho*magnitude*rhat_x;
-        Gy_global[three_d_index] += rho*magnitude*rhat_y;
+        Gx_global[three_d_index] = static_Gx_global[three_d_index]*rho;
+        Gy_global[three_d_index] = static_Gy_global[three_d_index]*rho;
     }
 }
 
-void get_psi(
+double get_psi(
     const int PSI_SPECIFIER,
-    double rho_1, double rho_2,
-    double *psi_1, double *psi_2,
+    double rho,
     __constant double *parameters)
 {
     //TODO: DO WE NEED ZERO CHECKING?
-    if(rho_1 < 0) rho_1 = 0;
-    if(rho_2 < 0) rho_2 = 0;
+    if(rho < 0) rho = 0;
 
-    if(PSI_SPECIFIER == 0){ // rho_1 * rho_2
-        *psi_1 = rho_1;
-        *psi_2 = rho_2;
+    if(PSI_SPECIFIER == 0){ // psi = rho
+        return rho;
     }
     if(PSI_SPECIFIER == 1){ // shan-chen
         double rho_0 = parameters[0];
-        *psi_1 = rho_0*(1 - exp(-rho_1/rho_0));
-        *psi_2 = rho_0*(1 - exp(-rho_2/rho_0));
+        return rho_0*(1 - exp(-rho/rho_0));
     }
-    if(PSI_SPECIFIER == 2){ // pow(rho_1, alpha) * pow(rho_2, alpha)
-        *psi_1 = (double)pow(rho_1, parameters[0]);
-        *psi_2 = (double)pow(rho_2, parameters[0]);
+    if(PSI_SPECIFIER == 2){ // psi = pow(rho, alpha)
+        return (double)pow(rho, parameters[0]);
     }
     if(PSI_SPECIFIER==3){ //van-der-waals; G MUST BE SET TO ONE TO USE THIS
         double a = parameters[0];
@@ -634,11 +595,35 @@ void get_psi(
         double T = parameters[2];
         double cs = parameters[3];
 
-        double P1 = (rho_1*T)/(1 - rho_1*b) - a*rho_1*rho_1;
-        double P2 = (rho_2*T)/(1 - rho_2*b) - a*rho_2*rho_2;
+        double P = (rho*T)/(1 - rho*b) - a*rho*rho;
+
+        return sqrt(2*(P - cs*cs*rho)/(cs*cs));
+    }
+    return 0;
+}
+
+__kernel void
+update_psi(
+    __global __read_only double *rho_global,
+    __global __write_only double *psi_global,
+    __constant int *slot_fluids,
+    __constant int *slot_specifiers,
+    __constant double *slot_parameters,
+    const int num_slot_parameters,
+    const int nx, const int ny)
+{
+    // Evaluates the pseudopotential of every (fluid, potential) slot once per step. The interaction
+    // forces then only have to sum psi over their stencil.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+    const int slot = get_global_id(2);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        const double rho = rho_global[slot_fluids[slot]*ny*nx + two_d_index];
 
-        *psi_1 = sqrt(2*(P1 - cs*cs*rho_1)/(cs*cs));
-        *psi_2 = sqrt(2*(P2 - cs*cs*rho_2)/(cs*cs));
+        psi_global[slot*ny*nx + two_d_index] = get_psi(slot_specifiers[slot], rho,
+                                                       slot_parameters + slot*num_slot_parameters);
     }
 }
 
@@ -668,10 +653,12 @@ __kernel void
 add_interaction_force(
     const int fluid_index_1,
     const int fluid_index_2,
+    const int psi_slot_1,
+    const int psi_slot_2,
     const double G_int,
     __local double *local_fluid_1,
     __local double *local_fluid_2,
-    __global __read_only double *rho_global,
+    __global __read_only double *psi_global,
     __global double *Gx_global,
     __global double *Gy_global,
     const double cs,
@@ -682,9 +669,7 @@ add_interaction_force(
     const int buf_nx, const int buf_ny,
     const int halo,
     const int num_jumpers,
-    const int BC_SPECIFIER,
-    const int PSI_SPECIFIER,
-    __constant double *parameters)
+    const int BC_SPECIFIER)
 {
     const int x = get_global_id(0);
     const int y = get_global_id(1);
@@ -717,13 +702,13 @@ add_interaction_force(
             //Painfully deal with BC's...i.e. use periodic BC's.
             get_BC(&temp_x, &temp_y, BC_SPECIFIER, nx, ny);
 
-            local_fluid_1[row*buf_nx + idx_1D] = rho_global[fluid_index_1*ny*nx + temp_y*nx + temp_x];
-            local_fluid_2[row*buf_nx + idx_1D] = rho_global[fluid_index_2*ny*nx + temp_y*nx + temp_x];
+            local_fluid_1[row*buf_nx + idx_1D] = psi_global[psi_slot_1*ny*nx + temp_y*nx + temp_x];
+            local_fluid_2[row*buf_nx + idx_1D] = psi_global[psi_slot_2*ny*nx + temp_y*nx + temp_x];
         }
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    //Now that all desired rhos are read in, do the multiplication
+    //Now that all desired psis are read in, do the multiplication
     if ((x < nx) && (y < ny)){
 
         double force_x_fluid_1 = 0;
@@ -735,16 +720,8 @@ add_interaction_force(
         // Get the psi at the current pixel
         const int old_2d_buf_index = buf_y*buf_nx + buf_x;
 
-        double rho_1_pixel = local_fluid_1[old_2d_buf_index];
-        double rho_2_pixel = local_fluid_2[old_2d_buf_index];
-
-        double psi_1_pixel = 0;
-        double psi_2_pixel = 0;
-
-        get_psi(PSI_SPECIFIER, rho_1_pixel, rho_2_pixel, &psi_1_pixel, &psi_2_pixel, parameters);
-
-        double psi_1 = 0; // The psi that correspond to jumping around the lattice
-        double psi_2 = 0;
+        const double psi_1_pixel = local_fluid_1[old_2d_buf_index];
+        const double psi_2_pixel = local_fluid_2[old_2d_buf_index];
 
         for(int jump_id = 0; jump_id < num_jumpers; jump_id++){
             int cur_cx = cx[jump_id];
@@ -757,10 +734,9 @@ add_interaction_force(
 
             int new_2d_buf_index = stream_buf_y*buf_nx + stream_buf_x;
 
-            double cur_rho_1 = local_fluid_1[new_2d_buf_index];
-            double cur_rho_2 = local_fluid_2[new_2d_buf_index];
-
-            get_psi(PSI_SPECIFIER, cur_rho_1, cur_rho_2, &psi_1, &psi_2, parameters);
+            // The psi that correspond to jumping around the lattice
+            const double psi_1 = local_fluid_1[new_2d_buf_index];
+            const double psi_2 = local_fluid_2[new_2d_buf_index];
 
             force_x_fluid_1 += cur_w * cur_cx * psi_2;
             force_y_fluid_1 += cur_w * cur_cy * psi_2;
@@ -794,10 +770,12 @@ __kernel void
 add_interaction_force_second_belt(
     const int fluid_index_1,
     const int fluid_index_2,
+    const int psi_slot_1,
+    const int psi_slot_2,
     const double G_int,
     __local double *local_fluid_1,
     __local double *local_fluid_2,
-    __global __read_only double *rho_global,
+    __global __read_only double *psi_global,
     __global double *Gx_global,
     __global double *Gy_global,
     const double cs,
@@ -812,9 +790,7 @@ add_interaction_force_second_belt(
     const int nx, const int ny,
     const int buf_nx, const int buf_ny,
     const int halo,
-    const int BC_SPECIFIER,
-    const int PSI_SPECIFIER,
-    __constant double *parameters)
+    const int BC_SPECIFIER)
 {
     const int x = get_global_id(0);
     const int y = get_global_id(1);
@@ -847,13 +823,13 @@ add_interaction_force_second_belt(
             //Painfully deal with BC's...i.e. use periodic BC's.
             get_BC(&temp_x, &temp_y, BC_SPECIFIER, nx, ny);
 
-            local_fluid_1[row*buf_nx + idx_1D] = rho_global[fluid_index_1*ny*nx + temp_y*nx + temp_x];
-            local_fluid_2[row*buf_nx + idx_1D] = rho_global[fluid_index_2*ny*nx + temp_y*nx + temp_x];
+            local_fluid_1[row*buf_nx + idx_1D] = psi_global[psi_slot_1*ny*nx + temp_y*nx + temp_x];
+            local_fluid_2[row*buf_nx + idx_1D] = psi_global[psi_slot_2*ny*nx + temp_y*nx + temp_x];
         }
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    //Now that all desired rhos are read in, do the multiplication
+    //Now that all desired psis are read in, do the multiplication
     if ((x < nx) && (y < ny)){
 
         //Remember, this is force PER DENSITY to avoid problems
@@ -866,18 +842,8 @@ add_interaction_force_second_belt(
         // Get the psi at the current pixel
         const int old_2d_buf_index = buf_y*buf_nx + buf_x;
 
-        double rho_1_pixel = local_fluid_1[old_2d_buf_index];
-        double rho_2_pixel = local_fluid_2[old_2d_buf_index];
-
-        double psi_1_pixel = 0;
-        double psi_2_pixel = 0;
-
-        get_psi(PSI_SPECIFIER, rho_1_pixel, rho_2_pixel, &psi_1_pixel, &psi_2_pixel, parameters);
-
-        //Psi at other pixels
-
-        double psi_1 = 0;
-        double psi_2 = 0;
+        const double psi_1_pixel = local_fluid_1[old_2d_buf_index];
+        const double psi_2_pixel = local_fluid_2[old_2d_buf_index];
 
         for(int jump_id = 0; jump_id < num_jumpers_1; jump_id++){
             int cur_cx = cx1[jump_id];
@@ -890,10 +856,9 @@ add_interaction_force_second_belt(
 
             int new_2d_buf_index = stream_buf_y*buf_nx + stream_buf_x;
 
-            double cur_rho_1 = local_fluid_1[new_2d_buf_index];
-            double cur_rho_2 = local_fluid_2[new_2d_buf_index];
-
-            get_psi(PSI_SPECIFIER, cur_rho_1, cur_rho_2, &psi_1, &psi_2, parameters);
+            // The psi that correspond to jumping around the lattice
+            const double psi_1 = local_fluid_1[new_2d_buf_index];
+            const double psi_2 = local_fluid_2[new_2d_buf_index];
 
             force_x_fluid_1 += cur_w * cur_cx * psi_2;
             force_y_fluid_1 += cur_w * cur_cy * psi_2;
@@ -913,10 +878,9 @@ add_interaction_force_second_belt(
 
             int new_2d_buf_index = stream_buf_y*buf_nx + stream_buf_x;
 
-            double cur_rho_1 = local_fluid_1[new_2d_buf_index];
-            double cur_rho_2 = local_fluid_2[new_2d_buf_index];
-
-            get_psi(PSI_SPECIFIER, cur_rho_1, cur_rho_2, &psi_1, &psi_2, parameters);
+            // The psi that correspond to jumping around the lattice
+            const double psi_1 = local_fluid_1[new_2d_buf_index];
+            const double psi_2 = local_fluid_2[new_2d_buf_index];
 
             force_x_fluid_1 += cur_w * cur_cx * psi_2;
             force_y_fluid_1 += cur_w * cur_cy * psi_2;
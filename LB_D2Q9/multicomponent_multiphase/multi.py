@@ -6,8 +6,15 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import recorder
+from LB_D2Q9 import memory_pool
+from LB_D2Q9 import diagnostics
+from LB_D2Q9 import initialization
 import matplotlib.pyplot as plt
 from LB_D2Q9.spectral_poisson import screened_poisson as sp
+from LB_D2Q9.spectral_poisson import schedule
+from LB_D2Q9.multicomponent_multiphase import force_compiler
 
 # Required to draw obstacles
 import skimage as ski
@@ -24,6 +31,10 @@ num_size = ct.sizeof(ct.c_double)
 num_type = np.double
 int_type = np.int32
 
+# The pseudopotentials of the interaction forces, as numbered by get_psi in multi.cl
+PSI_SPECIFIERS = {'linear': 0, 'shan_chen': 1, 'pow': 2, 'vdw': 3}
+NUM_PSI_PARAMETERS = 4 # The parameters of every psi slot are padded to this length
+
 
 def get_divisible_global(global_size, local_size):
     """
@@ -54,6 +65,12 @@ class Fluid(object):
 
         self.lb_nu_e = num_type(nu)
         self.bc = bc
+        if self.bc not in ('periodic', 'zero_gradient'):
+            raise ValueError('unknown bc...')
+
+        # The kernels act on the fields listed in a table; this fluid's launches list only itself.
+        self.field_table = cl.Buffer(sim.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                     hostbuf=np.array([self.field_index], dtype=int_type))
 
         # Determine the viscosity
         self.tau = num_type(.5 + self.lb_nu_e / (sim.cs**2))
@@ -66,13 +83,14 @@ class Fluid(object):
     def initialize(self, rho_arr, f_amp = 0.0):
         """
         ASSUMES THAT THE BARYCENTRIC VELOCITY IS ALREADY SET
+
+        :param rho_arr: The initial density: a scalar, an (nx, ny) array, or an OpenCL expression of x and y that is
+            evaluated on the device; see initialization.Initializer.set_field_slice.
+        :param f_amp: The relative amplitude of the noise added to the initial populations
         """
 
         #### DENSITY #####
-        rho_host = self.sim.rho.get()
-
-        rho_host[:, :, self.field_index] = rho_arr
-        self.sim.rho = cl.array.to_device(self.sim.queue, rho_host)
+        self.sim.initializer.set_field_slice(self.sim.rho, self.field_index, rho_arr)
 
         #### UPDATE HOPPERS ####
         self.update_feq() # Based on the hydrodynamic fields, create feq
@@ -85,23 +103,12 @@ class Fluid(object):
         # self.update_forces() # Calculates the drag force, if necessary, based on the component velocity
 
     def init_pop(self, amplitude=0.001):
-        """Based on feq, create the initial population of jumpers."""
-
-        nx = self.sim.nx
-        ny = self.sim.ny
-
-        # For simplicity, copy feq to the local host, where you can make a copy. There is probably a better way to do this.
-        f_host = self.sim.feq.get()
-        cur_f = f_host[:, :, self.field_index, :]
+        """Based on feq, create the initial population of jumpers. Only this fluid's slice of f is written."""
 
         # We now slightly perturb f. This is actually dangerous, as concentration can grow exponentially fast
         # from sall fluctuations. Sooo...be careful.
-        perturb = (1. + amplitude * np.random.randn(nx, ny, self.sim.num_jumpers))
-        cur_f *= perturb
-
-        # Now send f to the GPU
-        f_host[:, :, self.field_index, :] = cur_f
-        self.sim.f = cl.array.to_device(self.sim.queue, f_host)
+        self.sim.initializer.perturb_populations(self.sim.f, self.sim.feq, self.field_index,
+                                                 self.sim.num_populations, self.sim.num_jumpers, amplitude)
 
     def update_forces(self):
         """For internal forces...none in this case."""
@@ -113,39 +120,14 @@ class Fluid(object):
         Based on the hydrodynamic fields, create the local equilibrium feq that the jumpers f will relax to.
         Implemented in OpenCL.
         """
-
-        sim = self.sim
-
-        self.sim.kernels.update_feq_fluid(
-            sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-            sim.feq.data,
-            sim.rho.data,
-            sim.u_bary.data, sim.v_bary.data,
-            sim.w, sim.cx, sim.cy, sim.cs,
-            sim.nx, sim.ny,
-            self.field_index, sim.num_populations,
-            sim.num_jumpers).wait()
+        self.sim.update_feq_fields(self.field_table, 1)
 
     def move_bcs(self):
         """
         Enforce boundary conditions and move the jumpers on the boundaries. Generally extremely painful.
         Implemented in OpenCL.
         """
-
-        sim = self.sim
-
-        if self.bc is 'periodic':
-            pass # Implemented in move_periodic in this case...it's just easier
-        elif self.bc is 'zero_gradient':
-            self.sim.kernels.move_open_bcs(
-                sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-                sim.f.data,
-                sim.nx, sim.ny,
-                self.field_index, sim.num_populations,
-                sim.num_jumpers).wait()
-        else:
-            raise ValueError('unknown bc...')
-
+        self.sim.move_bcs_fields(self.bc, self.field_table, 1)
 
     def move(self):
         """
@@ -153,77 +135,17 @@ class Fluid(object):
         streaming f into a new buffer, and then copying that new buffer onto f. We could not think of a way to stream
         in parallel without copying the temporary buffer back onto f.
         """
-
-        sim = self.sim
-
-        if self.bc is 'periodic':
-            self.sim.kernels.move_periodic(
-                sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-                sim.f.data, sim.f_streamed.data,
-                sim.cx, sim.cy,
-                sim.nx, sim.ny,
-                self.field_index, sim.num_populations, sim.num_jumpers
-            ).wait()
-        elif self.bc is 'zero_gradient':
-            self.sim.kernels.move(
-                sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-                sim.f.data, sim.f_streamed.data,
-                sim.cx, sim.cy,
-                sim.nx, sim.ny,
-                self.field_index, sim.num_populations, sim.num_jumpers
-            ).wait()
-        else:
-            raise ValueError('unknown bc...')
-
+        self.sim.move_fields(self.bc, self.field_table, 1)
         # Copy the streamed buffer into f so that it is correctly updated.
-        self.sim.kernels.copy_streamed_onto_f(
-            sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-            sim.f_streamed.data, sim.f.data,
-            sim.cx, sim.cy,
-            sim.nx, sim.ny,
-            self.field_index, sim.num_populations, sim.num_jumpers).wait()
+        self.sim.copy_streamed_fields(self.field_table, 1)
 
     def update_hydro(self):
-
-        sim = self.sim
-
-        sim.kernels.update_hydro_fluid(
-            sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-            sim.f.data,
-            sim.rho.data,
-            sim.u.data, sim.v.data,
-            sim.Gx.data, sim.Gy.data,
-            sim.w, sim.cx, sim.cy,
-            sim.nx, sim.ny,
-            self.field_index, sim.num_populations,
-            sim.num_jumpers
-        ).wait()
-
-        if sim.check_max_ulb:
-            max_ulb = cl.array.max((sim.u[:, :, self.field_index]**2 + sim.v[:, :, self.field_index]**2)**.5, queue=sim.queue)
-
-            if max_ulb > sim.cs*sim.mach_tolerance:
-                print 'max_ulb is greater than cs/10! Ma=', max_ulb/sim.cs
+        self.sim.update_hydro_fields(self.field_table, 1)
 
     def collide_particles(self):
-        sim = self.sim
-
-        self.sim.kernels.collide_particles_fluid(
-            sim.queue, sim.two_d_global_size, sim.two_d_local_size,
-            sim.f.data,
-            sim.feq.data,
-            sim.rho.data,
-            sim.u_bary.data, sim.v_bary.data,
-            sim.Gx.data, sim.Gy.data,
-            self.omega,
-            sim.w, sim.cx, sim.cy,
-            sim.nx, sim.ny,
-            self.field_index, sim.num_populations,
-            sim.num_jumpers,
-            sim.cs
-        ).wait()
+        self.sim.collide_fields(self.field_table, 1)
 
-class Simulation_Runner(object):
+class Simulation_Runner(checkpoint.Checkpointable, recorder.Recordable):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -233,7 +155,7 @@ class Simulation_Runner(object):
                  num_populations=1,
                  two_d_local_size=(32,32), use_interop=False,
                  check_max_ulb=False, mach_tolerance=0.1,
-                 context = None):
+                 context = None, diagnostics_interval=1, batch_fluids=True, fuse_forces=True):
 
         self.nx = int_type(nx)
         self.ny = int_type(ny)
@@ -253,6 +175,8 @@ class Simulation_Runner(object):
         # Create global & local sizes appropriately
         self.two_d_local_size = two_d_local_size        # The local size to be used for 2-d workgroups
         self.two_d_global_size = get_divisible_global((self.nx, self.ny), self.two_d_local_size)
+        # Launches over (nx, ny, fields); the fields of a launch never share a workgroup
+        self.three_d_local_size = tuple(self.two_d_local_size) + (1,)
 
         print '2d global:' , self.two_d_global_size
         print '2d local:' , self.two_d_local_size
@@ -263,6 +187,8 @@ class Simulation_Runner(object):
         self.kernels = None     # Compiled OpenCL kernels
         self.use_interop = use_interop
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
@@ -271,51 +197,95 @@ class Simulation_Runner(object):
         self.cs = None
         self.num_jumpers = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.recorders = [] # Scalar time series recorded every step; see add_recorder
+        # Device fields saved by save_checkpoint. psi is skipped while no interaction uses it.
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'u_bary', 'v_bary', 'Gx', 'Gy', 'psi']
+        # Owned objects whose state is saved with the runner; see checkpoint.Checkpointable
+        self.checkpoint_children = ['poisson_solver', 'poisson_schedule']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables & Shan-chen variables
 
         rho_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         u_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
         v_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.u = cl.array.to_device(self.queue, u_host) # Velocity in the x direction; one per sim!
-        self.v = cl.array.to_device(self.queue, v_host) # Velocity in the y direction; one per sim.
+        self.u = cl.array.to_device(self.queue, u_host, allocator=self.allocator) # Velocity in the x direction; one per sim!
+        self.v = cl.array.to_device(self.queue, v_host, allocator=self.allocator) # Velocity in the y direction; one per sim.
 
         u_bary_host = np.zeros((self.nx, self.ny), dtype=num_type, order='F')
         v_bary_host = np.zeros((self.nx, self.ny), dtype=num_type, order='F')
-        self.u_bary = cl.array.to_device(self.queue, u_bary_host)  # Velocity in the x direction; one per sim!
-        self.v_bary = cl.array.to_device(self.queue, v_bary_host)  # Velocity in the y direction; one per sim.
+        self.u_bary = cl.array.to_device(self.queue, u_bary_host, allocator=self.allocator)  # Velocity in the x direction; one per sim!
+        self.v_bary = cl.array.to_device(self.queue, v_bary_host, allocator=self.allocator)  # Velocity in the y direction; one per sim.
 
         # Intitialize the underlying feq equilibrium field
         feq_host = np.zeros((self.nx, self.ny, self.num_populations, self.num_jumpers), dtype=num_type, order='F')
-        self.feq = cl.array.to_device(self.queue, feq_host)
+        self.feq = cl.array.to_device(self.queue, feq_host, allocator=self.allocator)
 
         f_host = np.zeros((self.nx, self.ny, self.num_populations, self.num_jumpers), dtype=num_type, order='F')
-        self.f = cl.array.to_device(self.queue, f_host)
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
         self.f_streamed = self.f.copy()
 
         # Initialize G: the body force acting on each phase
         Gx_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
         Gy_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.Gx = cl.array.to_device(self.queue, Gx_host)
-        self.Gy = cl.array.to_device(self.queue, Gy_host)
+        self.Gx = cl.array.to_device(self.queue, Gx_host, allocator=self.allocator)
+        self.Gy = cl.array.to_device(self.queue, Gy_host, allocator=self.allocator)
+
+        # On-device health checks (mass, momentum, Mach number, NaN/Inf); see check_fields
+        self.diagnostics = diagnostics.Diagnostics(self, interval=diagnostics_interval)
+
+        # Writes the initial conditions of the fluids in place; its random number generator is checkpointed
+        self.initializer = initialization.Initializer(self)
+        self.random_generator = self.initializer.random_generator
 
         # Create list corresponding to all of the different fluids
         self.fluid_list = []
         self.tau_arr = []
+        self.omega_table = None # The relaxation rate of every field, indexed by field_index
+
+        # If batch_fluids, each phase of a step is launched once per group of fluids sharing a boundary condition
+        # instead of once per fluid. The groups are built by complete_setup.
+        self.batch_fluids = batch_fluids
+        self.fluid_groups = [] # (bc, field table, number of fields)
+        self.all_fields_table = None
+        self.num_fluids = None
 
         self.additional_collisions = [] # Takes into account growth, other things that can influence collisions
         self.additional_forces = []  # Takes into account other forces, i.e. surface tension
 
+        # If fuse_forces, the forces registered by the add_*_force methods are evaluated by one generated kernel, or
+        # by a few if their tiles do not fit into local memory at once; see force_compiler. Entries of
+        # additional_forces are [kernel, arguments, description of the force].
+        self.fuse_forces = fuse_forces
+        self.fused_force_specs = None
+        self.fused_force_kernels = None # List of (kernel, local memory); None if the forces can not be fused
+        self.fused_force_programs = {} # Compiled fused force programs by source, so rebuilding the same forces is free
+
+        # Position-only forces (i.e. gravity), stored as force per density; see add_static_force
+        self.static_Gx = None
+        self.static_Gy = None
+        self.static_Gx_host = None
+        self.static_Gy_host = None
+        self.static_force_fluids = []
+
+        # The pseudopotential of every (fluid, potential, parameters) used by an interaction force is evaluated once
+        # per step into its own slot of psi, which all interactions read; see get_psi_slot.
+        self.psi_slots = []
+        self.psi = None
+        self.psi_slot_fluids = None
+        self.psi_slot_specifiers = None
+        self.psi_slot_parameters = None
+
         self.poisson_solver = None # To solve the poisson & screened poisson equation, if necessary.
         self.poisson_force_active = False
         self.poisson_source_index = None
         self.poisson_force_index = None
         self.poisson_amp = None
-        self.poisson_xgrad = None
-        self.poisson_ygrad = None
+        self.poisson_schedule = None # When to re-solve the poisson field
 
     def add_fluid(self, fluid):
         self.fluid_list.append(fluid)
@@ -333,9 +303,155 @@ class Simulation_Runner(object):
         self.tau_arr = cl.Buffer(self.context, cl.mem_flags.READ_ONLY |
         cl.mem_flags.COPY_HOST_PTR, hostbuf=tau_host)
 
+        omega_host = np.zeros(self.num_populations, dtype=num_type)
+        for cur_fluid in self.fluid_list:
+            omega_host[cur_fluid.field_index] = cur_fluid.omega
+        self.omega_table = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                     hostbuf=omega_host)
+
+        # Group the fluids by boundary condition
+        self.fluid_groups = []
+        bc_list = []
+        for cur_fluid in self.fluid_list:
+            if cur_fluid.bc not in bc_list:
+                bc_list.append(cur_fluid.bc)
+        for bc in bc_list:
+            fields = [cur_fluid.field_index for cur_fluid in self.fluid_list if cur_fluid.bc == bc]
+            self.fluid_groups.append((bc, self.get_field_table(fields), int_type(len(fields))))
+
+        all_fields = [cur_fluid.field_index for cur_fluid in self.fluid_list]
+        self.all_fields_table = self.get_field_table(all_fields)
+        self.num_fluids = int_type(len(all_fields))
+
+    def get_field_table(self, fields):
+        return cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                         hostbuf=np.array(fields, dtype=int_type))
+
+    def get_field_global_size(self, num_fields):
+        return tuple(self.two_d_global_size) + (int(num_fields),)
+
+    ##### Kernels acting on a list of fields. Each is a single launch over (nx, ny, num_fields). #####
+    def update_feq_fields(self, field_table, num_fields):
+        self.kernels.update_feq_fluid(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.feq.data,
+            self.rho.data,
+            self.u_bary.data, self.v_bary.data,
+            self.w, self.cx, self.cy, self.cs,
+            self.nx, self.ny,
+            field_table, self.num_populations,
+            self.num_jumpers).wait()
+
+    def move_bcs_fields(self, bc, field_table, num_fields):
+        if bc == 'periodic':
+            pass # Implemented in move_periodic in this case...it's just easier
+        elif bc == 'zero_gradient':
+            self.kernels.move_open_bcs(
+                self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+                self.f.data,
+                self.nx, self.ny,
+                field_table, self.num_populations,
+                self.num_jumpers).wait()
+        else:
+            raise ValueError('unknown bc...')
+
+    def move_fields(self, bc, field_table, num_fields):
+        """Streams the listed fields into f_streamed; see copy_streamed_fields."""
+        if bc == 'periodic':
+            kernel = self.kernels.move_periodic
+        elif bc == 'zero_gradient':
+            kernel = self.kernels.move
+        else:
+            raise ValueError('unknown bc...')
+
+        kernel(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f.data, self.f_streamed.data,
+            self.cx, self.cy,
+            self.nx, self.ny,
+            field_table, self.num_populations, self.num_jumpers
+        ).wait()
+
+    def copy_streamed_fields(self, field_table, num_fields):
+        self.kernels.copy_streamed_onto_f(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f_streamed.data, self.f.data,
+            self.cx, self.cy,
+            self.nx, self.ny,
+            field_table, self.num_populations, self.num_jumpers).wait()
+
+    def update_hydro_fields(self, field_table, num_fields):
+        self.kernels.update_hydro_fluid(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f.data,
+            self.rho.data,
+            self.u.data, self.v.data,
+            self.Gx.data, self.Gy.data,
+            self.w, self.cx, self.cy,
+            self.nx, self.ny,
+            field_table, self.num_populations,
+            self.num_jumpers
+        ).wait()
+
+    def collide_fields(self, field_table, num_fields):
+        self.kernels.collide_particles_fluid(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f.data,
+            self.feq.data,
+            self.rho.data,
+            self.u_bary.data, self.v_bary.data,
+            self.Gx.data, self.Gy.data,
+            self.omega_table,
+            self.w, self.cx, self.cy,
+            self.nx, self.ny,
+            field_table, self.num_populations,
+            self.num_jumpers,
+            self.cs
+        ).wait()
+
+    ##### The phases of a step, for every fluid #####
+    def move(self):
+        if self.batch_fluids:
+            for bc, field_table, num_fields in self.fluid_groups:
+                self.move_fields(bc, field_table, num_fields)
+            # Every fluid was streamed, whatever its bc, so one copy covers them all
+            self.copy_streamed_fields(self.all_fields_table, self.num_fluids)
+        else:
+            for cur_fluid in self.fluid_list:
+                cur_fluid.move()
+
+    def move_bcs(self):
+        if self.batch_fluids:
+            for bc, field_table, num_fields in self.fluid_groups:
+                self.move_bcs_fields(bc, field_table, num_fields)
+        else:
+            for cur_fluid in self.fluid_list:
+                cur_fluid.move_bcs()
+
+    def update_hydro(self):
+        if self.batch_fluids:
+            self.update_hydro_fields(self.all_fields_table, self.num_fluids)
+        else:
+            for cur_fluid in self.fluid_list:
+                cur_fluid.update_hydro()
+
+    def update_feq(self):
+        if self.batch_fluids:
+            self.update_feq_fields(self.all_fields_table, self.num_fluids)
+        else:
+            for cur_fluid in self.fluid_list:
+                cur_fluid.update_feq()
+
+    def collide_particles(self):
+        if self.batch_fluids:
+            self.collide_fields(self.all_fields_table, self.num_fluids)
+        else:
+            for cur_fluid in self.fluid_list:
+                cur_fluid.collide_particles()
+
     def set_bary_velocity(self, u_bary_host, v_bary_host):
-        self.u_bary = cl.array.to_device(self.queue, u_bary_host)
-        self.v_bary = cl.array.to_device(self.queue, v_bary_host)
+        self.u_bary = cl.array.to_device(self.queue, u_bary_host, allocator=self.allocator)
+        self.v_bary = cl.array.to_device(self.queue, v_bary_host, allocator=self.allocator)
 
     def update_bary_velocity(self):
         self.kernels.update_bary_velocity(
@@ -457,40 +573,59 @@ class Simulation_Runner(object):
         self.additional_collisions.append([kernel_to_run, arguments])
 
 
-    def add_constant_g_force(self, fluid_index, force_x, force_y):
+    def add_static_force(self, fluid_index, force_x, force_y):
+        """
+        Adds a body force that depends on position only. It is stored once as force per density and applied every
+        step as a single multiply by rho, in the same pass that starts G (see init_forces and the fused force kernel).
 
-        kernel_to_run = self.kernels.add_constant_g_force
-        arguments = [
-            self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_index), num_type(force_x), num_type(force_y),
-            self.Gx.data, self.Gy.data,
-            self.rho.data,
-            self.nx, self.ny
-        ]
+        :param fluid_index: The fluid the force acts on
+        :param force_x: The x force per density; a scalar or an (nx, ny) array
+        :param force_y: The y force per density; a scalar or an (nx, ny) array
+        """
+        if self.static_Gx is None:
+            self.static_Gx_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
+            self.static_Gy_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
 
-        self.additional_forces.append([kernel_to_run, arguments])
+        self.static_Gx_host[:, :, fluid_index] += force_x
+        self.static_Gy_host[:, :, fluid_index] += force_y
+        if int(fluid_index) not in self.static_force_fluids:
+            self.static_force_fluids.append(int(fluid_index))
+            self.static_force_fluids.sort()
 
-    def add_radial_g_force(self, fluid_index, center_x, center_y, prefactor, radial_scaling):
+        self.static_Gx = cl.array.to_device(self.queue, self.static_Gx_host, allocator=self.allocator)
+        self.static_Gy = cl.array.to_device(self.queue, self.static_Gy_host, allocator=self.allocator)
 
-        kernel_to_run = self.kernels.add_radial_g_force
-        arguments = [
-            self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_index), int_type(center_x), int_type(center_y),
-            num_type(prefactor), num_type(radial_scaling),
-            self.Gx.data, self.Gy.data,
-            self.rho.data,
-            self.nx, self.ny
-        ]
+    def add_constant_g_force(self, fluid_index, force_x, force_y):
+        self.add_static_force(fluid_index, force_x, force_y)
 
-        self.additional_forces.append([kernel_to_run, arguments])
+    def add_radial_g_force(self, fluid_index, center_x, center_y, prefactor, radial_scaling):
+        x, y = np.meshgrid(np.arange(self.nx), np.arange(self.ny), indexing='ij')
+        dx = x - int(center_x)
+        dy = y - int(center_y)
+        theta = np.arctan2(dy, dx)
+        with np.errstate(divide='ignore'):
+            magnitude = prefactor*np.sqrt(dx**2 + dy**2)**radial_scaling
+
+        self.add_static_force(fluid_index, magnitude*np.cos(theta), magnitude*np.sin(theta))
 
     ##### Dealing with Poisson Repulsion. ###########
-    def add_screened_poisson_force(self, source_index, force_index, interaction_length, amplitude):
+    def add_screened_poisson_force(self, source_index, force_index, interaction_length, amplitude,
+                                   resolve_interval=1, resolve_tolerance=None, extrapolate=False):
+        """
+        :param resolve_interval: Re-solve the screened poisson field at most every resolve_interval steps. None only
+            re-solves on resolve_tolerance.
+        :param resolve_tolerance: If not None, also re-solve as soon as the relative change of the source density
+            since the last solve exceeds it.
+        :param extrapolate: If True, linearly extrapolate the force from the last two solves in between.
+        """
 
         input_density = self.rho.get()[:, :, source_index]
         self.poisson_solver = sp.Screened_Poisson(input_density, cl_context=self.context, cl_queue = self.queue,
-                                                  lam=interaction_length, dx=1.0)
+                                                  lam=interaction_length, dx=1.0,
+                                                  two_d_local_size=self.two_d_local_size)
         self.poisson_solver.create_grad_fields()
+        self.poisson_schedule = schedule.Resolve_Schedule(self.poisson_solver, interval=resolve_interval,
+                                                          tolerance=resolve_tolerance, extrapolate=extrapolate)
 
         self.poisson_force_active = True
         self.poisson_source_index = int_type(source_index)
@@ -498,17 +633,12 @@ class Simulation_Runner(object):
         self.poisson_amp = amplitude
 
     def screened_poisson_kernel(self):
-        # Update the charge field for the poisson solver
-        density_view = self.rho[:, :, self.poisson_source_index]
-
-        cl.enqueue_copy(self.queue, self.poisson_solver.charge.data, density_view.astype(np.complex64).data)
-
-        self.poisson_solver.solve_and_update_grad_fields()
-        self.poisson_xgrad = self.poisson_amp * self.poisson_solver.xgrad.real
-        self.poisson_ygrad = self.poisson_amp * self.poisson_solver.ygrad.real
-
-        self.Gx[:, :, self.poisson_force_index] += self.poisson_xgrad
-        self.Gy[:, :, self.poisson_force_index] += self.poisson_ygrad
+        # Update the charge field for the poisson solver and add the scaled gradients onto the force
+        extrapolation = self.poisson_schedule.update(self.rho, self.step_count,
+                                                     field_index=self.poisson_source_index)
+        self.poisson_solver.unpack_grad_fields(self.Gx, self.Gy, scale=self.poisson_amp,
+                                               field_index=self.poisson_force_index, accumulate=True,
+                                               extrapolation=extrapolation)
     ############################################
 
     def add_interaction_force(self, fluid_1_index, fluid_2_index, G_int, bc='periodic', potential='linear',
@@ -536,12 +666,20 @@ class Simulation_Runner(object):
         psi_local_1 = cl.LocalMemory(num_size * buf_nx * buf_ny)
         psi_local_2 = cl.LocalMemory(num_size * buf_nx * buf_ny)
 
+        if potential_parameters is None:
+            potential_parameters = np.array([0.], dtype=num_type)
+        else:
+            potential_parameters = np.array(potential_parameters, dtype=num_type)
+
+        psi_slot_1 = self.get_psi_slot(fluid_1_index, potential, potential_parameters)
+        psi_slot_2 = self.get_psi_slot(fluid_2_index, potential, potential_parameters)
+
         kernel_to_run = self.kernels.add_interaction_force
         arguments = [
             self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_1_index), int_type(fluid_2_index), num_type(G_int),
+            int_type(fluid_1_index), int_type(fluid_2_index), psi_slot_1, psi_slot_2, num_type(G_int),
             psi_local_1, psi_local_2,
-            self.rho.data, self.Gx.data, self.Gy.data,
+            self.psi.data, self.Gx.data, self.Gy.data,
             cs, cx, cy, w,
             self.nx, self.ny,
             buf_nx, buf_ny, halo, num_jumpers
@@ -554,28 +692,11 @@ class Simulation_Runner(object):
         else:
             raise ValueError('Specified boundary condition does not exist')
 
-        if potential is 'linear':
-            arguments += [int_type(0)]
-        elif potential is 'shan_chen':
-            arguments += [int_type(1)]
-        elif potential is 'pow':
-            arguments += [int_type(2)]
-        elif potential is 'vdw':
-            arguments += [int_type(3)]
-        else:
-            raise ValueError('Specified pseudopotential does not exist.')
+        stencil = tuple(zip(w_arr.tolist(), cx_arr.tolist(), cy_arr.tolist()))
+        spec = ('interaction', int(fluid_1_index), int(fluid_2_index), float(G_int), bc, potential,
+                tuple(potential_parameters.tolist()), stencil)
 
-        if potential_parameters is None:
-            potential_parameters = np.array([0.], dtype=num_type)
-        else:
-            potential_parameters = np.array(potential_parameters, dtype=num_type)
-
-        parameters_const = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
-                                     hostbuf=potential_parameters)
-
-        arguments += [parameters_const]
-
-        self.additional_forces.append([kernel_to_run, arguments])
+        self.additional_forces.append([kernel_to_run, arguments, spec])
 
     def add_interaction_force_second_belt(self, fluid_1_index, fluid_2_index, G_int, bc='periodic', potential='linear',
                                           potential_parameters=None):
@@ -683,12 +804,20 @@ class Simulation_Runner(object):
         local_1 = cl.LocalMemory(num_size * cur_buf_nx * cur_buf_ny)
         local_2 = cl.LocalMemory(num_size * cur_buf_nx * cur_buf_ny)
 
+        if potential_parameters is None:
+            potential_parameters = np.array([0.], dtype=num_type)
+        else:
+            potential_parameters = np.array(potential_parameters, dtype=num_type)
+
+        psi_slot_1 = self.get_psi_slot(fluid_1_index, potential, potential_parameters)
+        psi_slot_2 = self.get_psi_slot(fluid_2_index, potential, potential_parameters)
+
         kernel_to_run = self.kernels.add_interaction_force_second_belt
         arguments = [
             self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_1_index), int_type(fluid_2_index), num_type(G_int),
+            int_type(fluid_1_index), int_type(fluid_2_index), psi_slot_1, psi_slot_2, num_type(G_int),
             local_1, local_2,
-            self.rho.data, self.Gx.data, self.Gy.data,
+            self.psi.data, self.Gx.data, self.Gy.data,
             self.cs,
             pi1_const, cx1_const, cy1_const, num_jumpers_1,
             pi2_const, cx2_const, cy2_const, num_jumpers_2,
@@ -703,28 +832,97 @@ class Simulation_Runner(object):
         else:
             raise ValueError('Specified boundary condition does not exist')
 
-        if potential is 'linear':
-            arguments += [int_type(0)]
-        elif potential is 'shan_chen':
-            arguments += [int_type(1)]
-        elif potential is 'pow':
-            arguments += [int_type(2)]
-        elif potential is 'vdw':
-            arguments += [int_type(3)]
-        else:
-            raise ValueError('Specified pseudopotential does not exist.')
+        stencil = tuple(zip(pi1.tolist() + pi2.tolist(), cx1.tolist() + cx2.tolist(), cy1.tolist() + cy2.tolist()))
+        spec = ('interaction', int(fluid_1_index), int(fluid_2_index), float(G_int), bc, potential,
+                tuple(potential_parameters.tolist()), stencil)
 
-        if potential_parameters is None:
-            potential_parameters = np.array([0.], dtype=num_type)
-        else:
-            potential_parameters = np.array(potential_parameters, dtype=num_type)
+        self.additional_forces.append([kernel_to_run, arguments, spec])
 
-        parameters_const = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
-                                     hostbuf=potential_parameters)
+    def get_psi_slot(self, fluid_index, potential, potential_parameters):
+        """
+        Returns the slot of psi holding the pseudopotential of a fluid, adding the slot if no interaction uses it yet.
+        Adding a slot reallocates psi, so the arguments of the registered forces are pointed at the new buffer.
 
-        arguments += [parameters_const]
+        :param fluid_index: The field index of the fluid
+        :param potential: One of 'linear', 'shan_chen', 'pow' or 'vdw'
+        :param potential_parameters: The parameters of the potential; at most NUM_PSI_PARAMETERS are used.
+        """
+        if potential not in PSI_SPECIFIERS:
+            raise ValueError('Specified pseudopotential does not exist.')
+        if len(potential_parameters) > NUM_PSI_PARAMETERS:
+            raise ValueError('At most ' + str(NUM_PSI_PARAMETERS) + ' pseudopotential parameters are supported.')
+
+        key = (int(fluid_index), potential, tuple(float(p) for p in potential_parameters))
+        if key in self.psi_slots:
+            return int_type(self.psi_slots.index(key))
+        self.psi_slots.append(key)
+        num_slots = len(self.psi_slots)
+
+        old_psi = self.psi
+        self.psi = cl.array.zeros(self.queue, (self.nx, self.ny, num_slots), dtype=num_type, order='F',
+                                  allocator=self.allocator)
+        if old_psi is not None:
+            for d in self.additional_forces:
+                d[1] = [self.psi.data if a is old_psi.data else a for a in d[1]]
+
+        slot_parameters = np.zeros((num_slots, NUM_PSI_PARAMETERS), dtype=num_type)
+        for slot, (fluid, cur_potential, parameters) in enumerate(self.psi_slots):
+            slot_parameters[slot, :len(parameters)] = parameters
+        self.psi_slot_fluids = self.get_field_table([fluid for fluid, _, _ in self.psi_slots])
+        self.psi_slot_specifiers = self.get_field_table([PSI_SPECIFIERS[p] for _, p, _ in self.psi_slots])
+        self.psi_slot_parameters = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                             hostbuf=slot_parameters)
+
+        return int_type(num_slots - 1)
+
+    def update_psi(self):
+        """Evaluates the pseudopotential of every psi slot with a single launch."""
+        self.kernels.update_psi(
+            self.queue, self.get_field_global_size(len(self.psi_slots)), self.three_d_local_size,
+            self.rho.data, self.psi.data,
+            self.psi_slot_fluids, self.psi_slot_specifiers, self.psi_slot_parameters,
+            int_type(NUM_PSI_PARAMETERS),
+            self.nx, self.ny).wait()
+
+    def init_forces(self):
+        """Starts the body force of a step: G = rho times the static forces, or zero if there are none."""
+        if self.static_Gx is None:
+            self.Gx[...] = 0
+            self.Gy[...] = 0
+        else:
+            self.kernels.apply_static_forces(
+                self.queue, self.get_field_global_size(self.num_populations), self.three_d_local_size,
+                self.rho.data, self.static_Gx.data, self.static_Gy.data,
+                self.Gx.data, self.Gy.data,
+                self.nx, self.ny).wait()
+
+    def update_fused_forces(self):
+        """
+        Evaluates every registered force with generated kernels that write Gx and Gy: one kernel, unless the tiles of
+        the forces exceed the local memory of the device. The kernels are regenerated only when the registered
+        forces change.
 
-        self.additional_forces.append([kernel_to_run, arguments])
+        :return: False if a single force does not fit into local memory, in which case nothing was evaluated.
+        """
+        force_specs = (tuple(d[2] for d in self.additional_forces), tuple(self.static_force_fluids))
+        if force_specs != self.fused_force_specs:
+            self.fused_force_kernels = force_compiler.get_fused_force_kernels(
+                self.context, force_specs[0], self.psi_slots, self.static_force_fluids, int(self.num_populations),
+                self.two_d_local_size, program_cache=self.fused_force_programs)
+            self.fused_force_specs = force_specs
+        if self.fused_force_kernels is None:
+            return False
+
+        # Unused buffers are replaced by rho, as kernel arguments cannot be empty
+        for kernel, local_tiles in self.fused_force_kernels:
+            kernel(self.queue, self.two_d_global_size, self.two_d_local_size,
+                   self.rho.data, self.psi.data if self.psi is not None else self.rho.data,
+                   self.static_Gx.data if self.static_Gx is not None else self.rho.data,
+                   self.static_Gy.data if self.static_Gy is not None else self.rho.data,
+                   self.Gx.data, self.Gy.data,
+                   local_tiles,
+                   self.nx, self.ny).wait()
+        return True
 
     def run(self, num_iterations, debug=False):
         """
@@ -739,32 +937,36 @@ class Simulation_Runner(object):
                 print 'At beginning of iteration:'
                 self.check_fields()
 
-            for cur_fluid in self.fluid_list:
-                cur_fluid.move() # Move all jumpers
+            self.move() # Move all jumpers
             if debug:
                 print 'After move'
                 self.check_fields()
 
-            for cur_fluid in self.fluid_list:
-                cur_fluid.move_bcs() # Must move before applying BC
+            self.move_bcs() # Must move before applying BC
             if debug:
                 print 'After move bcs'
                 self.check_fields()
 
             # Update forces here as appropriate
-            for cur_fluid in self.fluid_list:
-                cur_fluid.update_hydro() # Update the hydrodynamic variables
+            self.update_hydro() # Update the hydrodynamic variables
+            if self.check_max_ulb and self.diagnostics.sample():
+                self.check_mach()
             if debug:
                 print 'After updating hydro'
                 self.check_fields()
 
             # Reset the total body force and add to it as appropriate
-            self.Gx[...] = 0
-            self.Gy[...] = 0
-            for d in self.additional_forces:
-                kernel = d[0]
-                arguments = d[1]
-                kernel(*arguments).wait()
+            if len(self.psi_slots) > 0:
+                self.update_psi() # Shared by all interaction forces
+            fused = self.fuse_forces and all(len(d) > 2 for d in self.additional_forces)
+            if fused:
+                fused = self.update_fused_forces() # Overwrites Gx and Gy
+            if not fused:
+                self.init_forces()
+                for d in self.additional_forces:
+                    kernel = d[0]
+                    arguments = d[1]
+                    kernel(*arguments).wait()
             if self.poisson_force_active:
                 self.screened_poisson_kernel()
             if debug:
@@ -784,14 +986,12 @@ class Simulation_Runner(object):
                 print 'After updating bary-velocity'
                 self.check_fields()
 
-            for cur_fluid in self.fluid_list:
-                cur_fluid.update_feq() # Update the equilibrium fields
+            self.update_feq() # Update the equilibrium fields
             if debug:
                 print 'After updating feq'
                 self.check_fields()
 
-            for cur_fluid in self.fluid_list:
-                cur_fluid.collide_particles() # Relax the nonequilibrium fields.
+            self.collide_particles() # Relax the nonequilibrium fields.
             if debug:
                 print 'After colliding particles'
                 self.check_fields()
@@ -802,24 +1002,37 @@ class Simulation_Runner(object):
                 arguments = d[1]
                 kernel(*arguments).wait()
 
-    def check_fields(self):
-        # Start with rho
-        for i in range(self.num_populations):
-            print 'Field:', i
-            print 'rho_sum', cl.array.sum(self.rho[:, :, i])
-            print 'u, v bary sum', cl.array.sum(self.u_bary), cl.array.sum(self.u_bary)
-            print 'f_sum', np.sum(self.f.get()[:, :, i, :])
-            print 'f_eq_sum', np.sum(self.feq.get()[:, :, i, :])
+            self.step_count += 1
+            self.allocator.end_step()
+
+            self.update_recorders()
 
-        print 'Total rho_sum', cl.array.sum(self.rho)
-        print 'Total f_sum', np.sum(self.f.get())
-        print 'Total feq_sum', np.sum(self.feq.get())
+    def check_mach(self):
+        """
+        Warns if the maximum lattice velocity of any fluid exceeds mach_tolerance times the speed of sound. Uses the
+        results of the last diagnostics computation.
+        """
+        max_mach = self.diagnostics.get_max_mach(cs=self.cs)
+        for i in range(self.num_populations):
+            if max_mach[i] > self.mach_tolerance:
+                print 'max_ulb of field', i, 'exceeds the Mach tolerance! Ma=', max_mach[i]
 
-        print
+    def check_fields(self):
+        """
+        Prints the mass, momentum, maximum speed, density extrema and number of NaN/Inf nodes of every fluid. Only the
+        reduced values are transferred from the device.
+        """
+        self.diagnostics.compute()
+        self.diagnostics.report()
 
 
 class Simulation_RunnerD2Q25(Simulation_Runner):
+    """
+    Streams and collides with the kernels of d2q25.cl, which are specialised to the 25 velocities of this lattice.
+    The equilibrium is evaluated inside the collision, so the update_feq phase of a step does nothing.
+    """
     def __init__(self, **kwargs):
+        self.d2q25_kernels = None # Compiled by allocate_constants, once the velocities are known
         super(Simulation_RunnerD2Q25, self).__init__(**kwargs)
 
     def allocate_constants(self):
@@ -878,4 +1091,44 @@ class Simulation_RunnerD2Q25(Simulation_Runner):
 
         self.w = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=w)
         self.cx = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=cx)
-        self.cy = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=cy)
\ No newline at end of file
+        self.cy = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=cy)
+
+        # The specialised kernels bake the same velocities and weights in as constants
+        build_options = ['-DD2Q25_CX=' + ','.join(str(c) for c in cx_list),
+                         '-DD2Q25_CY=' + ','.join(str(c) for c in cy_list),
+                         '-DD2Q25_W=' + ','.join(repr(float(cur_w)) for cur_w in w_list)]
+        self.d2q25_kernels = cl.Program(self.context, open(file_dir + '/d2q25.cl').read()).build(options=build_options)
+
+    def move_fields(self, bc, field_table, num_fields):
+        """Streams the listed fields into f_streamed; see copy_streamed_fields."""
+        if bc == 'periodic':
+            periodic = int_type(1)
+        elif bc == 'zero_gradient':
+            periodic = int_type(0)
+        else:
+            raise ValueError('unknown bc...')
+
+        self.d2q25_kernels.move_d2q25(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f.data, self.f_streamed.data,
+            self.nx, self.ny,
+            field_table, self.num_populations, periodic
+        ).wait()
+
+    def collide_fields(self, field_table, num_fields):
+        """Updates feq and collides the listed fields in one pass."""
+        self.d2q25_kernels.collide_d2q25(
+            self.queue, self.get_field_global_size(num_fields), self.three_d_local_size,
+            self.f.data,
+            self.feq.data,
+            self.rho.data,
+            self.u_bary.data, self.v_bary.data,
+            self.Gx.data, self.Gy.data,
+            self.omega_table,
+            self.nx, self.ny,
+            field_table, self.num_populations,
+            self.cs
+        ).wait()
+
+    def update_feq(self):
+        pass # Evaluated by collide_fields, right where the collision needs it
@@ -0,0 +1,149 @@
+"""
+Host-side preprocessing of obstacle masks for any runner.
+
+A solid mask is an (nx, ny) boolean array that is True on obstacle nodes. get_fluid_node_tables numbers the fluid
+nodes and builds, for every fluid node and direction, the index of the fluid node its population streams from, so
+that a runner can store and update the fluid nodes only. Directions whose source is solid are the fluid-solid
+boundary links; a runner handles them with bounceback. Runners that store every node use get_bounceback_pairs instead,
+so that bounceback only visits the links on the surface of the obstacles rather than every solid node. Everything
+here is computed once per geometry.
+"""
+
+import numpy as np
+
+# The D2Q9 lattice used by the runners
+D2Q9_CX = np.array([0, 1, 0, -1, 0, 1, -1, -1, 1], dtype=np.int32)
+D2Q9_CY = np.array([0, 0, 1, 0, -1, 1, 1, -1, -1], dtype=np.int32)
+
+
+def get_opposite(cx, cy):
+    """
+    :return: An int32 array whose i'th entry is the direction opposite to direction i.
+    """
+    opposite = []
+    for cur_cx, cur_cy in zip(cx, cy):
+        matches = np.where((cx == -cur_cx) & (cy == -cur_cy))[0]
+        if len(matches) != 1:
+            raise ValueError('The lattice has no unique direction opposite to (' + str(cur_cx) + ', ' +
+                             str(cur_cy) + ').')
+        opposite.append(matches[0])
+    return np.array(opposite, dtype=np.int32)
+
+
+def shift_field(field, cur_cx, cur_cy, periodic=(False, False), fill=0):
+    """
+    Returns the field seen from the source of a population moving in direction (cur_cx, cur_cy), i.e.
+    result[x, y] = field[x - cur_cx, y - cur_cy]. Sources outside of a non-periodic axis are set to fill.
+
+    :param field: An (nx, ny) array
+    :param periodic: A tuple (periodic in x, periodic in y)
+    """
+    result = np.roll(np.roll(field, cur_cx, axis=0), cur_cy, axis=1)
+    if not periodic[0]:
+        if cur_cx > 0:
+            result[:cur_cx, :] = fill
+        elif cur_cx < 0:
+            result[cur_cx:, :] = fill
+    if not periodic[1]:
+        if cur_cy > 0:
+            result[:, :cur_cy] = fill
+        elif cur_cy < 0:
+            result[:, cur_cy:] = fill
+    return result
+
+
+def get_fluid_node_tables(solid_mask, cx=D2Q9_CX, cy=D2Q9_CY, periodic=(False, False)):
+    """
+    Builds the indirect addressing tables of a geometry.
+
+    :param solid_mask: An (nx, ny) array that is nonzero on solid nodes
+    :param cx: The x velocities of the lattice
+    :param cy: The y velocities of the lattice
+    :param periodic: A tuple (periodic in x, periodic in y). Sources outside of a non-periodic axis count as solid.
+    :return: A tuple (fluid_nodes, neighbours).
+        fluid_nodes holds the linear index y*nx + x of every fluid node, in increasing order, so that neighbouring
+        nodes stay close in memory.
+        neighbours is a (num_jumpers, num_fluid) int32 array. neighbours[i, n] is the fluid node that the
+        population moving in direction i streams from into fluid node n. It is -1 if that source is solid; such
+        (i, n) pairs are the boundary links.
+    """
+    solid_mask = np.asarray(solid_mask) != 0
+    nx, ny = solid_mask.shape
+
+    fluid_nodes = np.flatnonzero(~solid_mask.ravel(order='F')).astype(np.int32)
+    num_fluid = fluid_nodes.shape[0]
+    if num_fluid == 0:
+        raise ValueError('The geometry has no fluid nodes.')
+
+    node_index_flat = -np.ones(nx * ny, dtype=np.int32)
+    node_index_flat[fluid_nodes] = np.arange(num_fluid, dtype=np.int32)
+    node_index = node_index_flat.reshape((nx, ny), order='F')
+
+    neighbours = np.empty((len(cx), num_fluid), dtype=np.int32)
+    for i, (cur_cx, cur_cy) in enumerate(zip(cx, cy)):
+        source_index = shift_field(node_index, int(cur_cx), int(cur_cy), periodic=periodic, fill=-1)
+        neighbours[i, :] = source_index.ravel(order='F')[fluid_nodes]
+
+    return fluid_nodes, neighbours
+
+
+def get_link_list(neighbours):
+    """
+    :param neighbours: The neighbour table of get_fluid_node_tables
+    :return: A tuple (nodes, directions) of int32 arrays with one entry per boundary link: the population moving in
+        directions[k] into fluid node nodes[k] comes from a solid.
+    """
+    directions, nodes = np.nonzero(neighbours < 0)
+    return nodes.astype(np.int32), directions.astype(np.int32)
+
+
+def get_boundary_links(solid_mask, cx=D2Q9_CX, cy=D2Q9_CY, periodic=(False, False)):
+    """
+    Finds the fluid-solid boundary links of a runner that stores every node and bounces back on the solid ones: every
+    solid node (x, y) and direction i such that the population moving in direction i arrives at the solid node from
+    a fluid node. Solid nodes deep inside an obstacle have no links.
+
+    :param solid_mask: An (nx, ny) array that is nonzero on solid nodes
+    :param periodic: A tuple (periodic in x, periodic in y). Sources outside of a non-periodic axis are not fluid.
+    :return: A tuple (x, y, directions) of int32 arrays with one entry per link
+    """
+    solid_mask = np.asarray(solid_mask) != 0
+
+    x_list = []
+    y_list = []
+    direction_list = []
+    for i, (cur_cx, cur_cy) in enumerate(zip(cx, cy)):
+        source_is_fluid = shift_field(~solid_mask, int(cur_cx), int(cur_cy), periodic=periodic, fill=False)
+        x, y = np.nonzero(solid_mask & source_is_fluid)
+        x_list.append(x)
+        y_list.append(y)
+        direction_list.append(i * np.ones(x.shape[0], dtype=np.int32))
+
+    return (np.concatenate(x_list).astype(np.int32), np.concatenate(y_list).astype(np.int32),
+            np.concatenate(direction_list).astype(np.int32))
+
+
+def get_bounceback_pairs(solid_mask, cx=D2Q9_CX, cy=D2Q9_CY, periodic=(False, False)):
+    """
+    Reduces the boundary links of get_boundary_links to the population swaps of full-way bounceback: one entry per
+    solid node and pair of opposite directions of which at least one is a link. Swapping every entry once gives the
+    same populations, on every link, as swapping all populations on every solid node, and no two entries touch the
+    same population, so the swaps can run in parallel.
+
+    :return: A tuple (x, y, directions, opposites) of int32 arrays with one entry per swap; directions[k] is smaller
+        than opposites[k].
+    """
+    solid_mask = np.asarray(solid_mask) != 0
+    nx = solid_mask.shape[0]
+    opposite = get_opposite(cx, cy)
+    num_jumpers = len(cx)
+
+    x, y, directions = get_boundary_links(solid_mask, cx, cy, periodic=periodic)
+    canonical = np.minimum(directions, opposite[directions])
+
+    keys = np.unique((y.astype(np.int64) * nx + x) * num_jumpers + canonical)
+    nodes = keys // num_jumpers
+    directions = (keys % num_jumpers).astype(np.int32)
+
+    return ((nodes % nx).astype(np.int32), (nodes // nx).astype(np.int32), directions,
+            opposite[directions].astype(np.int32))
@@ -0,0 +1,48 @@
+"""
+Compares the LB relaxation of Poisson_Solver against method='multigrid' on a point-like source at increasing
+resolution. The LB iteration count grows like N^2 while the number of multigrid cycles should stay roughly constant.
+
+Run with python -m LB_D2Q9.poisson.benchmark_multigrid
+"""
+
+import time
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+from LB_D2Q9.poisson.solver import Poisson_Solver
+
+
+def make_sources(queue, n):
+    """A Gaussian blob of charge in the middle of an n x n domain of unit length."""
+    x, y = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n), indexing='ij')
+    sources = np.exp(-((x - .5)**2 + (y - .5)**2)/(2*.05**2))
+    return cl.array.to_device(queue, np.asfortranarray(sources, dtype=np.float32))
+
+
+def time_solver(n, method, max_iterations, context, queue, **kwargs):
+    delta_x = 1./n
+    delta_t = delta_x**2
+    solver = Poisson_Solver(nx=n, ny=n, sources=make_sources(queue, n), delta_t=delta_t, delta_x=delta_x,
+                            rho_on_boundary=1.0, tolerance=10.**-6., context=context, queue=queue,
+                            method=method, **kwargs)
+    start = time.time()
+    solver.run(max_iterations)
+    queue.finish()
+    elapsed = time.time() - start
+    return solver, elapsed
+
+
+if __name__ == '__main__':
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+
+    print 'N', 'method', 'iterations', 'seconds', 'max |rho_lb - rho_mg|'
+    for n in [33, 65, 129, 257]:
+        lb, lb_time = time_solver(n, 'lb', 100*n**2, context, queue)
+        mg, mg_time = time_solver(n, 'multigrid', 100, context, queue)
+        mg_np, mg_np_time = time_solver(n, 'multigrid', 100, context, queue, multigrid_backend='numpy')
+
+        difference = np.max(np.abs(lb.rho.get() - mg.rho.get()))
+        print n, 'lb', lb.num_iterations, lb_time
+        print n, 'multigrid (opencl)', mg.num_iterations, mg_time, difference
+        print n, 'multigrid (numpy)', mg_np.num_iterations, mg_np_time
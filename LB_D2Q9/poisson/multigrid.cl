@@ -0,0 +1,89 @@
+// Geometric multigrid for the 2D Poisson equation lap(u) = -f with Dirichlet boundaries on the outermost nodes.
+// Every level is an (nx, ny) grid stored as index = y*nx + x; coarse node (I, J) sits on fine node (2I, 2J).
+// Boundary nodes are never written by the smoother, so they keep their Dirichlet value.
+
+__kernel void
+smooth_red_black(__global float *u,
+                 __global __read_only float *f,
+                 const float h2,
+                 const int color,
+                 const int nx, const int ny)
+{
+    // One half sweep of red-black Gauss-Seidel: updates the interior nodes with (x + y) % 2 == color.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x > 0) && (x < nx - 1) && (y > 0) && (y < ny - 1) && (((x + y) & 1) == color)){
+        const int two_d_index = y*nx + x;
+        const float neighbors = u[two_d_index - 1] + u[two_d_index + 1] + u[two_d_index - nx] + u[two_d_index + nx];
+        u[two_d_index] = 0.25f*(neighbors + h2*f[two_d_index]);
+    }
+}
+
+__kernel void
+get_residual(__global __read_only float *u,
+             __global __read_only float *f,
+             __global __write_only float *r,
+             const float inv_h2,
+             const int nx, const int ny)
+{
+    // r = f + lap(u) in the interior, 0 on the boundary
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        if ((x > 0) && (x < nx - 1) && (y > 0) && (y < ny - 1)){
+            const float neighbors = u[two_d_index - 1] + u[two_d_index + 1] + u[two_d_index - nx] + u[two_d_index + nx];
+            r[two_d_index] = f[two_d_index] + inv_h2*(neighbors - 4.0f*u[two_d_index]);
+        }
+        else r[two_d_index] = 0;
+    }
+}
+
+__kernel void
+restrict_full_weighting(__global __read_only float *r_fine,
+                        __global __write_only float *f_coarse,
+                        const int nx_fine, const int ny_fine,
+                        const int nx_coarse, const int ny_coarse)
+{
+    // Full weighting restriction of the fine residual onto the coarse right hand side.
+    const int X = get_global_id(0);
+    const int Y = get_global_id(1);
+
+    if ((X < nx_coarse) && (Y < ny_coarse)){
+        const int coarse_index = Y*nx_coarse + X;
+        if ((X > 0) && (X < nx_coarse - 1) && (Y > 0) && (Y < ny_coarse - 1)){
+            const int i = (2*Y)*nx_fine + 2*X;
+            const float center = r_fine[i];
+            const float edges = r_fine[i - 1] + r_fine[i + 1] + r_fine[i - nx_fine] + r_fine[i + nx_fine];
+            const float corners = r_fine[i - nx_fine - 1] + r_fine[i - nx_fine + 1] +
+                                  r_fine[i + nx_fine - 1] + r_fine[i + nx_fine + 1];
+            f_coarse[coarse_index] = 0.25f*center + 0.125f*edges + 0.0625f*corners;
+        }
+        else f_coarse[coarse_index] = 0;
+    }
+}
+
+__kernel void
+prolong_and_correct(__global float *u_fine,
+                    __global __read_only float *e_coarse,
+                    const int nx_fine, const int ny_fine,
+                    const int nx_coarse, const int ny_coarse)
+{
+    // Bilinear interpolation of the coarse correction, added onto the interior of the fine solution.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x > 0) && (x < nx_fine - 1) && (y > 0) && (y < ny_fine - 1)){
+        const int X0 = x/2;
+        const int Y0 = y/2;
+        const int X1 = min(X0 + (x & 1), nx_coarse - 1);
+        const int Y1 = min(Y0 + (y & 1), ny_coarse - 1);
+
+        const float e = 0.25f*(e_coarse[Y0*nx_coarse + X0] + e_coarse[Y0*nx_coarse + X1] +
+                               e_coarse[Y1*nx_coarse + X0] + e_coarse[Y1*nx_coarse + X1]);
+
+        u_fine[y*nx_fine + x] += e;
+    }
+}
@@ -0,0 +1,277 @@
+import numpy as np
+import os
+import pyopencl as cl
+import pyopencl.array
+import pyopencl.reduction
+
+# Get path to *this* file. Necessary when reading in opencl code.
+full_path = os.path.realpath(__file__)
+file_dir = os.path.dirname(full_path)
+
+
+# The magnitude of the terms of the residual f + (neighbours - 4u) at interior node i of the finest level (h = 1)
+TERM_MAGNITUDE_PREAMBLE = """
+float get_term_magnitude(__global float *u, __global float *f, const int i, const int nx, const int ny)
+{
+    const int x = i % nx;
+    const int y = i / nx;
+    if ((x == 0) || (x == nx - 1) || (y == 0) || (y == ny - 1)) return 0;
+    const float neighbors = u[i - 1] + u[i + 1] + u[i - nx] + u[i + nx];
+    return fabs(f[i]) + fabs(neighbors) + 4.0f*fabs(u[i]);
+}
+"""
+
+
+def get_divisible_global(global_size, local_size):
+    """
+    Given a desired global size and a specified local size, return the smallest global
+    size that the local size fits into. Required when specifying arbitrary local
+    workgroup sizes.
+
+    :param global_size: A tuple of the global size, i.e. (x, y, z)
+    :param local_size:  A tuple of the local size, i.e. (lx, ly, lz)
+    :return: The smallest global size that the local size fits into.
+    """
+    new_size = []
+    for cur_global, cur_local in zip(global_size, local_size):
+        remainder = cur_global % cur_local
+        if remainder == 0:
+            new_size.append(cur_global)
+        else:
+            new_size.append(cur_global + cur_local - remainder)
+    return tuple(new_size)
+
+
+def get_coarse_size(n):
+    """
+    Coarse node I sits on fine node 2I and the outermost nodes of every level are Dirichlet boundaries, so the last
+    coarse node only lands on the last fine node n - 1 when n is odd. Sizes of the form 2**k + 1 coarsen all the way
+    down; other odd sizes coarsen until a level has an even number of nodes.
+
+    :param n: The number of nodes of the fine level, including both boundary nodes.
+    :return: The number of nodes of the coarse level.
+    """
+    if n % 2 == 0:
+        raise ValueError('A level with ' + str(n) + ' nodes cannot be coarsened: multigrid needs an odd number of '
+                         'nodes, ideally 2**k + 1.')
+    return (n + 1) // 2
+
+
+class Multigrid_Poisson(object):
+    """
+    Geometric multigrid solver for lap(u) = -f on an (nx, ny) lattice with unit spacing, where the outermost nodes
+    of u hold fixed (Dirichlet) values. Uses red-black Gauss-Seidel smoothing, full weighting restriction and bilinear
+    prolongation, in either V (gamma=1) or W (gamma=2) cycles. The smoothers run in OpenCL; a NumPy implementation of
+    the same cycle is used with backend='numpy'.
+    """
+
+    def __init__(self, nx, ny, context=None, queue=None, backend='opencl', cycle='V',
+                 num_pre_smooth=2, num_post_smooth=2, num_coarse_smooth=50, min_size=5,
+                 two_d_local_size=(16, 16)):
+        """
+        :param nx: Number of nodes in x, including the boundary nodes.
+        :param ny: Number of nodes in y, including the boundary nodes.
+        :param context: The OpenCL context; required for backend='opencl'.
+        :param queue: The OpenCL queue; required for backend='opencl'.
+        :param backend: 'opencl' or 'numpy'
+        :param cycle: 'V' or 'W'
+        :param num_pre_smooth: Red-black sweeps before restricting to the coarser level.
+        :param num_post_smooth: Red-black sweeps after correcting from the coarser level.
+        :param num_coarse_smooth: Red-black sweeps used to solve on the coarsest level.
+        :param min_size: Coarsening stops once either dimension would drop below min_size nodes, or once either
+            dimension has an even number of nodes. nx and ny must be odd; 2**k + 1 gives the most levels.
+        :param two_d_local_size: The local size of the OpenCL kernels.
+        """
+        if backend not in ('opencl', 'numpy'):
+            raise ValueError('Unknown multigrid backend ' + str(backend) + '. Choose opencl or numpy.')
+        if cycle not in ('V', 'W'):
+            raise ValueError('Unknown multigrid cycle ' + str(cycle) + '. Choose V or W.')
+
+        self.backend = backend
+        self.gamma = 1 if cycle == 'V' else 2
+        self.num_pre_smooth = num_pre_smooth
+        self.num_post_smooth = num_post_smooth
+        self.num_coarse_smooth = num_coarse_smooth
+
+        if (int(nx) % 2 == 0) or (int(ny) % 2 == 0):
+            raise ValueError('Multigrid needs an odd number of nodes in each direction (ideally 2**k + 1) so that '
+                             'the boundaries of every level coincide; got (' + str(nx) + ', ' + str(ny) + ').')
+
+        self.sizes = [(int(nx), int(ny))]
+        while (self.sizes[-1][0] % 2 == 1) and (self.sizes[-1][1] % 2 == 1) and \
+                min(get_coarse_size(self.sizes[-1][0]), get_coarse_size(self.sizes[-1][1])) >= min_size:
+            cur_nx, cur_ny = self.sizes[-1]
+            self.sizes.append((get_coarse_size(cur_nx), get_coarse_size(cur_ny)))
+        self.num_levels = len(self.sizes)
+
+        # The spacing of level l is 2**l lattice units
+        self.h2 = [np.float32(4.**l) for l in range(self.num_levels)]
+
+        # u and f of the finest level are passed in to cycle(); the coarser levels hold corrections.
+        self.u = [None]*self.num_levels
+        self.f = [None]*self.num_levels
+        self.r = [None]*self.num_levels
+
+        self.context = context
+        self.queue = queue
+        self.kernels = None
+        self.two_d_local_size = two_d_local_size
+        self.global_sizes = [get_divisible_global(size, two_d_local_size) for size in self.sizes]
+
+        self.residual_norm_kernel = None
+
+        if self.backend == 'opencl':
+            self.kernels = cl.Program(self.context, open(file_dir + '/multigrid.cl').read()).build(options='')
+            # Returns both sum(|r|) and the sum of the magnitudes of the terms of r in one pass
+            self.residual_norm_kernel = cl.reduction.ReductionKernel(self.context, cl.array.vec.float2,
+                                                                     neutral="(float2)(0, 0)",
+                                                                     reduce_expr="a+b",
+                                                                     map_expr="(float2)(fabs(r[i]), "
+                                                                              "get_term_magnitude(u, f, i, nx, ny))",
+                                                                     arguments="__global float *r, \
+                                                                                __global float *u, \
+                                                                                __global float *f, \
+                                                                                int nx, int ny",
+                                                                     preamble=TERM_MAGNITUDE_PREAMBLE)
+            for l, (cur_nx, cur_ny) in enumerate(self.sizes):
+                self.r[l] = cl.array.zeros(self.queue, (cur_nx, cur_ny), dtype=np.float32, order='F')
+                if l > 0:
+                    self.u[l] = cl.array.zeros(self.queue, (cur_nx, cur_ny), dtype=np.float32, order='F')
+                    self.f[l] = cl.array.zeros(self.queue, (cur_nx, cur_ny), dtype=np.float32, order='F')
+        else:
+            for l, (cur_nx, cur_ny) in enumerate(self.sizes):
+                self.r[l] = np.zeros((cur_nx, cur_ny), dtype=np.float32, order='F')
+                if l > 0:
+                    self.u[l] = np.zeros((cur_nx, cur_ny), dtype=np.float32, order='F')
+                    self.f[l] = np.zeros((cur_nx, cur_ny), dtype=np.float32, order='F')
+
+            # Red-black masks of the interior of every level
+            self.colors = []
+            for cur_nx, cur_ny in self.sizes:
+                x, y = np.meshgrid(np.arange(1, cur_nx - 1), np.arange(1, cur_ny - 1), indexing='ij')
+                self.colors.append([((x + y) % 2) == 0, ((x + y) % 2) == 1])
+
+    def cycle(self, u, f):
+        """
+        Performs one multigrid cycle in place on u.
+
+        :param u: The current solution of the finest level: a cl.array for the opencl backend, a numpy array for the
+            numpy backend. Its outermost nodes are the boundary values and are not modified.
+        :param f: The right hand side, of the same type and shape as u.
+        """
+        self.u[0] = u
+        self.f[0] = f
+        self.run_level(0)
+
+    def get_relative_residual(self, u, f):
+        """
+        Measures the residual relative to the size of the terms it is computed from, |f| + |sum of neighbours| +
+        4|u| at every interior node of the finest level. Measured against sum(|f|) alone, the float32 round-off of
+        lap(u) sets a floor that grows with |u| (and so with the grid size) and can lie above any sensible tolerance;
+        measured this way, round-off alone gives a value of order machine epsilon.
+
+        :return: sum(|f + lap(u)|) / sum(|f| + |neighbours| + 4|u|) over the interior of the finest level.
+        """
+        self.u[0] = u
+        self.f[0] = f
+        r = self.get_residual(0)
+        nx, ny = self.sizes[0]
+        if self.backend == 'opencl':
+            result = self.residual_norm_kernel(r, u, f, np.int32(nx), np.int32(ny)).get()
+            residual_norm, term_norm = result['x'], result['y']
+        else:
+            neighbors = np.abs(u[:-2, 1:-1] + u[2:, 1:-1] + u[1:-1, :-2] + u[1:-1, 2:])
+            residual_norm = np.sum(np.abs(r))
+            term_norm = np.sum(np.abs(f[1:-1, 1:-1]) + neighbors + 4*np.abs(u[1:-1, 1:-1]))
+        return residual_norm / max(term_norm, np.finfo(np.float32).tiny)
+
+    def run_level(self, l):
+        if l == self.num_levels - 1:
+            self.smooth(l, self.num_coarse_smooth)
+            return
+
+        self.smooth(l, self.num_pre_smooth)
+        self.restrict_residual(l)
+        self.zero(self.u[l + 1])
+        for i in range(self.gamma):
+            self.run_level(l + 1)
+        self.prolong_and_correct(l)
+        self.smooth(l, self.num_post_smooth)
+
+    def zero(self, a):
+        if self.backend == 'opencl':
+            a.fill(0)
+        else:
+            a[...] = 0
+
+    def smooth(self, l, num_sweeps):
+        """num_sweeps red-black Gauss-Seidel sweeps on level l."""
+        u, f, h2 = self.u[l], self.f[l], self.h2[l]
+        nx, ny = self.sizes[l]
+        for sweep in range(num_sweeps):
+            for color in (0, 1):
+                if self.backend == 'opencl':
+                    # Launches are not waited on; the in-order queue keeps the sweeps in sequence.
+                    self.kernels.smooth_red_black(self.queue, self.global_sizes[l], self.two_d_local_size,
+                                                  u.data, f.data, h2, np.int32(color),
+                                                  np.int32(nx), np.int32(ny))
+                else:
+                    mask = self.colors[l][color]
+                    neighbors = u[:-2, 1:-1] + u[2:, 1:-1] + u[1:-1, :-2] + u[1:-1, 2:]
+                    interior = u[1:-1, 1:-1]
+                    interior[mask] = (0.25*(neighbors + h2*f[1:-1, 1:-1]))[mask]
+
+    def get_residual(self, l):
+        """Stores f + lap(u) of level l in r[l]."""
+        u, f, r = self.u[l], self.f[l], self.r[l]
+        nx, ny = self.sizes[l]
+        inv_h2 = np.float32(1./self.h2[l])
+        if self.backend == 'opencl':
+            self.kernels.get_residual(self.queue, self.global_sizes[l], self.two_d_local_size,
+                                      u.data, f.data, r.data, inv_h2,
+                                      np.int32(nx), np.int32(ny))
+        else:
+            r[...] = 0
+            neighbors = u[:-2, 1:-1] + u[2:, 1:-1] + u[1:-1, :-2] + u[1:-1, 2:]
+            r[1:-1, 1:-1] = f[1:-1, 1:-1] + inv_h2*(neighbors - 4*u[1:-1, 1:-1])
+        return r
+
+    def restrict_residual(self, l):
+        """Restricts the residual of level l onto the right hand side of level l + 1."""
+        r = self.get_residual(l)
+        f_coarse = self.f[l + 1]
+        nx, ny = self.sizes[l]
+        nx_c, ny_c = self.sizes[l + 1]
+        if self.backend == 'opencl':
+            self.kernels.restrict_full_weighting(self.queue, self.global_sizes[l + 1], self.two_d_local_size,
+                                                 r.data, f_coarse.data,
+                                                 np.int32(nx), np.int32(ny), np.int32(nx_c), np.int32(ny_c))
+        else:
+            xc = slice(2, 2*(nx_c - 1), 2)
+            yc = slice(2, 2*(ny_c - 1), 2)
+            xm = slice(1, 2*(nx_c - 1) - 1, 2)
+            ym = slice(1, 2*(ny_c - 1) - 1, 2)
+            xp = slice(3, 2*(nx_c - 1) + 1, 2)
+            yp = slice(3, 2*(ny_c - 1) + 1, 2)
+
+            f_coarse[...] = 0
+            f_coarse[1:-1, 1:-1] = (0.25*r[xc, yc] +
+                                    0.125*(r[xm, yc] + r[xp, yc] + r[xc, ym] + r[xc, yp]) +
+                                    0.0625*(r[xm, ym] + r[xp, ym] + r[xm, yp] + r[xp, yp]))
+
+    def prolong_and_correct(self, l):
+        """Interpolates the correction of level l + 1 and adds it to the interior of level l."""
+        u, e = self.u[l], self.u[l + 1]
+        nx, ny = self.sizes[l]
+        nx_c, ny_c = self.sizes[l + 1]
+        if self.backend == 'opencl':
+            self.kernels.prolong_and_correct(self.queue, self.global_sizes[l], self.two_d_local_size,
+                                             u.data, e.data,
+                                             np.int32(nx), np.int32(ny), np.int32(nx_c), np.int32(ny_c))
+        else:
+            e_fine = np.zeros((nx, ny), dtype=np.float32, order='F')
+            e_fine[0:2*nx_c - 1:2, 0:2*ny_c - 1:2] = e
+            e_fine[1:2*nx_c - 2:2, 0:2*ny_c - 1:2] = 0.5*(e[:-1, :] + e[1:, :])
+            e_fine[0:2*nx_c - 1:2, 1:2*ny_c - 2:2] = 0.5*(e[:, :-1] + e[:, 1:])
+            e_fine[1:2*nx_c - 2:2, 1:2*ny_c - 2:2] = 0.25*(e[:-1, :-1] + e[1:, :-1] + e[:-1, 1:] + e[1:, 1:])
+            u[1:-1, 1:-1] += e_fine[1:-1, 1:-1]
@@ -4,8 +4,11 @@ os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 import pyopencl as cl
 import pyopencl.tools
 import pyopencl.reduction
+import pyopencl.elementwise
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9.poisson import multigrid
 
 # Required to draw obstacles
 import skimage as ski
@@ -53,15 +56,30 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Poisson_Solver(object):
+def get_relative_change(total_change, total):
+    """
+    :param total_change: The sum of |rho - rho_before|
+    :param total: The sum of rho_before
+    :return: total_change relative to |total|; infinite if rho_before was zero but rho changed, zero if neither.
+    """
+    total = abs(float(total))
+    if total == 0:
+        return np.inf if total_change > 0 else 0.
+    return float(total_change) / total
+
+class Poisson_Solver(checkpoint.Checkpointable):
     """
     Simulates pipe flow using the D2Q9 lattice. Generally used to verify that our simulations were working correctly.
     For usage, see the docs folder.
     """
 
+    checkpoint_step_attribute = 'num_iterations'
+
     def __init__(self, nx=None, ny=None, sources=None, delta_t=None, delta_x=None, rho_on_boundary = 0.0,
                  tolerance = 10.**-6., context = None, queue = None,
-                 two_d_local_size=(32,32), three_d_local_size=(32,32,1), use_interop=False):
+                 two_d_local_size=(32,32), three_d_local_size=(32,32,1), use_interop=False,
+                 check_interval=10, max_check_interval=1000,
+                 method='lb', multigrid_cycle='V', multigrid_backend='opencl', incremental=False):
 
         self.nx = np.int32(nx)
         self.ny = np.int32(ny)
@@ -75,6 +93,26 @@ class Poisson_Solver(object):
         self.rho_on_boundary = np.float32(rho_on_boundary)
         self.tolerance = np.float32(tolerance)
 
+        # Convergence is only checked every check_interval iterations; the interval adapts to the convergence rate.
+        self.initial_check_interval = int(check_interval)
+        self.max_check_interval = int(max_check_interval)
+        self.check_interval = None
+        self.next_check = None
+        self.last_check = None # (iteration, relative change) of the previous check
+
+        # 'lb' relaxes the LB diffusion scheme to steady state; 'multigrid' solves the same discrete problem directly
+        if method not in ('lb', 'multigrid'):
+            raise ValueError('Unknown method ' + str(method) + '. Choose lb or multigrid.')
+        self.method = method
+        self.multigrid = None
+        self.multigrid_rhs = None
+
+        # In incremental mode, update_source warm-starts from an extrapolation of the last two solutions
+        self.incremental = incremental
+        self.rho_history = [] # The last (up to) two solutions, newest first
+        self.extrapolate_kernel = None
+        self.num_iterations = 0 # Iterations since the last update_source
+
         # Initialize the lattice to simulate on; see http://wiki.palabos.org/_media/howtos:lbunits.pdf
         self.delta_x = np.float32(delta_x) # How many squares characteristic length is broken into
         self.delta_t = np.float32(delta_t) # How many time iterations until the characteristic time, should be ~ \delta x^2
@@ -103,11 +141,13 @@ class Poisson_Solver(object):
         self.context = context  # The pyOpenCL context...may pass one in to share buffers
         self.queue = queue       # The queue used to issue commands to the desired device
         self.kernels = None     # Compiled OpenCL kernels
-        self.reduction_kernel = None
-        self.sum_kernel = None
+        self.convergence_kernel = None
         self.init_opencl()      # Initializes all items required to run OpenCL code
 
         # Allocate constants & local memory for opencl
+        # Device fields saved by save_checkpoint, together with the warm start history; see get_checkpoint_fields
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'rho_before', 'multigrid_rhs']
+
         self.w = None
         self.cx = None
         self.cy = None
@@ -138,7 +178,12 @@ class Poisson_Solver(object):
 
         self.init_pop() # Based on feq, create the hopping non-equilibrium fields
 
-        self.num_iterations = 0
+        if self.method == 'multigrid':
+            self.multigrid = multigrid.Multigrid_Poisson(self.nx, self.ny, context=self.context, queue=self.queue,
+                                                         backend=multigrid_backend, cycle=multigrid_cycle,
+                                                         two_d_local_size=self.two_d_local_size)
+            self.set_rho_on_boundary()
+            self.update_multigrid_rhs()
 
     def set_D_and_omega(self):
         self.lb_D = self.delta_t / self.delta_x ** 2 # Should equal about one
@@ -150,7 +195,13 @@ class Poisson_Solver(object):
         assert self.omega < 2.
 
     def update_source(self, new_source):
-        """Pass in a new source. Restarts the simulation with the old density."""
+        """
+        Pass in a new source. Restarts the simulation with the old density or, in incremental mode, with a linear
+        extrapolation of the last two solutions.
+        """
+
+        if self.incremental and self.num_iterations > 0:
+            self.warm_start()
 
         self.input_sources = new_source
 
@@ -160,6 +211,52 @@ class Poisson_Solver(object):
             self.scaled_sources.finish()
         self.num_iterations = 0  # Restart the simulation, basically, but keep the last guess of rho.
 
+        self.check_interval = self.initial_check_interval
+        self.next_check = self.check_interval
+        self.last_check = None
+
+        if self.multigrid is not None:
+            self.update_multigrid_rhs()
+
+    def warm_start(self):
+        """
+        Stores the current solution and replaces rho by 2*rho_n - rho_(n-1), the linear extrapolation of the last two
+        solutions. Only the correction from this guess then has to be solved for, which is small if the source
+        changed little.
+        """
+        if len(self.rho_history) < 2:
+            self.rho_history.insert(0, self.rho.copy())
+        else:
+            oldest = self.rho_history.pop()
+            cl.enqueue_copy(self.queue, oldest.data, self.rho.data)
+            self.rho_history.insert(0, oldest)
+
+        if len(self.rho_history) == 2:
+            self.extrapolate_kernel(self.rho, self.rho_history[0], self.rho_history[1])
+
+        if self.method == 'lb':
+            # Restart the populations from equilibrium with the new guess, or update_hydro would overwrite it.
+            self.update_feq()
+            cl.enqueue_copy(self.queue, self.f, self.feq)
+
+    def update_multigrid_rhs(self):
+        """
+        The LB scheme relaxes to lap(rho) = -scaled_sources*delta_t (in lattice units), the problem multigrid solves.
+        """
+        rhs = self.scaled_sources * self.delta_t
+        if type(rhs) is not pyopencl.array.Array:
+            rhs = cl.array.to_device(self.queue, np.asfortranarray(rhs, dtype=np.float32))
+        self.multigrid_rhs = rhs
+
+    def set_rho_on_boundary(self):
+        """Sets the outermost nodes of rho to rho_on_boundary, the Dirichlet condition multigrid works with."""
+        rho_host = self.rho.get()
+        rho_host[0, :] = self.rho_on_boundary
+        rho_host[-1, :] = self.rho_on_boundary
+        rho_host[:, 0] = self.rho_on_boundary
+        rho_host[:, -1] = self.rho_on_boundary
+        self.rho.set(rho_host)
+
     def update_negative_gradient(self):
         self.kernels.update_negative_gradient(self.queue, self.two_d_global_size, self.two_d_local_size,
                                           self.rho.data, self.u.data, self.v.data,
@@ -208,16 +305,18 @@ class Poisson_Solver(object):
         # Compile our OpenCL code
         self.kernels = cl.Program(self.context, open(parent_dir + '/D2Q9_poisson.cl').read()).build(options='')
 
-        # Create the reduction kernel
-        self.reduction_kernel = cl.reduction.ReductionKernel(self.context, np.float32, neutral="0",
-                                                             reduce_expr="a+b",
-                                                             map_expr="fabs(x[i]-y[i])",
-                                                             arguments="__global float *x, \
-                                                                        __global float *y")
-        self.sum_kernel = cl.reduction.ReductionKernel(self.context, np.float32, neutral="0",
-                                                             reduce_expr="a+b",
-                                                             map_expr="x[i]",
-                                                             arguments="__global float *x")
+        # Create the reduction kernel. Returns both sum(|rho - rho_before|) and sum(rho_before) in a single pass.
+        self.convergence_kernel = cl.reduction.ReductionKernel(self.context, cl.array.vec.float2,
+                                                               neutral="(float2)(0, 0)",
+                                                               reduce_expr="a+b",
+                                                               map_expr="(float2)(fabs(x[i]-y[i]), y[i])",
+                                                               arguments="__global float *x, \
+                                                                          __global float *y")
+
+        self.extrapolate_kernel = cl.elementwise.ElementwiseKernel(self.context,
+                                                                   "float *rho, float *rho_1, float *rho_2",
+                                                                   "rho[i] = 2*rho_1[i] - rho_2[i]",
+                                                                   "extrapolate")
 
 
     def allocate_constants(self):
@@ -321,19 +420,87 @@ class Poisson_Solver(object):
                                 self.delta_t, self.lb_D,
                                 self.nx, self.ny).wait()
 
+    def get_checkpoint_fields(self):
+        names = super(Poisson_Solver, self).get_checkpoint_fields()
+        if type(self.scaled_sources) is pyopencl.array.Array:
+            names.append('scaled_sources')
+        names += ['rho_history.' + str(i) for i in range(len(self.rho_history))]
+        return names
+
+    def get_checkpoint_state(self):
+        """The adaptive convergence checks; a restored solver checks at the same iterations as the original."""
+        state = super(Poisson_Solver, self).get_checkpoint_state()
+        state['check_interval'] = self.check_interval
+        state['next_check'] = self.next_check
+        if self.last_check is None:
+            state['last_check'] = None
+        else:
+            state['last_check'] = [int(self.last_check[0]), float(self.last_check[1])]
+        state['num_rho_history'] = len(self.rho_history)
+        return state
+
+    def set_checkpoint_state(self, state):
+        super(Poisson_Solver, self).set_checkpoint_state(state)
+        if 'next_check' not in state:
+            return
+        self.check_interval = state['check_interval']
+        self.next_check = state['next_check']
+        self.last_check = None if state['last_check'] is None else tuple(state['last_check'])
+        # Allocated here and overwritten by the checkpoint
+        num_rho_history = state['num_rho_history']
+        del self.rho_history[num_rho_history:]
+        while len(self.rho_history) < num_rho_history:
+            self.rho_history.append(self.rho.copy())
+
+    def get_relative_change(self):
+        """
+        :return: The average change of rho over the last iteration relative to the average of rho. Requires rho_before
+                 to hold rho from the previous iteration. If rho was zero, i.e. before the first iteration with
+                 rho_on_boundary=0, any change is infinitely large.
+        """
+        result = self.convergence_kernel(self.rho, self.rho_before).get()
+        return get_relative_change(result['x'], result['y'])
+
+    def update_check_interval(self, relative_change):
+        """
+        Chooses the number of iterations until the next convergence check from the contraction rate observed between
+        the last two checks: we aim for half of the predicted number of iterations left, so that we do not overshoot
+        convergence by much while checking rarely when convergence is far away. Without a positive tolerance and
+        changes to predict from, i.e. tolerance=0 to run a fixed number of iterations, the interval only backs off.
+        """
+        if self.last_check is not None:
+            last_iteration, last_change = self.last_check
+            rate = 0
+            if self.tolerance > 0 and relative_change > 0 and last_change > 0:
+                rate = (relative_change / last_change) ** (1. / (self.num_iterations - last_iteration))
+            if 0 < rate < 1:
+                iterations_left = np.log(self.tolerance / relative_change) / np.log(rate)
+                self.check_interval = int(iterations_left / 2.)
+            else: # Not converging (yet); back off
+                self.check_interval *= 2
+        self.check_interval = min(max(self.check_interval, 1), self.max_check_interval)
+
+        self.last_check = (self.num_iterations, relative_change)
+        self.next_check = self.num_iterations + self.check_interval
+
     def run(self, num_iterations):
         """
-        Run the simulation for num_iterations. Be aware that the same number of iterations does not correspond
-        to the same non-dimensional time passing, as delta_t, the time discretization, will change depending on
-        your resolution.
+        Run the simulation for num_iterations, or until the relative change in rho per iteration drops below
+        tolerance. Convergence is only checked every check_interval iterations, chosen adaptively. With
+        method='multigrid', every iteration is a full multigrid cycle and convergence is checked after each.
 
         :param num_iterations: The number of iterations to run
         """
+        if self.method == 'multigrid':
+            self.run_multigrid(num_iterations)
+            return
 
         for cur_iteration in range(num_iterations):
 
-            # Copy the current rho onto the previous rho
-            cl.enqueue_copy(self.queue, self.rho_before.data, self.rho.data)
+            check_convergence = (self.num_iterations + 1 >= self.next_check)
+            if check_convergence:
+                # Only keep the previous rho on iterations that end with a convergence check
+                cl.enqueue_copy(self.queue, self.rho_before.data, self.rho.data)
 
             self.move() # Move all jumpers
             self.move_bcs() # Our BC's rely on streaming before applying the BC, actually
@@ -345,18 +512,62 @@ class Poisson_Solver(object):
 
             self.num_iterations += 1
 
-            if self.num_iterations != 1:
-                # Check that your simulation has not converged
-                weight = (1./(self.nx*self.ny))
-                average_difference = weight*self.reduction_kernel(self.rho_before, self.rho).get()
-                rho_av = weight * self.sum_kernel(self.rho_before).get()
+            if check_convergence:
+                relative_change = self.get_relative_change()
 
-                if (average_difference/rho_av) < self.tolerance:
+                if relative_change < self.tolerance:
                     print 'Done in' , self.num_iterations , 'iterations'
                     print 'Updating u and v...'
                     self.update_negative_gradient()
                     break
 
+                self.update_check_interval(relative_change)
+
+    def run_multigrid(self, num_cycles):
+        """
+        Runs up to num_cycles multigrid cycles, stopping when the relative change of rho over a cycle drops below
+        tolerance. In incremental mode, the relative residual of rho is checked before every cycle as well, so an
+        unchanged source costs no cycles. Updates u and v when done.
+        """
+        if self.multigrid.backend == 'numpy':
+            rho_host = self.rho.get()
+            rhs_host = self.multigrid_rhs.get()
+
+        for cur_cycle in range(num_cycles):
+            if self.incremental:
+                # Stop on the residual of the (warm started) guess, so nothing is done if the source barely changed.
+                # The residual is relative to the terms of lap(rho), so float32 round-off does not keep it above
+                # tolerance; the relative change below remains as a backstop.
+                if self.multigrid.backend == 'opencl':
+                    relative_residual = self.multigrid.get_relative_residual(self.rho, self.multigrid_rhs)
+                else:
+                    relative_residual = self.multigrid.get_relative_residual(rho_host, rhs_host)
+                if relative_residual < self.tolerance:
+                    print 'Done in', self.num_iterations, 'multigrid cycles'
+                    break
+
+            if self.multigrid.backend == 'opencl':
+                cl.enqueue_copy(self.queue, self.rho_before.data, self.rho.data)
+                self.multigrid.cycle(self.rho, self.multigrid_rhs)
+                relative_change = self.get_relative_change()
+            else:
+                rho_before_host = rho_host.copy()
+                self.multigrid.cycle(rho_host, rhs_host)
+                relative_change = get_relative_change(np.sum(np.abs(rho_host - rho_before_host)),
+                                                      np.sum(rho_before_host))
+
+            self.num_iterations += 1
+
+            if relative_change < self.tolerance:
+                print 'Done in' , self.num_iterations , 'multigrid cycles'
+                break
+
+        if self.multigrid.backend == 'numpy':
+            self.rho.set(rho_host)
+
+        print 'Updating u and v...'
+        self.update_negative_gradient()
+
     def get_fields(self):
         """
         :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
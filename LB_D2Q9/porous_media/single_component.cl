@@ -14,7 +14,7 @@ update_feq_pourous(
     __global __read_only double *rho_global,
     __global __read_only double *u_bary_global,
     __global __read_only double *v_bary_global,
-    const double epsilon,
+    __global __read_only double *inv_epsilon_global,
     __constant double *w_arr,
     __constant int *cx_arr,
     __constant int *cy_arr,
@@ -37,6 +37,7 @@ update_feq_pourous(
         double rho = rho_global[three_d_index];
         const double u = u_bary_global[two_d_index];
         const double v = v_bary_global[two_d_index];
+        const double inv_epsilon = inv_epsilon_global[three_d_index];
 
         // Now loop over every jumper
         for(int jump_id=0; jump_id < num_jumpers; jump_id++){
@@ -53,8 +54,8 @@ update_feq_pourous(
             w*rho*(
             1.f
             + c_dot_u/(cs*cs)
-            + (c_dot_u*c_dot_u)/(2*cs*cs*cs*cs*epsilon)
-            - u_squared/(2*cs*cs*epsilon)
+            + (c_dot_u*c_dot_u)*inv_epsilon/(2*cs*cs*cs*cs)
+            - u_squared*inv_epsilon/(2*cs*cs)
             );
 
             feq_global[four_d_index] = new_feq;
@@ -71,7 +72,7 @@ collide_particles_pourous(
     __global __read_only double *v_bary_global,
     __global __read_only double *Gx_global,
     __global __read_only double *Gy_global,
-    const double epsilon,
+    __global __read_only double *inv_epsilon_global,
     const double omega,
     __constant double *w_arr,
     __constant int *cx_arr,
@@ -95,7 +96,7 @@ collide_particles_pourous(
         const double v = v_bary_global[two_d_index];
         const double Gx = Gx_global[three_d_index];
         const double Gy = Gy_global[three_d_index];
-
+        const double inv_epsilon = inv_epsilon_global[three_d_index];
 
         for(int jump_id=0; jump_id < num_jumpers; jump_id++){
             int four_d_index = jump_id*num_populations*ny*nx + three_d_index;
@@ -108,8 +109,8 @@ collide_particles_pourous(
 
             double Fi = w_arr[jump_id]*rho*(1 - .5*omega)*(
                 c_dot_F/(cs*cs)
-                + c_dot_F*c_dot_u/(cs*cs*cs*cs*epsilon)
-                - u_dot_F/(cs*cs*epsilon)
+                + c_dot_F*c_dot_u*inv_epsilon/(cs*cs*cs*cs)
+                - u_dot_F*inv_epsilon/(cs*cs)
             );
 
             f_global[four_d_index] = relax + Fi;
@@ -219,10 +220,6 @@ update_hydro_pourous(
     __global double *v_global,
     __global __read_only double *Gx_global,
     __global __read_only double *Gy_global,
-    const double epsilon,
-    const double nu_fluid,
-    const double Fe,
-    const double K,
     __constant double *w_arr,
     __constant int *cx_arr,
     __constant int *cy_arr,
@@ -280,10 +277,9 @@ update_forces_pourous(
     __global double *v_global,
     __global __read_only double *Gx_global,
     __global __read_only double *Gy_global,
-    const double epsilon,
-    const double nu_fluid,
-    const double Fe,
-    const double K,
+    __global __read_only double *epsilon_global,
+    __global __read_only double *linear_drag_global,
+    __global __read_only double *nonlinear_drag_global,
     const int nx, const int ny,
     const int cur_field,
     const int num_populations
@@ -311,18 +307,18 @@ update_forces_pourous(
             //At this point, Gx and Gy are already nonzero. We must account
             //for porosity before doing anything else...
 
+            const double epsilon = epsilon_global[three_d_index];
             Gx *= epsilon;
             Gy *= epsilon;
 
-            // Now add everything else...
-
-            Gx += -(epsilon * nu_fluid*u)/K;
-            Gy += -(epsilon * nu_fluid*v)/K;
+            // Now add everything else: the Darcy drag epsilon*nu_fluid/K and the Forchheimer drag
+            // epsilon*Fe/sqrt(K), both precomputed per node.
 
             double vel_mag = sqrt(u*u + v*v);
+            double drag = linear_drag_global[three_d_index] + nonlinear_drag_global[three_d_index]*vel_mag;
 
-            Gx += -(epsilon * Fe * vel_mag * u)/sqrt(K);
-            Gy += -(epsilon * Fe * vel_mag * v)/sqrt(K);
+            Gx += -drag*u;
+            Gy += -drag*v;
 
             Gx_global[three_d_index] = Gx;
             Gy_global[three_d_index] = Gy;
@@ -334,6 +330,218 @@ update_forces_pourous(
     }
 }
 
+__kernel void
+update_hydro_forces_bary(
+    __global __read_only double *f_global,
+    __global double *rho_global,
+    __global double *u_global,
+    __global double *v_global,
+    __global __write_only double *Gx_global,
+    __global __write_only double *Gy_global,
+    __global __read_only double *static_Gx_global,
+    __global __read_only double *static_Gy_global,
+    __global __write_only double *u_bary_global,
+    __global __write_only double *v_bary_global,
+    __global __read_only double *epsilon_global,
+    __global __read_only double *linear_drag_global,
+    __global __read_only double *nonlinear_drag_global,
+    __constant int *cx_arr,
+    __constant int *cy_arr,
+    const int nx, const int ny,
+    const int num_populations,
+    const int num_jumpers,
+    const int read_forces)
+{
+    /* update_hydro_pourous, update_forces_pourous and update_bary_velocity in one pass over every fluid of a node.
+    The drag coefficients are precomputed per node (see Simulation_Runner.set_porous_coefficients):
+    linear_drag = epsilon*nu_fluid/K and nonlinear_drag = epsilon*Fe/sqrt(K). If read_forces is nonzero, the static
+    forces per density (see Simulation_Runner.add_static_force) are scaled by epsilon and added to the drag; otherwise
+    Gx and Gy hold the drag only. */
+    //Input should be a 2d workgroup! Loop over the fluids.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+
+        double sum_x = 0;
+        double sum_y = 0;
+        double rho_sum = 0;
+
+        for(int cur_field=0; cur_field < num_populations; cur_field++){
+            const int three_d_index = cur_field*ny*nx + two_d_index;
+
+            double rho = 0;
+            double mom_x = 0;
+            double mom_y = 0;
+
+            for(int jump_id=0; jump_id < num_jumpers; jump_id++){
+                const double f = f_global[jump_id*num_populations*ny*nx + three_d_index];
+
+                rho += f;
+                mom_x += f*cx_arr[jump_id];
+                mom_y += f*cy_arr[jump_id];
+            }
+
+            double u = 0;
+            double v = 0;
+            double Gx = 0;
+            double Gy = 0;
+
+            if (rho > ZERO_DENSITY){
+                u = mom_x/rho;
+                v = mom_y/rho;
+
+                if (read_forces){
+                    const double epsilon = epsilon_global[three_d_index];
+                    Gx = epsilon*static_Gx_global[three_d_index];
+                    Gy = epsilon*static_Gy_global[three_d_index];
+                }
+
+                const double drag = linear_drag_global[three_d_index]
+                    + nonlinear_drag_global[three_d_index]*sqrt(u*u + v*v);
+                Gx += -drag*u;
+                Gy += -drag*v;
+            }
+
+            rho_global[three_d_index] = rho;
+            u_global[three_d_index] = u;
+            v_global[three_d_index] = v;
+            Gx_global[three_d_index] = Gx;
+            Gy_global[three_d_index] = Gy;
+
+            rho_sum += rho;
+            sum_x += mom_x + rho*Gx/2.;
+            sum_y += mom_y + rho*Gy/2.;
+        }
+        u_bary_global[two_d_index] = sum_x/rho_sum;
+        v_bary_global[two_d_index] = sum_y/rho_sum;
+    }
+}
+
+__kernel void
+update_forces_bary(
+    __global __read_only double *rho_global,
+    __global __read_only double *u_global,
+    __global __read_only double *v_global,
+    __global double *Gx_global,
+    __global double *Gy_global,
+    __global __write_only double *u_bary_global,
+    __global __write_only double *v_bary_global,
+    __global __read_only double *epsilon_global,
+    __global __read_only double *linear_drag_global,
+    __global __read_only double *nonlinear_drag_global,
+    const int nx, const int ny,
+    const int num_populations)
+{
+    /* update_forces_pourous and update_bary_velocity in one pass, for when nonlocal forces have to be added between
+    update_hydro_pourous and the drag. The momentum of each fluid is recovered as rho*u, so f is not read again. */
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+
+        double sum_x = 0;
+        double sum_y = 0;
+        double rho_sum = 0;
+
+        for(int cur_field=0; cur_field < num_populations; cur_field++){
+            const int three_d_index = cur_field*ny*nx + two_d_index;
+
+            const double rho = rho_global[three_d_index];
+            double Gx = 0;
+            double Gy = 0;
+
+            if (rho > ZERO_DENSITY){
+                const double u = u_global[three_d_index];
+                const double v = v_global[three_d_index];
+                const double epsilon = epsilon_global[three_d_index];
+                const double drag = linear_drag_global[three_d_index]
+                    + nonlinear_drag_global[three_d_index]*sqrt(u*u + v*v);
+
+                Gx = epsilon*Gx_global[three_d_index] - drag*u;
+                Gy = epsilon*Gy_global[three_d_index] - drag*v;
+
+                sum_x += rho*u;
+                sum_y += rho*v;
+            }
+
+            Gx_global[three_d_index] = Gx;
+            Gy_global[three_d_index] = Gy;
+
+            rho_sum += rho;
+            sum_x += rho*Gx/2.;
+            sum_y += rho*Gy/2.;
+        }
+        u_bary_global[two_d_index] = sum_x/rho_sum;
+        v_bary_global[two_d_index] = sum_y/rho_sum;
+    }
+}
+
+// The sums of steady_state_partials
+#define SUM_U 0
+#define SUM_V 1
+#define SUM_DELTA_U_SQUARED 2
+#define SUM_U_SQUARED 3
+#define NUM_STEADY_SUMS 4
+
+__kernel void
+steady_state_partials(
+    __global __read_only double *u_bary_global,
+    __global __read_only double *v_bary_global,
+    __global double *u_prev_global,
+    __global double *v_prev_global,
+    __global __write_only double *partial_global,
+    __local double *local_sums,
+    const int num_nodes)
+{
+    /* Every work group reduces a strided share of the nodes to the sums of u, v, |u - u_prev|^2 and |u|^2, then
+    u_prev is set to u for the next check. local_size must be a power of two. */
+    const int lid = get_local_id(0);
+    const int local_size = get_local_size(0);
+
+    double sum_u = 0;
+    double sum_v = 0;
+    double sum_delta_u_squared = 0;
+    double sum_u_squared = 0;
+
+    for(int i = get_global_id(0); i < num_nodes; i += get_global_size(0)){
+        const double u = u_bary_global[i];
+        const double v = v_bary_global[i];
+        const double delta_u = u - u_prev_global[i];
+        const double delta_v = v - v_prev_global[i];
+
+        sum_u += u;
+        sum_v += v;
+        sum_delta_u_squared += delta_u*delta_u + delta_v*delta_v;
+        sum_u_squared += u*u + v*v;
+
+        u_prev_global[i] = u;
+        v_prev_global[i] = v;
+    }
+
+    __local double *my_sums = &local_sums[lid*NUM_STEADY_SUMS];
+    my_sums[SUM_U] = sum_u;
+    my_sums[SUM_V] = sum_v;
+    my_sums[SUM_DELTA_U_SQUARED] = sum_delta_u_squared;
+    my_sums[SUM_U_SQUARED] = sum_u_squared;
+
+    for(int offset = local_size/2; offset > 0; offset /= 2){
+        barrier(CLK_LOCAL_MEM_FENCE);
+        if (lid < offset){
+            for(int j = 0; j < NUM_STEADY_SUMS; j++){
+                local_sums[lid*NUM_STEADY_SUMS + j] += local_sums[(lid + offset)*NUM_STEADY_SUMS + j];
+            }
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (lid < NUM_STEADY_SUMS){
+        partial_global[get_group_id(0)*NUM_STEADY_SUMS + lid] = local_sums[lid];
+    }
+}
+
 __kernel void
 move_periodic(__global __read_only double *f_global,
               __global __write_only double *f_streamed_global,
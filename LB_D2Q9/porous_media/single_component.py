@@ -6,11 +6,18 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import memory_pool
+from LB_D2Q9 import diagnostics
+from LB_D2Q9 import initialization
 import matplotlib.pyplot as plt
 
 # Required to draw obstacles
 import skimage as ski
 import skimage.draw
+import skimage.color
+import skimage.io
+import skimage.transform
 
 # Get path to *this* file. Necessary when reading in opencl code.
 full_path = os.path.realpath(__file__)
@@ -43,22 +50,67 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
+
+def read_image_field(filename, nx, ny, low, high):
+    """
+    Reads a spatially varying parameter, i.e. a porosity or permeability map, from an image. The image is converted to
+    greyscale and resized to the lattice; black maps to low and white to high. The top row of the image is y = ny - 1.
+
+    :param filename: The image to read
+    :param nx: The number of lattice nodes in x
+    :param ny: The number of lattice nodes in y
+    :param low: The value of black pixels
+    :param high: The value of white pixels
+    :return: An (nx, ny) array, Fortran ordered
+    """
+    image = ski.io.imread(filename)
+    if image.ndim == 3:
+        image = ski.color.rgb2gray(image[:, :, :3])
+    image = ski.transform.resize(image, (ny, nx)) # Scales intensities to [0, 1]
+
+    field = low + (high - low) * image[::-1, :].T
+    return np.asfortranarray(field, dtype=num_type)
+
+
+def run_batch_to_steady_state(runners, **kwargs):
+    """
+    Runs many samples to steady state sequentially, one after the other; see Simulation_Runner.run_to_steady_state.
+    Nothing runs concurrently: each sample is run to completion before the next one starts. runners may be a
+    generator that sets up each runner only when it is needed, so that only one sample occupies the device at a time.
+
+    :param runners: An iterable of fully set up Simulation_Runners
+    :param kwargs: Passed on to run_to_steady_state
+    :return: A list with the result of run_to_steady_state of every runner
+    """
+    results = []
+    for sim in runners:
+        results.append(sim.run_to_steady_state(**kwargs))
+        sim.allocator.free_held() # Release the blocks of this sample before the next one is set up
+    return results
+
+
 class Pourous_Media(object):
 
     def __init__(self, sim, field_index, nu_e = 1.0, epsilon = 1.0, nu_fluid=1.0, K=1.0, Fe=1.0,
                  bc='periodic'):
+        """
+        epsilon, nu_fluid, K and Fe may each be a scalar or an (nx, ny) array, i.e. from read_image_field. The drag
+        coefficients derived from them are precomputed per node by sim.set_porous_coefficients.
+        """
 
         self.sim = sim # TODO: MAKE THIS A WEAKREF
 
         self.field_index = int_type(field_index)
 
         self.lb_nu_e = num_type(nu_e)
-        self.epsilon = num_type(epsilon)
-        self.nu_fluid = num_type(nu_fluid)
-        self.K = num_type(K)
-        self.Fe = num_type(Fe)
+        self.epsilon = np.asarray(epsilon, dtype=num_type)
+        self.nu_fluid = np.asarray(nu_fluid, dtype=num_type)
+        self.K = np.asarray(K, dtype=num_type)
+        self.Fe = np.asarray(Fe, dtype=num_type)
         self.bc = bc
 
+        sim.set_porous_coefficients(self.field_index, self.epsilon, self.K, self.nu_fluid, self.Fe)
+
         # Determine the viscosity
         self.tau = num_type(.5 + self.lb_nu_e / (sim.cs**2))
         print 'tau', self.tau
@@ -70,13 +122,14 @@ class Pourous_Media(object):
     def initialize(self, rho_arr, f_amp = 0.0):
         """
         ASSUMES THAT THE BARYCENTRIC VELOCITY IS ALREADY SET
+
+        :param rho_arr: The initial density: a scalar, an (nx, ny) array, or an OpenCL expression of x and y that is
+            evaluated on the device; see initialization.Initializer.set_field_slice.
+        :param f_amp: The relative amplitude of the noise added to the initial populations
         """
 
         #### DENSITY #####
-        rho_host = self.sim.rho.get()
-
-        rho_host[:, :, self.field_index] = rho_arr
-        self.sim.rho = cl.array.to_device(self.sim.queue, rho_host)
+        self.sim.initializer.set_field_slice(self.sim.rho, self.field_index, rho_arr)
 
         #### UPDATE HOPPERS ####
         self.update_feq() # Based on the hydrodynamic fields, create feq
@@ -89,23 +142,12 @@ class Pourous_Media(object):
         self.update_forces() # Calculates the drag force, if necessary, based on the component velocity
 
     def init_pop(self, amplitude=0.001):
-        """Based on feq, create the initial population of jumpers."""
-
-        nx = self.sim.nx
-        ny = self.sim.ny
-
-        # For simplicity, copy feq to the local host, where you can make a copy. There is probably a better way to do this.
-        f_host = self.sim.feq.get()
-        cur_f = f_host[:, :, self.field_index, :]
+        """Based on feq, create the initial population of jumpers. Only this fluid's slice of f is written."""
 
         # We now slightly perturb f. This is actually dangerous, as concentration can grow exponentially fast
         # from sall fluctuations. Sooo...be careful.
-        perturb = (1. + amplitude * np.random.randn(nx, ny, self.sim.num_jumpers))
-        cur_f *= perturb
-
-        # Now send f to the GPU
-        f_host[:, :, self.field_index, :] = cur_f
-        self.sim.f = cl.array.to_device(self.sim.queue, f_host)
+        self.sim.initializer.perturb_populations(self.sim.f, self.sim.feq, self.field_index,
+                                                 self.sim.num_populations, self.sim.num_jumpers, amplitude)
 
     def update_forces(self):
         """
@@ -120,7 +162,7 @@ class Pourous_Media(object):
             sim.rho.data,
             sim.u.data, sim.v.data,
             sim.Gx.data, sim.Gy.data,
-            self.epsilon, self.nu_fluid, self.Fe, self.K,
+            sim.porous_epsilon.data, sim.porous_linear_drag.data, sim.porous_nonlinear_drag.data,
             sim.nx, sim.ny,
             self.field_index, sim.num_populations
         ).wait()
@@ -138,7 +180,7 @@ class Pourous_Media(object):
             sim.feq.data,
             sim.rho.data,
             sim.u_bary.data, sim.v_bary.data,
-            self.epsilon,
+            sim.porous_inv_epsilon.data,
             sim.w, sim.cx, sim.cy, sim.cs,
             sim.nx, sim.ny,
             self.field_index, sim.num_populations,
@@ -211,19 +253,12 @@ class Pourous_Media(object):
             sim.rho.data,
             sim.u.data, sim.v.data,
             sim.Gx.data, sim.Gy.data,
-            self.epsilon, self.nu_fluid, self.Fe, self.K,
             sim.w, sim.cx, sim.cy,
             sim.nx, sim.ny,
             self.field_index, sim.num_populations,
             sim.num_jumpers
         ).wait()
 
-        if sim.check_max_ulb:
-            max_ulb = cl.array.max((sim.u[:, :, self.field_index]**2 + sim.v[:, :, self.field_index]**2)**.5, queue=sim.queue)
-
-            if max_ulb > sim.cs*sim.mach_tolerance:
-                print 'max_ulb is greater than cs/10! Ma=', max_ulb/sim.cs
-
     def collide_particles(self):
         sim = self.sim
 
@@ -234,7 +269,7 @@ class Pourous_Media(object):
             sim.rho.data,
             sim.u_bary.data, sim.v_bary.data,
             sim.Gx.data, sim.Gy.data,
-            self.epsilon, self.omega,
+            sim.porous_inv_epsilon.data, self.omega,
             sim.w, sim.cx, sim.cy,
             sim.nx, sim.ny,
             self.field_index, sim.num_populations,
@@ -242,7 +277,7 @@ class Pourous_Media(object):
             sim.cs
         ).wait()
 
-class Simulation_Runner(object):
+class Simulation_Runner(checkpoint.Checkpointable):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -251,7 +286,7 @@ class Simulation_Runner(object):
                  L_lb=100, T_lb=1.,
                  num_populations=1,
                  two_d_local_size=(32,32), use_interop=False,
-                 check_max_ulb=False, mach_tolerance=0.1):
+                 check_max_ulb=False, mach_tolerance=0.1, diagnostics_interval=1):
 
         self.nx = int_type(nx)
         self.ny = int_type(ny)
@@ -281,6 +316,8 @@ class Simulation_Runner(object):
         self.kernels = None     # Compiled OpenCL kernels
         self.use_interop = use_interop
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
@@ -296,43 +333,73 @@ class Simulation_Runner(object):
         self.psi_local_1 = None
         self.psi_local_2 = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        # Device fields saved by save_checkpoint
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'u_bary', 'v_bary', 'Gx', 'Gy']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables & Shan-chen variables
 
         rho_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         u_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
         v_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.u = cl.array.to_device(self.queue, u_host) # Velocity in the x direction; one per sim!
-        self.v = cl.array.to_device(self.queue, v_host) # Velocity in the y direction; one per sim.
+        self.u = cl.array.to_device(self.queue, u_host, allocator=self.allocator) # Velocity in the x direction; one per sim!
+        self.v = cl.array.to_device(self.queue, v_host, allocator=self.allocator) # Velocity in the y direction; one per sim.
 
         u_bary_host = np.zeros((self.nx, self.ny), dtype=num_type, order='F')
         v_bary_host = np.zeros((self.nx, self.ny), dtype=num_type, order='F')
-        self.u_bary = cl.array.to_device(self.queue, u_bary_host)  # Velocity in the x direction; one per sim!
-        self.v_bary = cl.array.to_device(self.queue, v_bary_host)  # Velocity in the y direction; one per sim.
+        self.u_bary = cl.array.to_device(self.queue, u_bary_host, allocator=self.allocator)  # Velocity in the x direction; one per sim!
+        self.v_bary = cl.array.to_device(self.queue, v_bary_host, allocator=self.allocator)  # Velocity in the y direction; one per sim.
 
         # Intitialize the underlying feq equilibrium field
         feq_host = np.zeros((self.nx, self.ny, self.num_populations, self.num_jumpers), dtype=num_type, order='F')
-        self.feq = cl.array.to_device(self.queue, feq_host)
+        self.feq = cl.array.to_device(self.queue, feq_host, allocator=self.allocator)
 
         f_host = np.zeros((self.nx, self.ny, self.num_populations, self.num_jumpers), dtype=num_type, order='F')
-        self.f = cl.array.to_device(self.queue, f_host)
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
         self.f_streamed = self.f.copy()
 
         # Initialize G: the body force acting on each phase
         Gx_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
         Gy_host = np.zeros((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
-        self.Gx = cl.array.to_device(self.queue, Gx_host)
-        self.Gy = cl.array.to_device(self.queue, Gy_host)
+        self.Gx = cl.array.to_device(self.queue, Gx_host, allocator=self.allocator)
+        self.Gy = cl.array.to_device(self.queue, Gy_host, allocator=self.allocator)
+
+        # Per-node porous coefficients of every field, precomputed by set_porous_coefficients so that the kernels only
+        # multiply and add. Fields without a Pourous_Media are free fluid: epsilon = 1 and no drag.
+        ones_host = np.ones((self.nx, self.ny, self.num_populations), dtype=num_type, order='F')
+        self.porous_epsilon = cl.array.to_device(self.queue, ones_host, allocator=self.allocator)
+        self.porous_inv_epsilon = cl.array.to_device(self.queue, ones_host, allocator=self.allocator)
+        self.porous_linear_drag = cl.array.zeros_like(self.Gx) # epsilon*nu_fluid/K
+        self.porous_nonlinear_drag = cl.array.zeros_like(self.Gx) # epsilon*Fe/sqrt(K)
+
+        # On-device health checks (mass, momentum, Mach number, NaN/Inf); see check_fields
+        self.diagnostics = diagnostics.Diagnostics(self, interval=diagnostics_interval)
+
+        # Writes the initial conditions of the fluids in place; its random number generator is checkpointed
+        self.initializer = initialization.Initializer(self)
+        self.random_generator = self.initializer.random_generator
 
         # Create list corresponding to all of the different fluids
         self.fluid_list = []
         self.tau_arr = []
 
         self.additional_collisions = [] # Takes into account growth, other things that can influence collisions
-        self.additional_forces = []  # Takes into account other forces, i.e. surface tension
+        self.additional_forces = []  # Forces that read the neighbours, i.e. surface tension
+        self.constant_body_forces = [] # (fluid_index, force_x, force_y); the driving forces of run_to_steady_state
+        # Position-only forces per density, written once when they are added; see add_static_force
+        self.static_Gx = None
+        self.static_Gy = None
+
+        # Buffers of the steady state check; allocated by the first call to get_steady_state_sums
+        self.u_prev = None
+        self.v_prev = None
+        self.steady_partials = None
+        self.steady_local_sums = None
+        self.steady_local_size = None
 
     def add_fluid(self, fluid):
         self.fluid_list.append(fluid)
@@ -350,9 +417,40 @@ class Simulation_Runner(object):
         self.tau_arr = cl.Buffer(self.context, cl.mem_flags.READ_ONLY |
         cl.mem_flags.COPY_HOST_PTR, hostbuf=tau_host)
 
+    def set_porous_coefficients(self, field_index, epsilon, K, nu_fluid, Fe):
+        """
+        Precomputes the Brinkman-Forchheimer coefficients of one field at every node: epsilon, 1/epsilon, the Darcy drag
+        epsilon*nu_fluid/K and the Forchheimer drag epsilon*Fe/sqrt(K). Called by Pourous_Media; may be called again
+        to change the medium.
+
+        :param field_index: The field the coefficients apply to
+        :param epsilon: The porosity, in (0, 1]; a scalar or an (nx, ny) array
+        :param K: The permeability, positive; a scalar or an (nx, ny) array
+        :param nu_fluid: The viscosity of the fluid; a scalar or an (nx, ny) array
+        :param Fe: The Forchheimer coefficient; a scalar or an (nx, ny) array
+        """
+        def to_field(values):
+            return np.zeros((self.nx, self.ny), dtype=num_type, order='F') + values
+
+        epsilon = to_field(epsilon)
+        K = to_field(K)
+        nu_fluid = to_field(nu_fluid)
+        Fe = to_field(Fe)
+
+        if np.any(epsilon <= 0) or np.any(epsilon > 1):
+            raise ValueError('The porosity epsilon must lie in (0, 1].')
+        if np.any(K <= 0):
+            raise ValueError('The permeability K must be positive.')
+
+        set_slice = self.initializer.set_field_slice
+        set_slice(self.porous_epsilon, field_index, epsilon)
+        set_slice(self.porous_inv_epsilon, field_index, 1. / epsilon)
+        set_slice(self.porous_linear_drag, field_index, epsilon * nu_fluid / K)
+        set_slice(self.porous_nonlinear_drag, field_index, epsilon * Fe / np.sqrt(K))
+
     def set_bary_velocity(self, u_bary_host, v_bary_host):
-        self.u_bary = cl.array.to_device(self.queue, u_bary_host)
-        self.v_bary = cl.array.to_device(self.queue, v_bary_host)
+        self.u_bary = cl.array.to_device(self.queue, u_bary_host, allocator=self.allocator)
+        self.v_bary = cl.array.to_device(self.queue, v_bary_host, allocator=self.allocator)
 
     def update_bary_velocity(self):
         self.kernels.update_bary_velocity(
@@ -367,6 +465,49 @@ class Simulation_Runner(object):
             self.num_populations, self.num_jumpers
         ).wait()
 
+    def update_hydro_forces_bary(self, read_forces=False):
+        """
+        Computes the density and velocity of every fluid, their porous drag and the barycentric velocity in a single
+        pass; equivalent to update_hydro and update_forces of every fluid followed by update_bary_velocity.
+
+        :param read_forces: If True, the static forces (see add_static_force) are added to the drag. Otherwise Gx and
+            Gy hold the drag only.
+        """
+        if read_forces and self.static_Gx is None:
+            raise ValueError('No static force was added.')
+        static_Gx = self.static_Gx if read_forces else self.Gx # A placeholder that is not read
+        static_Gy = self.static_Gy if read_forces else self.Gy
+
+        self.kernels.update_hydro_forces_bary(
+            self.queue, self.two_d_global_size, self.two_d_local_size,
+            self.f.data,
+            self.rho.data,
+            self.u.data, self.v.data,
+            self.Gx.data, self.Gy.data,
+            static_Gx.data, static_Gy.data,
+            self.u_bary.data, self.v_bary.data,
+            self.porous_epsilon.data, self.porous_linear_drag.data, self.porous_nonlinear_drag.data,
+            self.cx, self.cy,
+            self.nx, self.ny,
+            self.num_populations, self.num_jumpers,
+            int_type(read_forces)
+        ).wait()
+
+    def update_forces_bary(self):
+        """
+        Adds the porous drag of every fluid to the forces in Gx and Gy and updates the barycentric velocity in a single
+        pass; equivalent to update_forces of every fluid followed by update_bary_velocity.
+        """
+        self.kernels.update_forces_bary(
+            self.queue, self.two_d_global_size, self.two_d_local_size,
+            self.rho.data,
+            self.u.data, self.v.data,
+            self.Gx.data, self.Gy.data,
+            self.u_bary.data, self.v_bary.data,
+            self.porous_epsilon.data, self.porous_linear_drag.data, self.porous_nonlinear_drag.data,
+            self.nx, self.ny,
+            self.num_populations
+        ).wait()
 
     def init_opencl(self):
         """
@@ -458,30 +599,32 @@ class Simulation_Runner(object):
 
         self.additional_collisions.append([kernel_to_run, arguments])
 
-    def add_constant_body_force(self, fluid_index, force_x, force_y):
+    def add_static_force(self, kernel_to_run, arguments):
+        """
+        Adds a body force that depends on position only. The kernel runs once, adding the force per density to
+        static_Gx and static_Gy, which update_hydro_forces_bary then reads every step in the same pass as the drag.
 
-        kernel_to_run = self.kernels.add_constant_body_force
-        arguments = [
-            self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_index), num_type(force_x), num_type(force_y),
-            self.Gx.data, self.Gy.data,
-            self.nx, self.ny
-        ]
+        :param kernel_to_run: A kernel that adds a force to the Gx and Gy it is given, i.e. add_constant_body_force
+        :param arguments: The arguments of the kernel between the work sizes and Gx, Gy
+        """
+        if self.static_Gx is None:
+            self.static_Gx = cl.array.zeros_like(self.Gx)
+            self.static_Gy = cl.array.zeros_like(self.Gy)
 
-        self.additional_forces.append([kernel_to_run, arguments])
+        kernel_to_run(self.queue, self.two_d_global_size, self.two_d_local_size,
+                      *(list(arguments) + [self.static_Gx.data, self.static_Gy.data, self.nx, self.ny])).wait()
 
-    def add_radial_body_force(self, fluid_index, center_x, center_y, prefactor, radial_scaling):
+    def add_constant_body_force(self, fluid_index, force_x, force_y):
 
-        kernel_to_run = self.kernels.add_radial_body_force
-        arguments = [
-            self.queue, self.two_d_global_size, self.two_d_local_size,
-            int_type(fluid_index), int_type(center_x), int_type(center_y),
-            num_type(prefactor), num_type(radial_scaling),
-            self.Gx.data, self.Gy.data,
-            self.nx, self.ny
-        ]
+        self.add_static_force(self.kernels.add_constant_body_force,
+                              [int_type(fluid_index), num_type(force_x), num_type(force_y)])
+        self.constant_body_forces.append((int(fluid_index), float(force_x), float(force_y)))
 
-        self.additional_forces.append([kernel_to_run, arguments])
+    def add_radial_body_force(self, fluid_index, center_x, center_y, prefactor, radial_scaling):
+
+        self.add_static_force(self.kernels.add_radial_body_force,
+                              [int_type(fluid_index), int_type(center_x), int_type(center_y),
+                               num_type(prefactor), num_type(radial_scaling)])
 
     def add_interaction_force(self, fluid_1_index, fluid_2_index, G_int, bc='periodic', potential='linear',
                               potential_parameters=None):
@@ -701,36 +844,44 @@ class Simulation_Runner(object):
                 print 'After move bcs'
                 self.check_fields()
 
-            # Update forces here as appropriate
-            for cur_fluid in self.fluid_list:
-                cur_fluid.update_hydro() # Update the hydrodynamic variables
-            if debug:
-                print 'After updating hydro'
-                self.check_fields()
-
-            # Reset the total body force and add to it as appropriate
-            self.Gx[...] = 0
-            self.Gy[...] = 0
-            for d in self.additional_forces:
-                kernel = d[0]
-                arguments = d[1]
-                kernel(*arguments).wait()
-            if debug:
-                print 'After updating supplementary forces'
-                self.check_fields()
-
-            # Update other forces...includes pourous effects & must be run last
-            for cur_fluid in self.fluid_list:
-                cur_fluid.update_forces()
-            if debug:
-                print 'After updating internal forces'
-                self.check_fields()
-
-            # After updating forces, update the bary_velocity
-            self.update_bary_velocity()
-            if debug:
-                print 'After updating bary-velocity'
-                self.check_fields()
+            if len(self.additional_forces) == 0:
+                # Hydrodynamic variables, static forces, porous drag and bary_velocity in one pass
+                self.update_hydro_forces_bary(read_forces=self.static_Gx is not None)
+                if debug:
+                    print 'After updating hydro, forces & bary-velocity'
+                    self.check_fields()
+            else:
+                # The additional forces may depend on the density of the neighbours, so the hydrodynamic variables
+                # must be updated everywhere first.
+                for cur_fluid in self.fluid_list:
+                    cur_fluid.update_hydro() # Update the hydrodynamic variables
+                if debug:
+                    print 'After updating hydro'
+                    self.check_fields()
+
+                # Start the total body force from the static forces and add to it as appropriate
+                if self.static_Gx is None:
+                    self.Gx[...] = 0
+                    self.Gy[...] = 0
+                else:
+                    self.Gx[...] = self.static_Gx
+                    self.Gy[...] = self.static_Gy
+                for d in self.additional_forces:
+                    kernel = d[0]
+                    arguments = d[1]
+                    kernel(*arguments).wait()
+                if debug:
+                    print 'After updating supplementary forces'
+                    self.check_fields()
+
+                # Pourous effects must be added last; the bary_velocity is updated in the same pass
+                self.update_forces_bary()
+                if debug:
+                    print 'After updating internal forces & bary-velocity'
+                    self.check_fields()
+
+            if self.check_max_ulb and self.diagnostics.sample():
+                self.check_mach()
 
             for cur_fluid in self.fluid_list:
                 cur_fluid.update_feq() # Update the equilibrium fields
@@ -750,17 +901,142 @@ class Simulation_Runner(object):
                 arguments = d[1]
                 kernel(*arguments).wait()
 
-    def check_fields(self):
-        # Start with rho
-        for i in range(self.num_populations):
-            print 'Field:', i
-            print 'rho_sum', cl.array.sum(self.rho[:, :, i])
-            print 'u, v bary sum', cl.array.sum(self.u_bary), cl.array.sum(self.u_bary)
-            print 'f_sum', np.sum(self.f.get()[:, :, i, :])
-            print 'f_eq_sum', np.sum(self.feq.get()[:, :, i, :])
+            self.step_count += 1
+            self.allocator.end_step()
 
-        print 'Total rho_sum', cl.array.sum(self.rho)
-        print 'Total f_sum', np.sum(self.f.get())
-        print 'Total feq_sum', np.sum(self.feq.get())
+    def get_steady_state_sums(self):
+        """
+        Reduces the barycentric velocity on the device to the sums of u, v, |u - u_prev|^2 and |u|^2 over all nodes,
+        where u_prev is the velocity of the previous call, and stores the current velocity as u_prev. Only the
+        partial sums of the work groups (a few hundred bytes) are transferred.
 
-        print
+        :return: A tuple (sum_u, sum_v, sum_delta_u_squared, sum_u_squared)
+        """
+        num_nodes = int(self.nx) * int(self.ny)
+        if self.u_prev is None:
+            max_size = min(256, self.context.devices[0].max_work_group_size)
+            self.steady_local_size = 2**int(np.floor(np.log2(max_size)))
+            num_groups = int(max(1, min(64, (num_nodes + self.steady_local_size - 1) // self.steady_local_size)))
+
+            self.u_prev = cl.array.zeros_like(self.u_bary)
+            self.v_prev = cl.array.zeros_like(self.v_bary)
+            self.steady_partials = cl.array.zeros(self.queue, (num_groups, 4), dtype=num_type,
+                                                  allocator=self.allocator)
+            self.steady_local_sums = cl.LocalMemory(self.steady_local_size * 4 * num_size)
+
+        num_groups = self.steady_partials.shape[0]
+        self.kernels.steady_state_partials(
+            self.queue, (num_groups * self.steady_local_size,), (self.steady_local_size,),
+            self.u_bary.data, self.v_bary.data,
+            self.u_prev.data, self.v_prev.data,
+            self.steady_partials.data, self.steady_local_sums,
+            int_type(num_nodes)
+        ).wait()
+
+        return tuple(np.sum(self.steady_partials.get(), axis=0))
+
+    def run_to_steady_state(self, tol=1e-6, check_every=100, max_iterations=1000000, fluid_index=0, force=None,
+                            viscosity=None):
+        """
+        Runs until the flow is steady and returns the Darcy permeability of the medium. Every check_every steps, the
+        relative change of the barycentric velocity field, ||u - u_prev|| / ||u||, and of the superficial velocity
+        (the velocity averaged over all nodes) since the last check are reduced on the device. The run stops when both
+        are below tol. A flow that is at rest everywhere is not converged: the run stops at once, as the force does not
+        move the fluid. Neither is a flow whose superficial velocity is zero, as its relative change is undefined.
+
+        :param tol: The relative change per check_every steps below which the flow is steady
+        :param check_every: The number of steps between checks
+        :param max_iterations: The run stops after this many steps even if the flow is not steady
+        :param fluid_index: The fluid whose viscosity and driving force define the permeability
+        :param force: The driving body force (per density) (force_x, force_y). Defaults to the sum of the constant
+            body forces added to fluid_index.
+        :param viscosity: The viscosity in Darcy's law. Defaults to the (mean) nu_fluid of fluid_index; pass the
+            lattice viscosity nu_e for pore scale runs without drag.
+        :return: A dictionary with the permeability K = viscosity * (U . g) / |g|^2, the superficial_velocity U as
+            (U_x, U_y), num_iterations, whether the run converged and the last residual.
+        """
+        check_every = int(check_every)
+        if check_every < 1:
+            raise ValueError('check_every must be at least one step.')
+
+        if force is None:
+            force = np.zeros(2, dtype=num_type)
+            for cur_index, force_x, force_y in self.constant_body_forces:
+                if cur_index == fluid_index:
+                    force += (force_x, force_y)
+        force = np.asarray(force, dtype=num_type)
+        force_squared = np.sum(force**2)
+        if force_squared == 0:
+            raise ValueError('A nonzero driving force is required to compute the permeability.')
+
+        if viscosity is None:
+            fluids = [cur_fluid for cur_fluid in self.fluid_list if cur_fluid.field_index == fluid_index]
+            if len(fluids) == 0:
+                raise ValueError('No fluid has the field index ' + str(fluid_index))
+            viscosity = np.mean(fluids[0].nu_fluid)
+
+        num_nodes = int(self.nx) * int(self.ny)
+
+        sum_u, sum_v, sum_delta_u_squared, sum_u_squared = self.get_steady_state_sums() # Sets u_prev
+        superficial_velocity = np.array([sum_u, sum_v]) / num_nodes
+
+        num_iterations = 0
+        converged = False
+        residual = np.inf
+        while num_iterations < max_iterations:
+            num_steps = min(check_every, max_iterations - num_iterations)
+            self.run(num_steps)
+            num_iterations += num_steps
+
+            prev_superficial_velocity = superficial_velocity
+            sum_u, sum_v, sum_delta_u_squared, sum_u_squared = self.get_steady_state_sums()
+            superficial_velocity = np.array([sum_u, sum_v]) / num_nodes
+
+            if not np.isfinite(sum_u_squared):
+                print 'The velocity field is not finite after', num_iterations, 'steps; stopping.'
+                break
+
+            if sum_u_squared == 0:
+                print 'The driving force does not move the fluid after', num_iterations, 'steps; stopping.'
+                residual = np.inf
+                break
+
+            velocity_change = np.sqrt(sum_delta_u_squared / sum_u_squared)
+            superficial_speed = np.linalg.norm(superficial_velocity)
+            if superficial_speed > 0:
+                flux_change = np.linalg.norm(superficial_velocity - prev_superficial_velocity) / superficial_speed
+            else:
+                flux_change = np.inf
+            residual = max(velocity_change, flux_change)
+
+            if residual < tol:
+                converged = True
+                break
+
+        permeability = viscosity * np.dot(superficial_velocity, force) / force_squared
+
+        return {
+            'permeability': permeability,
+            'superficial_velocity': superficial_velocity,
+            'num_iterations': num_iterations,
+            'converged': converged,
+            'residual': residual
+        }
+
+    def check_mach(self):
+        """
+        Warns if the maximum lattice velocity of any fluid exceeds mach_tolerance times the speed of sound. Uses the
+        results of the last diagnostics computation.
+        """
+        max_mach = self.diagnostics.get_max_mach(cs=self.cs)
+        for i in range(self.num_populations):
+            if max_mach[i] > self.mach_tolerance:
+                print 'max_ulb of field', i, 'exceeds the Mach tolerance! Ma=', max_mach[i]
+
+    def check_fields(self):
+        """
+        Prints the mass, momentum, maximum speed, density extrema and number of NaN/Inf nodes of every fluid. Only the
+        reduced values are transferred from the device.
+        """
+        self.diagnostics.compute()
+        self.diagnostics.report()
@@ -6,6 +6,9 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import recorder
+from LB_D2Q9 import field_access
 
 # Required to draw obstacles
 import skimage as ski
@@ -53,7 +56,7 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Diffusion(object):
+class Diffusion(checkpoint.Checkpointable, recorder.Recordable, field_access.Field_Access):
     """
     Simulates pipe flow using the D2Q9 lattice. Generally used to verify that our simulations were working correctly.
     For usage, see the docs folder.
@@ -135,6 +138,10 @@ class Diffusion(object):
         self.w = None
         self.cx = None
         self.cy = None
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.recorders = [] # Scalar time series recorded every step; see add_recorder
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v'] # Device fields saved by save_checkpoint
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables
@@ -379,33 +386,17 @@ class Diffusion(object):
 
             self.collide_particles() # Relax the nonequilibrium fields.
 
+            self.step_count += 1
+
+            self.update_recorders()
+
 
     def get_fields(self):
         """
-        :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
+        :return: Returns a dictionary of all fields. A field is only transferred from the GPU to the CPU the first
+                 time it is accessed, so reading fields['rho'] does not transfer f.
         """
-        f = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, f, self.f, is_blocking=True)
-
-        feq = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, feq, self.feq, is_blocking=True)
-
-        u = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, u, self.u, is_blocking=True)
-
-        v = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, v, self.v, is_blocking=True)
-
-        rho = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, rho, self.rho, is_blocking=True)
-
-        results={}
-        results['f'] = f
-        results['u'] = u
-        results['v'] = v
-        results['rho'] = rho
-        results['feq'] = feq
-        return results
+        return field_access.Lazy_Fields(self.get_field, ['f', 'u', 'v', 'rho', 'feq'])
 
     def get_nondim_fields(self):
         """
@@ -413,8 +404,8 @@ class Diffusion(object):
         """
         fields = self.get_fields()
 
-        fields['u'] *= self.delta_x/self.delta_t
-        fields['v'] *= self.delta_x/self.delta_t
+        fields.scale('u', self.delta_x/self.delta_t)
+        fields.scale('v', self.delta_x/self.delta_t)
 
         return fields
 
@@ -425,8 +416,8 @@ class Diffusion(object):
         """
         fields = self.get_nondim_fields()
 
-        fields['u'] *= (self.L/self.T)
-        fields['v'] *= (self.L/self.T)
+        fields.scale('u', self.L/self.T)
+        fields.scale('v', self.L/self.T)
 
         return fields
 
@@ -561,6 +552,8 @@ class Reaction_Advection_Diffusion_Stochastic(Reaction_Advection_Diffusion):
 
         super(Reaction_Advection_Diffusion_Stochastic, self).__init__(**kwargs)
 
+        self.checkpoint_fields.append('random_normal')
+
     def allocate_constants(self):
         super(Reaction_Advection_Diffusion_Stochastic, self).allocate_constants()
 
@@ -606,6 +599,10 @@ class Reaction_Advection_Diffusion_Stochastic(Reaction_Advection_Diffusion):
             self.random_generator.fill_normal(self.random_normal, queue=self.queue)
             self.random_normal.finish()
 
+            self.step_count += 1
+
+            self.update_recorders()
+
 
 # class Pipe_Flow_Cylinder(Pipe_Flow):
 #     """
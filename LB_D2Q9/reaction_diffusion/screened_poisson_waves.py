@@ -6,7 +6,12 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import recorder
+from LB_D2Q9 import memory_pool
+from LB_D2Q9 import field_access
 from LB_D2Q9.spectral_poisson import screened_poisson as sp
+from LB_D2Q9.spectral_poisson import schedule
 
 # Required to draw obstacles
 import skimage as ski
@@ -52,7 +57,7 @@ def get_divisible_global(global_size, local_size):
             new_size.append(cur_global + cur_local - remainder)
     return tuple(new_size)
 
-class Screened_Fisher_Wave(object):
+class Screened_Fisher_Wave(checkpoint.Checkpointable, recorder.Recordable, field_access.Field_Access):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -60,7 +65,8 @@ class Screened_Fisher_Wave(object):
     def __init__(self, Lx=1.0, Ly=1.0, vc=1., lam=1., R0 = 5.,
                  time_prefactor=1., N=50,
                  two_d_local_size=(32,32), three_d_local_size=(32,32,1), use_interop=False,
-                 check_max_ulb=False, mach_tolerance=0.1):
+                 check_max_ulb=False, mach_tolerance=0.1,
+                 poisson_interval=1, poisson_tolerance=None, poisson_extrapolate=False):
         """
         :param N: Resolution of the simulation. As N increases, the simulation should become more accurate. N determines
                   how many grid points the characteristic length scale is discretized into
@@ -70,6 +76,11 @@ class Screened_Fisher_Wave(object):
                                by N.
         :param two_d_local_size: A tuple of the local size to be used in 2d, i.e. (32, 32)
         :param three_d_local_size: A tuple of the local size to be used in 3d, i.e. (32, 32, 3)
+        :param poisson_interval: Re-solve the screened poisson field at most every poisson_interval steps. None only
+            re-solves on poisson_tolerance.
+        :param poisson_tolerance: If not None, also re-solve as soon as the relative change of the density since the
+            last solve exceeds it.
+        :param poisson_extrapolate: If True, linearly extrapolate the velocity from the last two solves in between.
         """
 
         # Physical units
@@ -86,6 +97,11 @@ class Screened_Fisher_Wave(object):
         self.check_max_ulb = check_max_ulb
         self.mach_tolerance = mach_tolerance
 
+        # When to re-solve the screened poisson field; see spectral_poisson.schedule
+        self.poisson_interval = poisson_interval
+        self.poisson_tolerance = poisson_tolerance
+        self.poisson_extrapolate = poisson_extrapolate
+
         # Get the characteristic length and time scales for the flow. Since this simulation is in dimensionless units
         # they should both be one!
         self.L = 1.0 # Fisher length
@@ -132,11 +148,19 @@ class Screened_Fisher_Wave(object):
         self.queue = None       # The queue used to issue commands to the desired device
         self.kernels = None     # Compiled OpenCL kernels
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
         self.cx = None
         self.cy = None
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.recorders = [] # Scalar time series recorded every step; see add_recorder
+        self.checkpoint_fields = ['f', 'feq', 'rho'] # Device fields saved by save_checkpoint
+        # Owned objects whose state is saved with the runner; see checkpoint.Checkpointable
+        self.checkpoint_children = ['poisson_solver', 'poisson_schedule']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables and poisson solver
@@ -150,6 +174,7 @@ class Screened_Fisher_Wave(object):
         self.Y_dim = None
 
         self.poisson_solver = None
+        self.poisson_schedule = None
 
         self.init_hydro() # Create the hydrodynamic fields, and also intialize the poisson solver
 
@@ -261,22 +286,32 @@ class Screened_Fisher_Wave(object):
         rho_host[:, :] = np.exp(-(self.X**2 + self.Y**2)/self.R0**2)
         # rand_num = np.random.rand(nx, ny)
         # rho_host[rand_num > .1] = 0.0
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         #### VELOCITY ####
 
+        # Allocated once; update_u_and_v writes the poisson gradients into them.
+        u_host = np.zeros((nx, ny), dtype=np.float32, order='F')
+        self.u = cl.array.to_device(self.queue, u_host, allocator=self.allocator)
+        self.v = cl.array.to_device(self.queue, u_host, allocator=self.allocator)
+
         # Initialize via poisson solver...
         self.poisson_solver = sp.Screened_Poisson(rho_host, cl_context=self.context, cl_queue = self.queue,
-                                                  lam=self.lam, dx=self.delta_x)
+                                                  lam=self.lam, dx=self.delta_x,
+                                                  two_d_local_size=self.two_d_local_size)
         self.poisson_solver.create_grad_fields()
+        self.poisson_schedule = schedule.Resolve_Schedule(self.poisson_solver, interval=self.poisson_interval,
+                                                          tolerance=self.poisson_tolerance,
+                                                          extrapolate=self.poisson_extrapolate)
 
         self.update_u_and_v()
 
     def redo_initial_condition(self, rho_field):
         """After you have specified your own IC"""
         rho_host = rho_field.astype(dtype=np.float32, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
+        self.poisson_schedule.reset()
         self.update_u_and_v()
         self.update_feq()  # Based on the hydrodynamic fields, create feq
         self.init_pop()  # Based on feq, create the hopping non-equilibrium fields
@@ -336,13 +371,10 @@ class Screened_Fisher_Wave(object):
 
     def update_u_and_v(self):
         # Update the charge field for the poisson solver
-        #self.poisson_solver.charge = self.rho.astype(np.complex64, queue=self.queue)
-        cl.enqueue_copy(self.queue, self.poisson_solver.charge.data, self.rho.astype(np.complex64).data)
-
-        self.poisson_solver.solve_and_update_grad_fields()
-
-        self.u = -self.vc*(self.delta_t/self.delta_x)*(self.poisson_solver.xgrad.real)
-        self.v = -self.vc*(self.delta_t/self.delta_x)*(self.poisson_solver.ygrad.real)
+        # Re-solves only when the schedule requires it
+        extrapolation = self.poisson_schedule.update(self.rho, self.step_count)
+        self.poisson_solver.unpack_grad_fields(self.u, self.v, scale=-self.vc*(self.delta_t/self.delta_x),
+                                               extrapolation=extrapolation)
 
         if self.check_max_ulb:
             max_ulb = cl.array.max((self.u**2 + self.v**2)**.5, queue=self.queue)
@@ -386,33 +418,18 @@ class Screened_Fisher_Wave(object):
             self.update_feq() # Update the equilibrium fields
             self.collide_particles() # Relax the nonequilibrium fields.
 
+            self.step_count += 1
+            self.allocator.end_step()
+
+            self.update_recorders()
+
 
     def get_fields(self):
         """
-        :return: Returns a dictionary of all fields. Transfers data from the GPU to the CPU.
+        :return: Returns a dictionary of all fields. A field is only transferred from the GPU to the CPU the first
+                 time it is accessed, so reading fields['rho'] does not transfer f.
         """
-        f = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, f, self.f, is_blocking=True)
-
-        feq = np.zeros((self.nx, self.ny, NUM_JUMPERS), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, feq, self.feq, is_blocking=True)
-
-        u = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, u, self.u.data, is_blocking=True)
-
-        v = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, v, self.v.data, is_blocking=True)
-
-        rho = np.zeros((self.nx, self.ny), dtype=np.float32, order='F')
-        cl.enqueue_copy(self.queue, rho, self.rho.data, is_blocking=True)
-
-        results={}
-        results['f'] = f
-        results['u'] = u
-        results['v'] = v
-        results['rho'] = rho
-        results['feq'] = feq
-        return results
+        return field_access.Lazy_Fields(self.get_field, ['f', 'u', 'v', 'rho', 'feq'])
 
     def get_nondim_fields(self):
         """
@@ -420,8 +437,8 @@ class Screened_Fisher_Wave(object):
         """
         fields = self.get_fields()
 
-        fields['u'] *= self.delta_x/self.delta_t
-        fields['v'] *= self.delta_x/self.delta_t
+        fields.scale('u', self.delta_x/self.delta_t)
+        fields.scale('v', self.delta_x/self.delta_t)
 
         return fields
 
@@ -432,8 +449,8 @@ class Screened_Fisher_Wave(object):
         """
         fields = self.get_nondim_fields()
 
-        fields['u'] *= (self.L/self.T)
-        fields['v'] *= (self.L/self.T)
+        fields.scale('u', self.L/self.T)
+        fields.scale('v', self.L/self.T)
 
         return fields
 
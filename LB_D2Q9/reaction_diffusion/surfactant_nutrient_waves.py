@@ -6,7 +6,11 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import recorder
+from LB_D2Q9 import memory_pool
 from LB_D2Q9.spectral_poisson import screened_poisson as sp
+from LB_D2Q9.spectral_poisson import schedule
 import matplotlib.pyplot as plt
 
 # Required to draw obstacles
@@ -57,7 +61,7 @@ def get_divisible_global(global_size, local_size):
     return tuple(new_size)
 
 
-class Surfactant_Nutrient_Wave(object):
+class Surfactant_Nutrient_Wave(checkpoint.Checkpointable, recorder.Recordable):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -65,7 +69,8 @@ class Surfactant_Nutrient_Wave(object):
     def __init__(self, Lx=1.0, Ly=1.0, vc=1., lam=1., Dn = 1./4., R0 = 5.,
                  time_prefactor=1., N=50,
                  two_d_local_size=(32,32), three_d_local_size=(32,32,1), use_interop=False,
-                 check_max_ulb=False, mach_tolerance=0.1):
+                 check_max_ulb=False, mach_tolerance=0.1,
+                 poisson_interval=1, poisson_tolerance=None, poisson_extrapolate=False):
         """
         :param N: Resolution of the simulation. As N increases, the simulation should become more accurate. N determines
                   how many grid points the characteristic length scale is discretized into
@@ -75,6 +80,11 @@ class Surfactant_Nutrient_Wave(object):
                                by N.
         :param two_d_local_size: A tuple of the local size to be used in 2d, i.e. (32, 32)
         :param three_d_local_size: A tuple of the local size to be used in 3d, i.e. (32, 32, 3)
+        :param poisson_interval: Re-solve the screened poisson field at most every poisson_interval steps. None only
+            re-solves on poisson_tolerance.
+        :param poisson_tolerance: If not None, also re-solve as soon as the relative change of the density since the
+            last solve exceeds it.
+        :param poisson_extrapolate: If True, linearly extrapolate the velocity from the last two solves in between.
         """
 
         # Physical units
@@ -96,6 +106,11 @@ class Surfactant_Nutrient_Wave(object):
         self.check_max_ulb = check_max_ulb
         self.mach_tolerance = mach_tolerance
 
+        # When to re-solve the screened poisson field; see spectral_poisson.schedule
+        self.poisson_interval = poisson_interval
+        self.poisson_tolerance = poisson_tolerance
+        self.poisson_extrapolate = poisson_extrapolate
+
         # Get the characteristic length and time scales for the flow. Since this simulation is in dimensionless units
         # they should both be one!
         self.L = 1.0 # Fisher length
@@ -152,11 +167,19 @@ class Surfactant_Nutrient_Wave(object):
         self.queue = None       # The queue used to issue commands to the desired device
         self.kernels = None     # Compiled OpenCL kernels
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
         self.cx = None
         self.cy = None
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.recorders = [] # Scalar time series recorded every step; see add_recorder
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v'] # Device fields saved by save_checkpoint
+        # Owned objects whose state is saved with the runner; see checkpoint.Checkpointable
+        self.checkpoint_children = ['poisson_solver', 'poisson_schedule']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables and poisson solver
@@ -170,12 +193,13 @@ class Surfactant_Nutrient_Wave(object):
         self.Y_dim = None
 
         self.poisson_solver = None
+        self.poisson_schedule = None
 
         self.init_hydro() # Create the hydrodynamic fields, and also intialize the poisson solver
 
         # Intitialize the underlying feq equilibrium field
         feq_host = np.zeros((self.nx, self.ny, self.num_populations, NUM_JUMPERS), dtype=np.float32, order='F')
-        self.feq = cl.array.to_device(self.queue, feq_host)
+        self.feq = cl.array.to_device(self.queue, feq_host, allocator=self.allocator)
 
         self.update_feq() # Based on the hydrodynamic fields, create feq
 
@@ -288,30 +312,35 @@ class Surfactant_Nutrient_Wave(object):
         rho_host[:, :, self.nut_index] = 1.0 #- rho_host[:, :, self.pop_index]
 
         # Send to device
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         #### VELOCITY ####
 
-        # Create u and v fields. Necessary to copy onto due to complex type issues...
+        # Create u and v fields; update_u_and_v copies the poisson gradients into them.
         u_host = np.zeros((nx, ny), dtype=np.float32, order='F')
         v_host = np.zeros((nx, ny), dtype=np.float32, order='F')
 
-        self.u = cl.array.to_device(self.queue, u_host)
-        self.v = cl.array.to_device(self.queue, v_host)
+        self.u = cl.array.to_device(self.queue, u_host, allocator=self.allocator)
+        self.v = cl.array.to_device(self.queue, v_host, allocator=self.allocator)
 
         # Initialize via poisson solver...
         density_field = rho_host[:, :, self.pop_index]
         self.poisson_solver = sp.Screened_Poisson(density_field, cl_context=self.context, cl_queue = self.queue,
-                                                  lam=self.lam, dx=self.delta_x)
+                                                  lam=self.lam, dx=self.delta_x,
+                                                  two_d_local_size=self.two_d_local_size)
         self.poisson_solver.create_grad_fields()
+        self.poisson_schedule = schedule.Resolve_Schedule(self.poisson_solver, interval=self.poisson_interval,
+                                                          tolerance=self.poisson_tolerance,
+                                                          extrapolate=self.poisson_extrapolate)
 
         self.update_u_and_v()
 
     def redo_initial_condition(self, rho_field):
         """After you have specified your own IC"""
         rho_host = rho_field.astype(dtype=np.float32, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
+        self.poisson_schedule.reset()
         self.update_u_and_v()
         self.update_feq()  # Based on the hydrodynamic fields, create feq
         self.init_pop()  # Based on feq, create the hopping non-equilibrium fields
@@ -344,7 +373,7 @@ class Surfactant_Nutrient_Wave(object):
         f_host *= perturb
 
         # Now send f to the GPU
-        self.f = cl.array.to_device(self.queue, f_host)
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
 
         # f_temporary will be the buffer that f moves into in parallel.
         self.f_streamed = self.f.copy()
@@ -372,23 +401,10 @@ class Surfactant_Nutrient_Wave(object):
 
     def update_u_and_v(self):
         # Update the charge field for the poisson solver
-        #self.poisson_solver.charge = self.rho.astype(np.complex64, queue=self.queue)
-        density_view = self.rho[:, :, self.pop_index]
-
-        cl.enqueue_copy(self.queue, self.poisson_solver.charge.data, density_view.astype(np.complex64).data)
-
-        self.poisson_solver.solve_and_update_grad_fields()
-        xgrad = self.poisson_solver.xgrad
-        ygrad = self.poisson_solver.ygrad
-
-        #TODO: THIS SEEMS TO BE THE ONLY WAY TO PREVENT WEIRD TRANSPOSITION ERRORS. TRY TO FIX IN THE FUTURE.
-        # THERE SEEMS TO BE AN ERROR ASSOCIATED WITH .REAL, IT SEEMS TO TRANSPOSE ELEMENTS IN A WAY I DON'T
-        # UNDERSTAND
-        cl.enqueue_copy(self.queue, self.u.data, xgrad.real.data)
-        cl.enqueue_copy(self.queue, self.v.data, ygrad.real.data)
-
-        self.u *= -self.vc * (self.delta_t / self.delta_x)
-        self.v *= -self.vc * (self.delta_t / self.delta_x)
+        # Re-solves only when the schedule requires it
+        extrapolation = self.poisson_schedule.update(self.rho, self.step_count, field_index=self.pop_index)
+        self.poisson_solver.unpack_grad_fields(self.u, self.v, scale=-self.vc*(self.delta_t/self.delta_x),
+                                               extrapolation=extrapolation)
 
         if self.check_max_ulb:
             max_ulb = cl.array.max((self.u**2 + self.v**2)**.5, queue=self.queue)
@@ -434,6 +450,11 @@ class Surfactant_Nutrient_Wave(object):
             self.update_feq() # Update the equilibrium fields
             self.collide_particles() # Relax the nonequilibrium fields.
 
+            self.step_count += 1
+            self.allocator.end_step()
+
+            self.update_recorders()
+
 class Clumpy_Surfactant_Nutrient_Wave(Surfactant_Nutrient_Wave):
 
     def __init__(self, rho_o = 1.0, G_chen=-1.0,  **kwargs):
@@ -460,10 +481,10 @@ class Clumpy_Surfactant_Nutrient_Wave(Surfactant_Nutrient_Wave):
 
     def init_hydro(self):
         psi_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.psi = cl.array.to_device(self.queue, psi_host)
+        self.psi = cl.array.to_device(self.queue, psi_host, allocator=self.allocator)
 
         pseudo_force_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host)
+        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host, allocator=self.allocator)
         self.pseudo_force_y = self.pseudo_force_x.copy()
 
         super(Clumpy_Surfactant_Nutrient_Wave, self).init_hydro()
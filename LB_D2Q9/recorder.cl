@@ -0,0 +1,101 @@
+// Kernels that evaluate scalar observables straight into a device row buffer. Compiled with -D NUM_TYPE=float or
+// -D NUM_TYPE=double (plus -D USE_DOUBLE for the latter).
+
+#ifdef USE_DOUBLE
+    #ifdef cl_khr_fp64
+        #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    #elif defined(cl_amd_fp64)
+        #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+    #else
+        #error "Double precision floating point not supported by OpenCL implementation."
+    #endif
+#endif
+
+#define OP_SUM 0
+#define OP_MAX 1
+#define OP_MIN 2
+
+NUM_TYPE
+get_identity(const int op)
+{
+    if (op == OP_MAX) return -INFINITY;
+    else if (op == OP_MIN) return INFINITY;
+    else return 0;
+}
+
+NUM_TYPE
+combine(const NUM_TYPE a, const NUM_TYPE b, const int op)
+{
+    if (op == OP_MAX) return fmax(a, b);
+    else if (op == OP_MIN) return fmin(a, b);
+    else return a + b;
+}
+
+NUM_TYPE
+reduce_local(__local NUM_TYPE *scratch, NUM_TYPE value, const int op)
+{
+    // Tree reduction over the work group; the local size must be a power of two.
+    const int lid = get_local_id(0);
+    scratch[lid] = value;
+    for(int offset = get_local_size(0)/2; offset > 0; offset /= 2){
+        barrier(CLK_LOCAL_MEM_FENCE);
+        if (lid < offset) scratch[lid] = combine(scratch[lid], scratch[lid + offset], op);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    return scratch[0];
+}
+
+__kernel void
+record_probes(
+    __global __read_only NUM_TYPE *field_global,
+    __global NUM_TYPE *rows_global,
+    __global __read_only int *offsets,
+    __global __read_only int *columns,
+    const int num_probes,
+    const int row,
+    const int num_columns)
+{
+    // Copies the value of field_global at every offset into its column of the current row of the buffer.
+    const int i = get_global_id(0);
+    if (i < num_probes){
+        rows_global[row*num_columns + columns[i]] = field_global[offsets[i]];
+    }
+}
+
+__kernel void
+reduce_partial(
+    __global __read_only NUM_TYPE *field_global,
+    __global NUM_TYPE *partial_global,
+    __local NUM_TYPE *scratch,
+    const int offset,
+    const int num_values,
+    const int op)
+{
+    // First stage: every work group reduces a strided share of field_global[offset:offset + num_values].
+    NUM_TYPE value = get_identity(op);
+    for(int i = get_global_id(0); i < num_values; i += get_global_size(0)){
+        value = combine(value, field_global[offset + i], op);
+    }
+
+    value = reduce_local(scratch, value, op);
+    if (get_local_id(0) == 0) partial_global[get_group_id(0)] = value;
+}
+
+__kernel void
+reduce_to_row(
+    __global __read_only NUM_TYPE *partial_global,
+    __global NUM_TYPE *rows_global,
+    __local NUM_TYPE *scratch,
+    const int num_partials,
+    const int op,
+    const int index)
+{
+    // Second stage: a single work group combines the partial results and writes them into the buffer.
+    NUM_TYPE value = get_identity(op);
+    for(int i = get_local_id(0); i < num_partials; i += get_local_size(0)){
+        value = combine(value, partial_global[i], op);
+    }
+
+    value = reduce_local(scratch, value, op);
+    if (get_local_id(0) == 0) rows_global[index] = value;
+}
@@ -0,0 +1,216 @@
+"""
+Per-step scalar time series recorded on the device.
+
+A Scalar_Recorder evaluates a set of registered observables (point probes, reductions over a field, or custom
+kernels) every interval steps and writes them into the next row of a device row buffer. The buffer is filled
+linearly and does not wrap: nothing is transferred to the host until all capacity rows are written or flush() is
+called, at which point every pending row is copied in a single transfer and the buffer starts again from row zero.
+Runners inherit Recordable; attach a recorder with sim.add_recorder(recorder) and the run loop calls record() after
+every step.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+from LB_D2Q9.diagnostics import get_program, get_buffer_and_type
+
+REDUCTION_OPS = {'sum': 0, 'max': 1, 'min': 2}
+
+
+class Recordable(object):
+    """
+    Mixin for runners whose run loop feeds scalar recorders. The runner must set self.recorders = [] in __init__ and
+    call self.update_recorders() at the end of every step, after step_count is incremented.
+    """
+
+    def add_recorder(self, recorder):
+        """
+        Attaches a recorder (i.e. a LB_D2Q9.recorder.Scalar_Recorder) whose record() method is called after every step.
+        """
+        self.recorders.append(recorder)
+
+    def update_recorders(self):
+        """Lets every attached recorder record the current step."""
+        for recorder in self.recorders:
+            recorder.record()
+
+
+class Scalar_Recorder(object):
+    """
+    Records scalar observables of a runner into a device row buffer. Register all observables with add_probe,
+    add_reduction and add_observable before the first call to record().
+    """
+
+    def __init__(self, sim, interval=1, capacity=1024, local_size=256, num_groups=64):
+        """
+        :param sim: The runner to record. Must have context, queue, nx, ny and step_count.
+        :param interval: Observables are evaluated every interval steps.
+        :param capacity: The number of rows the device buffer holds before it is flushed to the host.
+        :param local_size: The work group size of the reductions; rounded down to a power of two the device supports.
+        :param num_groups: The number of work groups used in the first stage of each reduction.
+        """
+        self.sim = sim
+        self.interval = int(interval)
+        self.capacity = int(capacity)
+        if self.interval < 1 or self.capacity < 1:
+            raise ValueError('The interval and capacity of a recorder must be at least one.')
+
+        self.num_nodes = int(sim.nx) * int(sim.ny)
+
+        max_size = min(local_size, sim.context.devices[0].max_work_group_size)
+        self.local_size = 2**int(np.floor(np.log2(max_size)))
+        self.num_groups = int(num_groups)
+
+        self.names = []
+        self.probes = {} # field name -> list of (offset, column)
+        self.reductions = [] # (field name, offset, num_values, op, column)
+        self.observables = [] # (function, column)
+
+        self.dtype = None
+        self.kernels = None
+        self.rows = None
+        self.partials = None
+        self.scratch = None
+        self.probe_tables = {} # field name -> (offsets, columns) on the device
+
+        self.pending_steps = [] # Steps of the rows currently in the device buffer; row i belongs to pending_steps[i]
+        self.host_steps = []
+        self.host_rows = []
+
+    def add_column(self, name):
+        if self.rows is not None:
+            raise ValueError('Observables must be registered before the first call to record().')
+        if name in self.names:
+            raise ValueError('An observable called ' + name + ' is already registered.')
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def add_probe(self, name, field_name, x, y, index=0):
+        """
+        Records the value of a field at a single node.
+
+        :param name: The name of the observable.
+        :param field_name: The attribute of the runner holding the field, i.e. 'u'
+        :param x: The x coordinate of the node.
+        :param y: The y coordinate of the node.
+        :param index: For fields with several slices per node (populations or jumpers), which slice to read.
+        """
+        if not (0 <= x < self.sim.nx and 0 <= y < self.sim.ny):
+            raise ValueError('The probe (' + str(x) + ', ' + str(y) + ') is outside of the grid.')
+        column = self.add_column(name)
+        offset = int(index)*self.num_nodes + int(y)*int(self.sim.nx) + int(x)
+        self.probes.setdefault(field_name, []).append((offset, column))
+
+    def add_reduction(self, name, field_name, op='sum', index=None):
+        """
+        Records a reduction over a field, i.e. the total mass with add_reduction('mass', 'rho').
+
+        :param name: The name of the observable.
+        :param field_name: The attribute of the runner holding the field.
+        :param op: One of 'sum', 'max' or 'min'
+        :param index: Reduce only over this slice (population) of the field. None reduces over the whole field.
+        """
+        if op not in REDUCTION_OPS:
+            raise ValueError('Unknown reduction ' + str(op) + '. Choose one of ' + str(sorted(REDUCTION_OPS.keys())))
+        column = self.add_column(name)
+        if index is None:
+            buf, dtype, num_bytes = get_buffer_and_type(getattr(self.sim, field_name))
+            offset, num_values = 0, num_bytes // dtype.itemsize
+        else:
+            offset, num_values = int(index)*self.num_nodes, self.num_nodes
+        self.reductions.append((field_name, offset, num_values, REDUCTION_OPS[op], column))
+
+    def add_observable(self, name, function):
+        """
+        Records a custom observable, i.e. a front position or the drag on an obstacle.
+
+        :param name: The name of the observable.
+        :param function: Called as function(rows, index) every interval steps. It must enqueue (without waiting)
+            a kernel that writes one value into rows.data at the flat index index.
+        """
+        column = self.add_column(name)
+        self.observables.append((function, column))
+
+    def allocate(self):
+        """Allocates the row buffer and the probe tables once all observables are registered."""
+        if len(self.names) == 0:
+            raise ValueError('No observables were registered.')
+
+        sim = self.sim
+        self.dtype = get_buffer_and_type(sim.rho)[1]
+        self.kernels = get_program(sim.context, self.dtype, source_name='recorder.cl')
+
+        self.rows = cl.array.zeros(sim.queue, (self.capacity, len(self.names)), dtype=self.dtype)
+        self.partials = cl.array.empty(sim.queue, (self.num_groups,), dtype=self.dtype)
+        self.scratch = cl.LocalMemory(self.local_size * self.dtype.itemsize)
+
+        for field_name, probe_list in self.probes.items():
+            offsets = np.array([p[0] for p in probe_list], dtype=np.int32)
+            columns = np.array([p[1] for p in probe_list], dtype=np.int32)
+            self.probe_tables[field_name] = (cl.array.to_device(sim.queue, offsets),
+                                             cl.array.to_device(sim.queue, columns))
+
+    def record(self):
+        """
+        Evaluates every observable into the next row of the buffer if the step counter is a multiple of interval.
+        Flushes the buffer to the host when it is full.
+        """
+        sim = self.sim
+        if sim.step_count % self.interval != 0:
+            return
+        if self.rows is None:
+            self.allocate()
+
+        row = len(self.pending_steps)
+        num_columns = np.int32(len(self.names))
+
+        for field_name, (offsets, columns) in self.probe_tables.items():
+            num_probes = offsets.shape[0]
+            self.kernels.record_probes(
+                sim.queue, (num_probes,), None,
+                get_buffer_and_type(getattr(sim, field_name))[0], self.rows.data,
+                offsets.data, columns.data,
+                np.int32(num_probes), np.int32(row), num_columns)
+
+        for field_name, offset, num_values, op, column in self.reductions:
+            num_groups = max(1, min(self.num_groups, (num_values + self.local_size - 1) // self.local_size))
+            self.kernels.reduce_partial(
+                sim.queue, (num_groups * self.local_size,), (self.local_size,),
+                get_buffer_and_type(getattr(sim, field_name))[0], self.partials.data, self.scratch,
+                np.int32(offset), np.int32(num_values), np.int32(op))
+            self.kernels.reduce_to_row(
+                sim.queue, (self.local_size,), (self.local_size,),
+                self.partials.data, self.rows.data, self.scratch,
+                np.int32(num_groups), np.int32(op), np.int32(row*num_columns + column))
+
+        for function, column in self.observables:
+            function(self.rows, row*num_columns + column)
+
+        self.pending_steps.append(sim.step_count)
+        if len(self.pending_steps) == self.capacity:
+            self.flush()
+
+    def flush(self):
+        """Copies every pending row of the buffer to the host in one transfer and starts again from row zero."""
+        num_rows = len(self.pending_steps)
+        if num_rows == 0:
+            return
+        self.host_rows.append(self.rows[:num_rows].get())
+        self.host_steps.extend(self.pending_steps)
+        self.pending_steps = []
+
+    def get(self):
+        """
+        Flushes the buffer and returns everything recorded so far.
+
+        :return: A dictionary mapping 'step' and the name of every observable to a numpy array with one entry per row.
+        """
+        self.flush()
+        results = {'step': np.array(self.host_steps, dtype=np.int64)}
+        if len(self.host_rows) > 0:
+            rows = np.concatenate(self.host_rows, axis=0)
+        else:
+            rows = np.zeros((0, len(self.names)), dtype=self.dtype)
+        for column, name in enumerate(self.names):
+            results[name] = rows[:, column]
+        return results
@@ -6,6 +6,8 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import memory_pool
 from LB_D2Q9.spectral_poisson import screened_poisson as sp
 import matplotlib.pyplot as plt
 
@@ -57,7 +59,7 @@ def get_divisible_global(global_size, local_size):
     return tuple(new_size)
 
 
-class Rocket_Yeast(object):
+class Rocket_Yeast(checkpoint.Checkpointable):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -158,6 +160,8 @@ class Rocket_Yeast(object):
         self.queue = None       # The queue used to issue commands to the desired device
         self.kernels = None     # Compiled OpenCL kernels
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
@@ -169,6 +173,10 @@ class Rocket_Yeast(object):
         self.buf_ny = None
         self.psi_local = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        # Device fields saved by save_checkpoint
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'psi', 'pseudo_force_x', 'pseudo_force_y']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables & Shan-chen variables
@@ -189,7 +197,7 @@ class Rocket_Yeast(object):
 
         # Intitialize the underlying feq equilibrium field
         feq_host = np.zeros((self.nx, self.ny, self.num_populations, NUM_JUMPERS), dtype=np.float32, order='F')
-        self.feq = cl.array.to_device(self.queue, feq_host)
+        self.feq = cl.array.to_device(self.queue, feq_host, allocator=self.allocator)
 
         self.update_feq() # Based on the hydrodynamic fields, create feq
 
@@ -308,7 +316,7 @@ class Rocket_Yeast(object):
         rho_host[:, :, self.surf_index] = 0.0 # No surfactant initially
 
         # Send to device
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         #### VELOCITY ####
 
@@ -316,8 +324,8 @@ class Rocket_Yeast(object):
         u_host = np.zeros((nx, ny), dtype=np.float32, order='F')
         v_host = np.zeros((nx, ny), dtype=np.float32, order='F')
 
-        self.u = cl.array.to_device(self.queue, u_host)
-        self.v = cl.array.to_device(self.queue, v_host)
+        self.u = cl.array.to_device(self.queue, u_host, allocator=self.allocator)
+        self.v = cl.array.to_device(self.queue, v_host, allocator=self.allocator)
 
         # If surfactant field is zero, so are u & v...check just in case
         self.update_u_and_v()
@@ -325,10 +333,10 @@ class Rocket_Yeast(object):
         ### CLUMPINESS ###
 
         psi_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.psi = cl.array.to_device(self.queue, psi_host)
+        self.psi = cl.array.to_device(self.queue, psi_host, allocator=self.allocator)
 
         pseudo_force_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host)
+        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host, allocator=self.allocator)
         self.pseudo_force_y = self.pseudo_force_x.copy()
 
         self.update_force()
@@ -336,7 +344,7 @@ class Rocket_Yeast(object):
     def redo_initial_condition(self, rho_field):
         """After you have specified your own IC"""
         rho_host = rho_field.astype(dtype=np.float32, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         self.update_u_and_v()
         self.update_force()
@@ -372,7 +380,7 @@ class Rocket_Yeast(object):
         f_host *= perturb
 
         # Now send f to the GPU
-        self.f = cl.array.to_device(self.queue, f_host)
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
 
         # f_temporary will be the buffer that f moves into in parallel.
         self.f_streamed = self.f.copy()
@@ -480,4 +488,7 @@ class Rocket_Yeast(object):
 
             self.update_hydro() # Update the hydrodynamic variables
             self.update_feq() # Update the equilibrium fields
-            self.collide_particles() # Relax the nonequilibrium fields.
\ No newline at end of file
+            self.collide_particles() # Relax the nonequilibrium fields.
+
+            self.step_count += 1
+            self.allocator.end_step()
\ No newline at end of file
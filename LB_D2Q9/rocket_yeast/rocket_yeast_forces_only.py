@@ -6,6 +6,8 @@ import pyopencl.tools
 import pyopencl.clrandom
 import pyopencl.array
 import ctypes as ct
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import memory_pool
 from LB_D2Q9.spectral_poisson import screened_poisson as sp
 import matplotlib.pyplot as plt
 
@@ -57,7 +59,7 @@ def get_divisible_global(global_size, local_size):
     return tuple(new_size)
 
 
-class Rocket_Yeast_Forces_Only(object):
+class Rocket_Yeast_Forces_Only(checkpoint.Checkpointable):
     """
     Everything is in dimensionless units. It's just easier.
     """
@@ -159,6 +161,8 @@ class Rocket_Yeast_Forces_Only(object):
         self.kernels = None     # Compiled OpenCL kernels
         self.use_interop = use_interop
         self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
 
         # Allocate constants & local memory for opencl
         self.w = None
@@ -170,6 +174,11 @@ class Rocket_Yeast_Forces_Only(object):
         self.buf_ny = None
         self.psi_local = None
 
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        # Device fields saved by save_checkpoint
+        self.checkpoint_fields = ['f', 'feq', 'rho', 'u', 'v', 'S', 'surface_force_x', 'surface_force_y',
+                                  'psi', 'pseudo_force_x', 'pseudo_force_y']
+
         self.allocate_constants()
 
         ## Initialize hydrodynamic variables & Shan-chen variables
@@ -194,7 +203,7 @@ class Rocket_Yeast_Forces_Only(object):
 
         # Intitialize the underlying feq equilibrium field
         feq_host = np.zeros((self.nx, self.ny, self.num_populations, NUM_JUMPERS), dtype=np.float32, order='F')
-        self.feq = cl.array.to_device(self.queue, feq_host)
+        self.feq = cl.array.to_device(self.queue, feq_host, allocator=self.allocator)
 
         self.update_feq() # Based on the hydrodynamic fields, create feq
 
@@ -313,18 +322,18 @@ class Rocket_Yeast_Forces_Only(object):
         rho_host[:, :, self.surf_index] = 0.0 # No surfactant initially
 
         # Send to device
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         ### Mobility ###
         m = np.zeros((nx, ny), dtype=np.float32, order='F')
-        self.S = cl.array.to_device(self.queue, m)
+        self.S = cl.array.to_device(self.queue, m, allocator=self.allocator)
 
         ### Velocity ###
         u = np.zeros((nx, ny), dtype=np.float32, order='F')
         v = np.zeros((nx, ny), dtype=np.float32, order='F')
 
-        self.u = cl.array.to_device(self.queue, u)
-        self.v = cl.array.to_device(self.queue, v)
+        self.u = cl.array.to_device(self.queue, u, allocator=self.allocator)
+        self.v = cl.array.to_device(self.queue, v, allocator=self.allocator)
 
         #### FORCES ####
 
@@ -332,15 +341,15 @@ class Rocket_Yeast_Forces_Only(object):
         surface_force_x = np.zeros((nx, ny), dtype=np.float32, order='F')
         surface_force_y = np.zeros((nx, ny), dtype=np.float32, order='F')
 
-        self.surface_force_x = cl.array.to_device(self.queue, surface_force_x)
-        self.surface_force_y = cl.array.to_device(self.queue, surface_force_y)
+        self.surface_force_x = cl.array.to_device(self.queue, surface_force_x, allocator=self.allocator)
+        self.surface_force_y = cl.array.to_device(self.queue, surface_force_y, allocator=self.allocator)
 
         # Van-der-waals forces
         psi_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.psi = cl.array.to_device(self.queue, psi_host)
+        self.psi = cl.array.to_device(self.queue, psi_host, allocator=self.allocator)
 
         pseudo_force_host = np.zeros((self.ny, self.ny), dtype=np.float32, order='F')
-        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host)
+        self.pseudo_force_x = cl.array.to_device(self.queue, pseudo_force_host, allocator=self.allocator)
         self.pseudo_force_y = self.pseudo_force_x.copy()
 
         # Now initialize all forces present
@@ -351,7 +360,7 @@ class Rocket_Yeast_Forces_Only(object):
     def redo_initial_condition(self, rho_field):
         """After you have specified your own IC"""
         rho_host = rho_field.astype(dtype=np.float32, order='F')
-        self.rho = cl.array.to_device(self.queue, rho_host)
+        self.rho = cl.array.to_device(self.queue, rho_host, allocator=self.allocator)
 
         self.update_forces()
 
@@ -386,7 +395,7 @@ class Rocket_Yeast_Forces_Only(object):
         f_host *= perturb
 
         # Now send f to the GPU
-        self.f = cl.array.to_device(self.queue, f_host)
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
 
         # f_temporary will be the buffer that f moves into in parallel.
         self.f_streamed = self.f.copy()
@@ -499,4 +508,7 @@ class Rocket_Yeast_Forces_Only(object):
 
             self.update_hydro() # Update the hydrodynamic variables
             self.update_feq() # Update the equilibrium fields
-            self.collide_particles() # Relax the nonequilibrium fields.
\ No newline at end of file
+            self.collide_particles() # Relax the nonequilibrium fields.
+
+            self.step_count += 1
+            self.allocator.end_step()
\ No newline at end of file
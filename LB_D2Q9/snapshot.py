@@ -0,0 +1,244 @@
+"""
+Asynchronous output of simulation fields.
+
+A Snapshot_Writer copies a list of device fields every few steps into a pool of reusable (page-locked where
+possible) host buffers with non-blocking copies, and hands them to a background thread that writes them to disk. The
+simulation only waits if every host buffer in the pool is still queued for writing.
+
+The on-disk store is a directory with one subdirectory per field. Each subdirectory contains chunks saved as .npy
+files of shape (chunk_size,) + field_shape, so a chunk can be opened with np.load(..., mmap_mode='r'). The file
+store.json lists the saved steps and the chunk layout; load_store reads it back.
+"""
+
+import numpy as np
+import os
+import json
+import threading
+import Queue
+import pyopencl as cl
+import pyopencl.array
+
+STORE_INDEX = 'store.json'
+
+
+def get_field_layout(sim, name):
+    """
+    Returns (cl.Buffer, shape, dtype, order) of a device field. cl.arrays know their own shape; raw cl.Buffers are
+    assumed to be float32 fields of shape (nx, ny, ...) in Fortran order, like every Buffer in the runners.
+    """
+    device_field = getattr(sim, name)
+    if isinstance(device_field, cl.array.Array):
+        order = 'F' if device_field.flags.f_contiguous else 'C'
+        return device_field.data, tuple(device_field.shape), device_field.dtype, order
+    else:
+        dtype = np.dtype(np.float32)
+        num_per_node = device_field.size // (sim.nx * sim.ny * dtype.itemsize)
+        if num_per_node == 1:
+            shape = (sim.nx, sim.ny)
+        else:
+            shape = (sim.nx, sim.ny, num_per_node)
+        return device_field, shape, dtype, 'F'
+
+
+def allocate_host_buffer(context, queue, shape, dtype, order):
+    """
+    Allocates a host array for device-to-host copies. Tries to use a page-locked (ALLOC_HOST_PTR) buffer so that the
+    copy can be done by DMA; falls back to ordinary pageable memory if the platform does not support it.
+
+    :return: A tuple of (host array, cl.Buffer backing it or None)
+    """
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    try:
+        pinned = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, size=num_bytes)
+        host, _ = cl.enqueue_map_buffer(queue, pinned, cl.map_flags.READ | cl.map_flags.WRITE, 0,
+                                        shape, dtype, order=order, is_blocking=True)
+        return host, pinned
+    except (cl.Error, cl.RuntimeError):
+        return np.empty(shape, dtype=dtype, order=order), None
+
+
+class Snapshot_Writer(object):
+    """
+    Saves fields of a runner every interval steps without stalling on disk. Use run(num_iterations) instead of
+    sim.run(num_iterations), or call record() yourself, and close() when done.
+    """
+
+    def __init__(self, sim, path, field_names=('rho',), interval=100, num_buffers=3, chunk_size=64):
+        """
+        :param sim: The runner to take snapshots of. Must have a context, queue, nx, ny and step_count.
+        :param path: The directory to write the store to. Created if it does not exist.
+        :param field_names: The attributes of sim to save, i.e. ['rho', 'u', 'v']
+        :param interval: The number of steps between snapshots
+        :param num_buffers: The number of host buffer sets in the pool, i.e. how many snapshots can be in flight
+        :param chunk_size: The number of snapshots stored in each chunk file
+        """
+
+        self.sim = sim
+        self.path = path
+        self.field_names = list(field_names)
+        self.interval = int(interval)
+        self.chunk_size = int(chunk_size)
+
+        if self.interval < 1:
+            raise ValueError('The snapshot interval must be at least one step.')
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.layouts = {}
+        for name in self.field_names:
+            self.layouts[name] = get_field_layout(sim, name)
+            field_dir = os.path.join(self.path, name)
+            if not os.path.exists(field_dir):
+                os.makedirs(field_dir)
+
+        # The pool of host buffer sets. The main thread takes a free set, the writer thread gives it back.
+        self.pinned_buffers = []
+        self.free_buffers = Queue.Queue()
+        for i in range(num_buffers):
+            host_set = {}
+            for name in self.field_names:
+                buf, shape, dtype, order = self.layouts[name]
+                host, pinned = allocate_host_buffer(sim.context, sim.queue, shape, dtype, order)
+                host_set[name] = host
+                if pinned is not None:
+                    self.pinned_buffers.append(pinned)
+            self.free_buffers.put(host_set)
+
+        self.steps = []
+        self.chunks = {} # The currently open memmap chunk of every field
+        self.pending = Queue.Queue()
+        self.error = None
+
+        self.writer_thread = threading.Thread(target=self.write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def run(self, num_iterations):
+        """
+        Runs the simulation for num_iterations, taking a snapshot whenever the step counter is a multiple of interval.
+        """
+        remaining = num_iterations
+        while remaining > 0:
+            steps_to_snapshot = self.interval - (self.sim.step_count % self.interval)
+            cur_steps = min(steps_to_snapshot, remaining)
+            self.sim.run(cur_steps)
+            remaining -= cur_steps
+            if self.sim.step_count % self.interval == 0:
+                self.record()
+
+    def record(self):
+        """
+        Enqueues non-blocking copies of all fields into a free host buffer set and hands them to the writer thread.
+        Only blocks if every buffer set is still waiting to be written. The fields are looked up again on every call,
+        as runners may swap or reallocate them (i.e. Sparse_Flow swaps f and f_new every step).
+        """
+        self.check_error()
+
+        buffers = []
+        for name in self.field_names:
+            buf, shape, dtype, order = get_field_layout(self.sim, name)
+            expected_shape, expected_dtype = self.layouts[name][1:3]
+            if shape != expected_shape or dtype != expected_dtype:
+                raise ValueError('The field ' + name + ' changed from ' + str(expected_shape) + ' ' +
+                                 str(expected_dtype) + ' to ' + str(shape) + ' ' + str(dtype) +
+                                 ' since the store was opened.')
+            buffers.append(buf)
+
+        host_set = self.free_buffers.get()
+        events = []
+        for name, buf in zip(self.field_names, buffers):
+            events.append(cl.enqueue_copy(self.sim.queue, host_set[name], buf, is_blocking=False))
+        self.sim.queue.flush()
+
+        self.pending.put((self.sim.step_count, events, host_set))
+
+    def write_loop(self):
+        """Runs on the writer thread: waits for each copy to land and appends it to the store."""
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            step, events, host_set = item
+            try:
+                cl.wait_for_events(events)
+                self.append(step, host_set)
+            except Exception as e:
+                self.error = e
+            self.free_buffers.put(host_set)
+
+    def append(self, step, host_set):
+        """Writes one snapshot into the current chunk of every field, starting a new chunk if needed."""
+        index = len(self.steps)
+        chunk_index, position = divmod(index, self.chunk_size)
+
+        for name in self.field_names:
+            if position == 0:
+                self.open_chunk(name, chunk_index)
+            self.chunks[name][position] = host_set[name]
+
+        self.steps.append(int(step))
+        if position == self.chunk_size - 1:
+            self.write_index()
+
+    def open_chunk(self, name, chunk_index):
+        """Flushes the previous chunk of a field and creates the next one as a memmapped .npy file."""
+        if name in self.chunks:
+            self.chunks[name].flush()
+        buf, shape, dtype, order = self.layouts[name]
+        chunk_path = os.path.join(self.path, name, 'chunk_%06d.npy' % chunk_index)
+        self.chunks[name] = np.lib.format.open_memmap(chunk_path, mode='w+', dtype=dtype,
+                                                      shape=(self.chunk_size,) + shape,
+                                                      fortran_order=False)
+
+    def write_index(self):
+        """Writes store.json, which describes which steps are stored and the shape of every field."""
+        for chunk in self.chunks.values():
+            chunk.flush()
+
+        fields = {}
+        for name in self.field_names:
+            buf, shape, dtype, order = self.layouts[name]
+            fields[name] = {'shape': list(shape), 'dtype': dtype.str}
+
+        index = {'steps': self.steps, 'chunk_size': self.chunk_size, 'fields': fields}
+        temp_path = os.path.join(self.path, STORE_INDEX + '.tmp')
+        with open(temp_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(temp_path, os.path.join(self.path, STORE_INDEX))
+
+    def check_error(self):
+        """Re-raises an exception from the writer thread on the main thread."""
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+        """Waits for all pending snapshots to be written and finalises the store."""
+        self.pending.put(None)
+        self.writer_thread.join()
+        self.write_index()
+        self.chunks = {}
+        self.check_error()
+
+
+def load_store(path):
+    """
+    Opens a store written by a Snapshot_Writer.
+
+    :return: A tuple of (steps, fields), where fields maps each field name to a list of memmapped chunks. Snapshot i is
+        fields[name][i // chunk_size][i % chunk_size]. The last chunk may be only partially filled.
+    """
+    with open(os.path.join(path, STORE_INDEX)) as index_file:
+        index = json.load(index_file)
+
+    steps = index['steps']
+    num_chunks = (len(steps) + index['chunk_size'] - 1) // index['chunk_size']
+
+    fields = {}
+    for name in index['fields']:
+        fields[name] = [np.load(os.path.join(path, name, 'chunk_%06d.npy' % i), mmap_mode='r')
+                        for i in range(num_chunks)]
+
+    return steps, fields
@@ -0,0 +1,106 @@
+#ifdef cl_khr_fp64
+    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#elif defined(cl_amd_fp64)
+    #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+#else
+    #error "Double precision floating point not supported by OpenCL implementation."
+#endif
+
+// D2Q9 kernels on the fluid nodes only. Populations are stored as f[jump_id*num_fluid + node], where node numbers the
+// fluid nodes; neighbours[jump_id*num_fluid + node] is the node the population streams from, or -1 across a
+// boundary link. See LB_D2Q9.obstacles.get_fluid_node_tables.
+
+#define NUM_JUMPERS 9
+
+__constant int cx_arr[NUM_JUMPERS] = {0, 1, 0, -1, 0, 1, -1, -1, 1};
+__constant int cy_arr[NUM_JUMPERS] = {0, 0, 1, 0, -1, 1, 1, -1, -1};
+__constant int opposite_arr[NUM_JUMPERS] = {0, 3, 4, 1, 2, 7, 8, 5, 6};
+__constant double w_arr[NUM_JUMPERS] = {4./9., 1./9., 1./9., 1./9., 1./9., 1./36., 1./36., 1./36., 1./36.};
+
+__kernel void
+stream_collide_sparse(
+    __global __read_only double *f_global,
+    __global __write_only double *f_new_global,
+    __global __read_only int *neighbours,
+    __global __write_only double *rho_global,
+    __global __write_only double *u_global,
+    __global __write_only double *v_global,
+    const double omega,
+    const double gx, const double gy,
+    const double cs,
+    const int num_fluid)
+{
+    /* Pull streaming, bounceback and a BGK collision with Guo forcing in one pass per fluid node. Across a boundary
+    link, the population that left the node towards the solid in the last step comes back reversed (halfway
+    bounceback). (gx, gy) is the body force per density, as in add_constant_body_force of the other runners. */
+    //Input should be a 1d workgroup over the fluid nodes.
+    const int node = get_global_id(0);
+
+    if (node < num_fluid){
+        double f[NUM_JUMPERS];
+        double rho = 0;
+        double mom_x = 0;
+        double mom_y = 0;
+
+        for(int jump_id=0; jump_id < NUM_JUMPERS; jump_id++){
+            const int source = neighbours[jump_id*num_fluid + node];
+            double cur_f;
+            if (source >= 0) cur_f = f_global[jump_id*num_fluid + source];
+            else cur_f = f_global[opposite_arr[jump_id]*num_fluid + node];
+
+            f[jump_id] = cur_f;
+            rho += cur_f;
+            mom_x += cx_arr[jump_id]*cur_f;
+            mom_y += cy_arr[jump_id]*cur_f;
+        }
+
+        // The velocity includes half of the force (Guo et al.)
+        const double u = mom_x/rho + gx/2.;
+        const double v = mom_y/rho + gy/2.;
+
+        rho_global[node] = rho;
+        u_global[node] = u;
+        v_global[node] = v;
+
+        const double cs2 = cs*cs;
+        const double u_squared = u*u + v*v;
+        const double u_dot_g = u*gx + v*gy;
+        const double force_prefactor = 1 - .5*omega;
+
+        for(int jump_id=0; jump_id < NUM_JUMPERS; jump_id++){
+            const double w = w_arr[jump_id];
+            const double c_dot_u = cx_arr[jump_id]*u + cy_arr[jump_id]*v;
+            const double c_dot_g = cx_arr[jump_id]*gx + cy_arr[jump_id]*gy;
+
+            const double feq = w*rho*(1 + c_dot_u/cs2 + c_dot_u*c_dot_u/(2*cs2*cs2) - u_squared/(2*cs2));
+            const double Fi = force_prefactor*w*rho*((c_dot_g - u_dot_g)/cs2 + c_dot_u*c_dot_g/(cs2*cs2));
+
+            f_new_global[jump_id*num_fluid + node] = f[jump_id]*(1 - omega) + omega*feq + Fi;
+        }
+    }
+}
+
+__kernel void
+link_momentum(
+    __global __read_only double *f_global,
+    __global __read_only int *link_nodes,
+    __global __read_only int *link_directions,
+    __global __write_only double *force_x_global,
+    __global __write_only double *force_y_global,
+    const int num_fluid,
+    const int num_links)
+{
+    /* Momentum exchange over the boundary links: the population opposite to the link direction leaves its node
+    towards the solid and comes back reversed, handing over 2*c*f. f must hold post-collision populations. */
+    const int link = get_global_id(0);
+
+    if (link < num_links){
+        const int node = link_nodes[link];
+        const int jump_id = link_directions[link];
+        const int opposite = opposite_arr[jump_id];
+
+        const double f = f_global[opposite*num_fluid + node];
+        force_x_global[link] = 2*cx_arr[opposite]*f;
+        force_y_global[link] = 2*cy_arr[opposite]*f;
+    }
+}
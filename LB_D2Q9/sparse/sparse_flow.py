@@ -0,0 +1,235 @@
+import numpy as np
+import os
+os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
+import pyopencl as cl
+import pyopencl.tools
+import pyopencl.array
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import geometry
+from LB_D2Q9 import memory_pool
+from LB_D2Q9 import obstacles
+
+# Get path to *this* file. Necessary when reading in opencl code.
+full_path = os.path.realpath(__file__)
+file_dir = os.path.dirname(full_path)
+parent_dir = os.path.dirname(file_dir)
+
+num_type = np.double
+int_type = np.int32
+
+NUM_JUMPERS = 9
+
+
+class Sparse_Flow(checkpoint.Checkpointable):
+    """
+    Flow through an obstacle geometry, i.e. an image of a porous medium, driven by a body force. Only the fluid nodes
+    are stored: each population streams through a precomputed neighbour table, and the fluid-solid boundary links
+    bounce back. Solid nodes cost neither memory nor work, which matters when most of the domain is solid. Fields are
+    scattered back onto the full (nx, ny) grid only when they are read with get_field.
+
+    Everything is in lattice units.
+    """
+
+    def __init__(self, obstacle_mask, viscosity=1./6., force=(0., 0.), periodic=(True, True), rho=1.,
+                 local_size=256, use_interop=False):
+        """
+        :param obstacle_mask: An (nx, ny) array that is nonzero on solid nodes, or a geometry.Rasterized_Geometry
+            built with the same periodicity, whose cached tables are then used as they are
+        :param viscosity: The lattice viscosity of the fluid
+        :param force: The driving body force per density (gx, gy)
+        :param periodic: A tuple (periodic in x, periodic in y). Non-periodic edges are solid walls.
+        :param rho: The initial density of the fluid at rest
+        :param local_size: The size of the 1d work groups over the fluid nodes
+        """
+        if isinstance(obstacle_mask, geometry.Rasterized_Geometry):
+            if obstacle_mask.periodic != tuple(bool(value) for value in periodic):
+                raise ValueError('The rasterized geometry was built for periodic=' + str(obstacle_mask.periodic))
+            self.nx = int_type(obstacle_mask.nx)
+            self.ny = int_type(obstacle_mask.ny)
+        else:
+            obstacle_mask = np.asarray(obstacle_mask)
+            self.nx = int_type(obstacle_mask.shape[0])
+            self.ny = int_type(obstacle_mask.shape[1])
+
+        self.cs = num_type(1. / np.sqrt(3))
+        self.viscosity = num_type(viscosity)
+        self.tau = num_type(.5 + self.viscosity / self.cs**2)
+        self.omega = num_type(self.tau ** -1.)
+        print 'omega', self.omega
+        assert self.omega < 2.
+
+        self.gx = num_type(force[0])
+        self.gy = num_type(force[1])
+        self.periodic = tuple(periodic)
+
+        # Indirect addressing: computed once on the host, or taken from the geometry cache
+        if isinstance(obstacle_mask, geometry.Rasterized_Geometry):
+            self.fluid_nodes = obstacle_mask.fluid_nodes
+            neighbours_host = obstacle_mask.neighbours
+        else:
+            self.fluid_nodes, neighbours_host = obstacles.get_fluid_node_tables(
+                obstacle_mask, obstacles.D2Q9_CX, obstacles.D2Q9_CY, periodic=self.periodic)
+        self.num_fluid = int_type(self.fluid_nodes.shape[0])
+        link_nodes_host, link_directions_host = obstacles.get_link_list(neighbours_host)
+        self.num_links = int_type(link_nodes_host.shape[0])
+
+        print 'Fluid nodes:', self.num_fluid, 'of', int(self.nx) * int(self.ny)
+        print 'Boundary links:', self.num_links
+
+        self.local_size = (local_size,)
+        self.global_size = (int(np.ceil(self.num_fluid / float(local_size))) * local_size,)
+        self.link_global_size = (max(1, int(np.ceil(self.num_links / float(local_size)))) * local_size,)
+
+        # Initialize the opencl environment
+        self.context = None     # The pyOpenCL context
+        self.queue = None       # The queue used to issue commands to the desired device
+        self.kernels = None     # Compiled OpenCL kernels
+        self.use_interop = use_interop
+        self.init_opencl()      # Initializes all items required to run OpenCL code
+        # Every cl.array of the runner, and so every temporary computed from them, draws from this shared pool
+        self.allocator = memory_pool.get_allocator(self.queue)
+
+        self.neighbours = cl.array.to_device(self.queue, neighbours_host.ravel(), allocator=self.allocator)
+        # The link list; at least one entry so that the buffers exist
+        if self.num_links == 0:
+            link_nodes_host = np.zeros(1, dtype=int_type)
+            link_directions_host = np.zeros(1, dtype=int_type)
+        self.link_nodes = cl.array.to_device(self.queue, link_nodes_host, allocator=self.allocator)
+        self.link_directions = cl.array.to_device(self.queue, link_directions_host, allocator=self.allocator)
+        self.link_force_x = cl.array.zeros(self.queue, link_nodes_host.shape, dtype=num_type,
+                                           allocator=self.allocator)
+        self.link_force_y = cl.array.zeros_like(self.link_force_x)
+
+        ## Initialize the fluid at rest: f = feq = w*rho
+        w = np.array([4. / 9., 1. / 9., 1. / 9., 1. / 9., 1. / 9., 1. / 36.,
+                      1. / 36., 1. / 36., 1. / 36.], dtype=num_type)
+        f_host = np.outer(w * rho, np.ones(self.num_fluid, dtype=num_type)).ravel()
+        self.f = cl.array.to_device(self.queue, f_host, allocator=self.allocator)
+        self.f_new = cl.array.empty_like(self.f) # Written by every step; the buffers are then swapped
+
+        self.rho = cl.array.to_device(self.queue, rho * np.ones(self.num_fluid, dtype=num_type),
+                                      allocator=self.allocator)
+        self.u = cl.array.zeros_like(self.rho)
+        self.v = cl.array.zeros_like(self.rho)
+
+        self.step_count = 0 # The number of steps taken; stored in checkpoints
+        self.checkpoint_fields = ['f', 'rho', 'u', 'v'] # Device fields saved by save_checkpoint
+
+    def init_opencl(self):
+        """
+        Initializes the base items needed to run OpenCL code.
+        """
+
+        # Startup script shamelessly taken from CS205 homework
+        platforms = cl.get_platforms()
+        print 'The platforms detected are:'
+        print '---------------------------'
+        for platform in platforms:
+            print platform.name, platform.vendor, 'version:', platform.version
+
+        # List devices in each platform
+        for platform in platforms:
+            print 'The devices detected on platform', platform.name, 'are:'
+            print '---------------------------'
+            for device in platform.get_devices():
+                print device.name, '[Type:', cl.device_type.to_string(device.type), ']'
+                print 'Maximum clock Frequency:', device.max_clock_frequency, 'MHz'
+                print 'Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB'
+                print 'Maximum work group size', device.max_work_group_size
+                print 'Maximum work item dimensions', device.max_work_item_dimensions
+                print 'Maximum work item size', device.max_work_item_sizes
+                print '---------------------------'
+
+        # Create a context with all the devices
+        devices = platforms[0].get_devices()
+        if not self.use_interop:
+            self.context = cl.Context(devices)
+        else:
+            self.context = cl.Context(properties=[(cl.context_properties.PLATFORM, platforms[0])]
+                                                 + cl.tools.get_gl_sharing_context_properties(),
+                                      devices= devices)
+        print 'This context is associated with ', len(self.context.devices), 'devices'
+
+        # Create a simple queue
+        self.queue = cl.CommandQueue(self.context, self.context.devices[0],
+                                     properties=cl.command_queue_properties.PROFILING_ENABLE)
+        # Compile our OpenCL code
+        self.kernels = cl.Program(self.context, open(file_dir + '/sparse_flow.cl').read()).build(options='')
+
+    def run(self, num_iterations):
+        """
+        Run the simulation for num_iterations.
+
+        :param num_iterations: The number of iterations to run
+        """
+        for cur_iteration in range(num_iterations):
+            self.kernels.stream_collide_sparse(
+                self.queue, self.global_size, self.local_size,
+                self.f.data, self.f_new.data,
+                self.neighbours.data,
+                self.rho.data, self.u.data, self.v.data,
+                self.omega, self.gx, self.gy, self.cs,
+                self.num_fluid
+            ).wait()
+
+            self.f, self.f_new = self.f_new, self.f
+
+            self.step_count += 1
+            self.allocator.end_step()
+
+    def get_obstacle_force(self):
+        """
+        :return: The total force (Fx, Fy) the fluid exerts on the obstacles and walls, from momentum exchange over the
+            boundary links. Reduced on the device.
+        """
+        if self.num_links == 0:
+            return np.zeros(2, dtype=num_type)
+
+        self.kernels.link_momentum(
+            self.queue, self.link_global_size, self.local_size,
+            self.f.data,
+            self.link_nodes.data, self.link_directions.data,
+            self.link_force_x.data, self.link_force_y.data,
+            self.num_fluid, self.num_links
+        ).wait()
+
+        return np.array([cl.array.sum(self.link_force_x).get(), cl.array.sum(self.link_force_y).get()])
+
+    def scatter(self, sparse_values, fill=0):
+        """
+        Places values of the fluid nodes onto the full grid.
+
+        :param sparse_values: A host array whose first axis runs over the fluid nodes
+        :param fill: The value of the solid nodes
+        :return: A Fortran ordered (nx, ny, ...) array
+        """
+        trailing_shape = sparse_values.shape[1:]
+        dense = np.empty((self.nx * self.ny,) + trailing_shape, dtype=sparse_values.dtype)
+        dense[...] = fill
+        dense[self.fluid_nodes] = sparse_values
+        return np.asfortranarray(dense.reshape((self.nx, self.ny) + trailing_shape, order='F'))
+
+    def get_field(self, name, fill=0):
+        """
+        Transfers one field of the fluid nodes from the device and scatters it onto the full grid.
+
+        :param name: 'f', 'rho', 'u' or 'v'
+        :param fill: The value of the solid nodes
+        :return: A Fortran ordered (nx, ny) array, or (nx, ny, 9) for f.
+        """
+        if name == 'f':
+            sparse_values = self.f.get().reshape((NUM_JUMPERS, self.num_fluid)).T
+        elif name in ('rho', 'u', 'v'):
+            sparse_values = getattr(self, name).get()
+        else:
+            raise ValueError('Unknown field ' + str(name) + ". Choose one of ['f', 'rho', 'u', 'v']")
+        return self.scatter(sparse_values, fill=fill)
+
+    def get_fields(self):
+        """
+        :return: Returns a dictionary of rho, u and v on the full grid.
+        """
+        results = {}
+        for name in ['rho', 'u', 'v']:
+            results[name] = self.get_field(name)
+        return results
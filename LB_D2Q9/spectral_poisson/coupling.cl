@@ -0,0 +1,68 @@
+// Moves data between a runner's fields and the float32 buffers of Screened_Poisson without temporaries. Compiled
+// with -D NUM_TYPE=float or -D NUM_TYPE=double (plus -D USE_DOUBLE) to match the precision of the runner.
+// Runner fields are (nx, ny, num_fields) in Fortran order, i.e. index = field*nx*ny + y*nx + x.
+
+#ifdef USE_DOUBLE
+    #ifdef cl_khr_fp64
+        #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    #elif defined(cl_amd_fp64)
+        #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+    #else
+        #error "Double precision floating point not supported by OpenCL implementation."
+    #endif
+#endif
+
+__kernel void
+pack_density(__global __read_only NUM_TYPE *rho,
+             __global __write_only float *charge,
+             const int field_index,
+             const int nx, const int ny)
+{
+    // Copies (and converts) one population of rho into the charge of the solver.
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        charge[two_d_index] = (float)rho[field_index*nx*ny + two_d_index];
+    }
+}
+
+__kernel void
+unpack_gradients(__global __read_only float *grad_fields,
+                 __global __read_only float *previous_grad_fields,
+                 __global NUM_TYPE *out_x,
+                 __global NUM_TYPE *out_y,
+                 const NUM_TYPE scale,
+                 const float extrapolation,
+                 const int field_index,
+                 const int accumulate,
+                 const int nx, const int ny)
+{
+    // Writes (or, if accumulate, adds) scale times the x and y gradient into one field of out_x and out_y. The
+    // gradients are linearly extrapolated from the previous solve by grad + extrapolation*(grad - previous).
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx) && (y < ny)){
+        const int two_d_index = y*nx + x;
+        const int out_index = field_index*nx*ny + two_d_index;
+
+        const float cur_x = grad_fields[two_d_index];
+        const float cur_y = grad_fields[nx*ny + two_d_index];
+        const float prev_x = previous_grad_fields[two_d_index];
+        const float prev_y = previous_grad_fields[nx*ny + two_d_index];
+
+        const NUM_TYPE grad_x = scale*(cur_x + extrapolation*(cur_x - prev_x));
+        const NUM_TYPE grad_y = scale*(cur_y + extrapolation*(cur_y - prev_y));
+
+        if (accumulate == 1){
+            out_x[out_index] += grad_x;
+            out_y[out_index] += grad_y;
+        }
+        else{
+            out_x[out_index] = grad_x;
+            out_y[out_index] = grad_y;
+        }
+    }
+}
@@ -0,0 +1,90 @@
+"""
+Host (CPU) FFTs for Screened_Poisson, used when gpyfft/clFFT is not available.
+
+The density is real, so only the half spectrum of a real-to-complex transform is computed. Both gradient fields are
+obtained from one batched complex-to-real inverse transform. If scipy.fft is available its threaded pocketfft is used;
+otherwise numpy.fft. Both cache their plans internally, so only the first transform of a given size pays for planning.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+
+try:
+    import scipy.fft as fft_module
+    SUPPORTS_WORKERS = True
+except ImportError:
+    import numpy.fft as fft_module
+    SUPPORTS_WORKERS = False
+
+
+def is_cpu_device(queue):
+    """:return: True if the queue's device is a CPU, i.e. mapping its buffers does not require a copy."""
+    return bool(queue.device.type & cl.device_type.CPU)
+
+
+def map_array(queue, array, flags):
+    """Maps a Fortran ordered cl.array into host memory. Release it with unmap_array."""
+    host, _ = cl.enqueue_map_buffer(queue, array.data, flags, 0, array.shape, array.dtype,
+                                    order='F', is_blocking=True)
+    return host
+
+
+def unmap_array(queue, host):
+    host.base.release(queue)
+
+
+class Host_FFT(object):
+    """
+    Screened Poisson solve and spectral gradients of a real (nx, ny) field on the host. Uses the same half spectrum
+    layout as the device transforms: x, the fastest varying axis of Fortran ordered fields, is the halved axis.
+    """
+
+    def __init__(self, freq_x, freq_y, grad_freq_x, grad_freq_y, lam=1., num_threads=None):
+        """
+        :param freq_x: The nx//2 + 1 frequencies of the halved x axis
+        :param freq_y: The ny frequencies of the y axis
+        :param grad_freq_x: The multipliers (without the factor i) of the x gradient, per x frequency
+        :param grad_freq_y: The multipliers (without the factor i) of the y gradient, per y frequency
+        :param lam: The screening length
+        :param num_threads: Threads used by each transform when scipy.fft is available. None uses every core.
+        """
+        self.nx_half = len(freq_x)
+        self.ny = len(freq_y)
+        self.nx = None # Set by the first transform, as nx_half does not determine whether nx is odd
+
+        self.fft_kwargs = {}
+        if SUPPORTS_WORKERS:
+            self.fft_kwargs['workers'] = -1 if num_threads is None else int(num_threads)
+
+        freq_Y, freq_X = np.meshgrid(freq_y, freq_x)
+        self.screening = np.asfortranarray(1./(lam**2*(freq_X**2 + freq_Y**2) + 1.), dtype=np.float32)
+
+        half_shape = (self.nx_half, self.ny)
+        self.gradient_multipliers = np.empty(half_shape + (2,), dtype=np.complex64, order='F')
+        self.gradient_multipliers[:, :, 0] = 1.0j*grad_freq_x[:, np.newaxis]
+        self.gradient_multipliers[:, :, 1] = 1.0j*grad_freq_y[np.newaxis, :]
+
+        # Work arrays, allocated once
+        self.spectrum = None
+        self.gradient_spectra = np.empty(half_shape + (2,), dtype=np.complex64, order='F')
+
+    def fft_and_screen(self, density):
+        """Transforms the real (nx, ny) density and screens it. The result is kept in self.spectrum."""
+        self.nx = density.shape[0]
+        # Listing x last makes it the halved axis
+        self.spectrum = fft_module.rfft2(density, axes=(1, 0), **self.fft_kwargs).astype(np.complex64, copy=False)
+        self.spectrum *= self.screening
+
+    def inverse_fft(self):
+        """:return: The screened density in real space."""
+        return fft_module.irfft2(self.spectrum, s=(self.ny, self.nx), axes=(1, 0), **self.fft_kwargs)
+
+    def get_grad_fields(self):
+        """
+        Requires fft_and_screen to have been run first.
+
+        :return: A (nx, ny, 2) array holding the x and y gradient of the screened density.
+        """
+        np.multiply(self.gradient_multipliers, self.spectrum[:, :, np.newaxis], out=self.gradient_spectra)
+        return fft_module.irfft2(self.gradient_spectra, s=(self.ny, self.nx), axes=(1, 0), **self.fft_kwargs)
@@ -0,0 +1,154 @@
+"""
+Decides when a runner coupled to Screened_Poisson has to re-solve.
+
+The density driving the screened poisson field usually changes little from one LB step to the next, while the FFTs
+are the most expensive part of a step. A Resolve_Schedule re-solves at most every interval steps and, with a
+tolerance, also as soon as the relative (L1) change of the density since the last solve exceeds it. That change is
+measured on the device at the end of every update and copied back without blocking; the next update reads it, by
+which time a whole step has run and the copy is done. A tolerance solve is therefore triggered one step after the
+change crossed it. Between solves the last gradients are reused or, with extrapolate, linearly extrapolated from
+the last two solves.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+import pyopencl.reduction
+from LB_D2Q9 import checkpoint
+
+
+class Resolve_Schedule(checkpoint.Checkpointable):
+    """
+    Holds no device fields; the steps of the last solves are saved with the checkpoints of the runner.
+    """
+
+    def __init__(self, solver, interval=1, tolerance=None, extrapolate=False):
+        """
+        :param solver: The Screened_Poisson to drive. Must have had create_grad_fields called.
+        :param interval: The maximum number of steps between solves. None only re-solves on the tolerance.
+        :param tolerance: If not None, re-solve once sum|rho - rho_last_solve| / sum|rho_last_solve| exceeds it. The
+            change is read one step late, so the queue never waits on it.
+        :param extrapolate: If True, the gradients between solves are linearly extrapolated from the last two solves.
+        """
+        if interval is None and tolerance is None:
+            raise ValueError('Either a resolve interval or a resolve tolerance is required.')
+        if interval is not None and interval < 1:
+            raise ValueError('The resolve interval must be at least one step.')
+
+        self.solver = solver
+        self.interval = interval
+        self.tolerance = tolerance
+        self.extrapolate = extrapolate
+
+        self.last_solve_step = None
+        self.previous_solve_step = None
+        self.num_solves = 0
+
+        self.change_kernels = {} # Per floating point type of the density
+        self.pending_change = None # (event, host result, device result) of the change measured by the last update
+
+    def reset(self):
+        """Forces a solve on the next update, i.e. after a new initial condition."""
+        self.last_solve_step = None
+        self.previous_solve_step = None
+        self.pending_change = None
+
+    def get_checkpoint_state(self):
+        state = {'last_solve_step': self.last_solve_step, 'previous_solve_step': self.previous_solve_step,
+                 'num_solves': self.num_solves, 'pending_change': None}
+        if self.pending_change is not None:
+            event, host_result, result = self.pending_change
+            if event is not None:
+                event.wait()
+            state['pending_change'] = [float(host_result[0]['x']), float(host_result[0]['y'])]
+        return state
+
+    def set_checkpoint_state(self, state):
+        self.last_solve_step = state.get('last_solve_step')
+        self.previous_solve_step = state.get('previous_solve_step')
+        self.num_solves = state.get('num_solves', 0)
+        self.pending_change = None
+        if state.get('pending_change') is not None:
+            host_result = np.empty(1, dtype=cl.array.vec.float2)
+            host_result[0]['x'], host_result[0]['y'] = state['pending_change']
+            self.pending_change = (None, host_result, None)
+
+    def get_change_kernel(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self.change_kernels:
+            if dtype == np.float64:
+                c_type = 'double'
+            elif dtype == np.float32:
+                c_type = 'float'
+            else:
+                raise ValueError('Densities of type ' + str(dtype) + ' are not supported.')
+            # The charge of the solver still holds the density of the last solve
+            self.change_kernels[dtype] = cl.reduction.ReductionKernel(
+                self.solver.context, cl.array.vec.float2,
+                neutral="(float2)(0, 0)",
+                reduce_expr="a+b",
+                map_expr="(float2)(fabs((float)rho[offset + i] - charge[i]), fabs(charge[i]))",
+                arguments="__global float *charge, __global " + c_type + " *rho, const int offset")
+        return self.change_kernels[dtype]
+
+    def measure_change(self, density, field_index=0):
+        """
+        Enqueues the measurement of the relative L1 change of one population of density since the last solve, and a
+        non-blocking copy of the result to the host. read_change returns it.
+        """
+        num_nodes = int(self.solver.nx) * int(self.solver.ny)
+        kernel = self.get_change_kernel(density.dtype)
+        result = kernel(self.solver.charge, density, np.int32(field_index*num_nodes), queue=self.solver.queue)
+        host_result = np.empty(1, dtype=cl.array.vec.float2)
+        event = cl.enqueue_copy(self.solver.queue, host_result, result.data, is_blocking=False)
+        self.pending_change = (event, host_result, result) # Keeps result alive until the copy is done
+
+    def read_change(self):
+        """:return: The change enqueued by the last measure_change, or None if nothing was measured since."""
+        if self.pending_change is None:
+            return None
+        event, host_result, result = self.pending_change
+        if event is not None:
+            event.wait()
+        self.pending_change = None
+        return host_result[0]['x'] / max(host_result[0]['y'], np.finfo(np.float32).tiny)
+
+    def get_relative_change(self, density, field_index=0):
+        """:return: The relative L1 change of one population of density since the last solve. Blocks."""
+        self.measure_change(density, field_index)
+        return self.read_change()
+
+    def needs_solve(self, step):
+        if self.last_solve_step is None:
+            return True
+        if self.interval is not None and step - self.last_solve_step >= self.interval:
+            return True
+        if self.tolerance is not None:
+            change = self.read_change()
+            if change is not None and change > self.tolerance:
+                return True
+        return False
+
+    def update(self, density, step, field_index=0):
+        """
+        Re-solves with one population of density if required.
+
+        :return: The extrapolation factor to pass to Screened_Poisson.unpack_grad_fields.
+        """
+        if self.needs_solve(step):
+            if self.extrapolate and self.last_solve_step is not None:
+                self.solver.store_grad_fields()
+                self.previous_solve_step = self.last_solve_step
+            self.solver.pack_charge(density, field_index=field_index)
+            self.solver.solve_and_update_grad_fields()
+            self.last_solve_step = step
+            self.num_solves += 1
+            self.pending_change = None # Measured against the charge of the previous solve
+            return 0.
+
+        if self.tolerance is not None:
+            self.measure_change(density, field_index)
+
+        if self.extrapolate and self.previous_solve_step is not None:
+            return float(step - self.last_solve_step) / (self.last_solve_step - self.previous_solve_step)
+        return 0.
@@ -0,0 +1,37 @@
+// Spectral screened poisson solve on the half spectrum of a real-to-complex transform.
+// The half spectrum is (nx_half, ny) complex values stored as index = y*nx_half + x; the gradient spectra hold the
+// x gradient followed by the y gradient.
+
+__kernel void
+screen_and_differentiate(__global float2 *spectrum,
+                         __global float2 *grad_spectra,
+                         __global __read_only float *freq_x,
+                         __global __read_only float *freq_y,
+                         __global __read_only float *grad_freq_x,
+                         __global __read_only float *grad_freq_y,
+                         const float lam2,
+                         const int screen, const int differentiate,
+                         const int nx_half, const int ny)
+{
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((x < nx_half) && (y < ny)){
+        const int two_d_index = y*nx_half + x;
+
+        float2 value = spectrum[two_d_index];
+        if (screen == 1){
+            const float kx = freq_x[x];
+            const float ky = freq_y[y];
+            value /= lam2*(kx*kx + ky*ky) + 1.0f;
+            spectrum[two_d_index] = value;
+        }
+
+        if (differentiate == 1){
+            // Multiplying by i*k rotates (re, im) into (-im, re)
+            const float2 i_value = (float2)(-value.y, value.x);
+            grad_spectra[two_d_index] = grad_freq_x[x]*i_value;
+            grad_spectra[nx_half*ny + two_d_index] = grad_freq_y[y]*i_value;
+        }
+    }
+}
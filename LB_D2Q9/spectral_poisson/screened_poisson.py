@@ -1,92 +1,315 @@
+import os
 import pyopencl as cl
 import pyopencl.array
-import gpyfft as gfft
 import numpy as np
 import matplotlib.pyplot as plt
-
-class Screened_Poisson(object):
-    def __init__(self, charge_cpu, cl_context=None, cl_queue=None, lam=1., dx=1.):
+from LB_D2Q9 import checkpoint
+from LB_D2Q9 import memory_pool
+from LB_D2Q9.spectral_poisson import host_fft
+
+# The gpyfft backend needs gpyfft >= 0.7, the first release whose FFT takes out_array= and real=. A real plan is
+# real to complex if its input is real and complex to real if its input is complex, so each direction has its own plan.
+try:
+    import gpyfft as gfft
+except ImportError:
+    gfft = None
+
+# Get path to *this* file. Necessary when reading in opencl code.
+full_path = os.path.realpath(__file__)
+file_dir = os.path.dirname(full_path)
+
+FFT_BACKENDS = ['auto', 'gpyfft', 'numpy']
+
+
+def get_divisible_global(global_size, local_size):
+    """
+    Given a desired global size and a specified local size, return the smallest global
+    size that the local size fits into. Required when specifying arbitrary local
+    workgroup sizes.
+
+    :param global_size: A tuple of the global size, i.e. (x, y, z)
+    :param local_size:  A tuple of the local size, i.e. (lx, ly, lz)
+    :return: The smallest global size that the local size fits into.
+    """
+    new_size = []
+    for cur_global, cur_local in zip(global_size, local_size):
+        remainder = cur_global % cur_local
+        if remainder == 0:
+            new_size.append(cur_global)
+        else:
+            new_size.append(cur_global + cur_local - remainder)
+    return tuple(new_size)
+
+
+class Screened_Poisson(checkpoint.Checkpointable):
+    """
+    Solves the screened poisson equation with periodic boundaries with real-to-complex FFTs. The charge is a real
+    (nx, ny) field. As it is stored in Fortran order, x is the fastest varying axis and the spectrum is the half
+    spectrum of shape (nx//2 + 1, ny). Both gradients are stored in grad_fields, of shape (nx, ny, 2);
+    xgrad and ygrad are views of its two slices.
+
+    A runner that owns a solver saves its charge (the density of the last solve) and gradients in its checkpoints.
+    """
+
+    checkpoint_fields = ['charge', 'grad_fields', 'previous_grad_fields']
+
+    def __init__(self, charge_cpu, cl_context=None, cl_queue=None, lam=1., dx=1., fft_backend='auto',
+                 num_threads=None, two_d_local_size=(32, 32), allocator=None):
+        """
+        :param fft_backend: 'gpyfft' runs the transforms on the device with clFFT (requires gpyfft >= 0.7). 'numpy'
+            runs them on the host with (threaded, if scipy.fft is available) pocketfft. 'auto' uses gpyfft if it is
+            installed.
+        :param num_threads: The number of threads of the numpy backend. None uses every core.
+        :param allocator: The allocator of the device arrays. None uses the memory pool shared by the context.
+        """
         self.context = cl_context
         self.queue = cl_queue
 
         if self.context is None:
             self.create_context_and_queue()
 
-        charge_cpu = charge_cpu.astype(np.complex64, order='F')
-        self.charge = cl.array.to_device(self.queue, charge_cpu)
+        self.allocator = allocator
+        if self.allocator is None:
+            self.allocator = memory_pool.get_allocator(self.queue)
+
+        if fft_backend not in FFT_BACKENDS:
+            raise ValueError('Unknown fft backend ' + str(fft_backend) + '. Choose one of ' + str(FFT_BACKENDS))
+        if fft_backend == 'auto':
+            fft_backend = 'numpy' if gfft is None else 'gpyfft'
+        if fft_backend == 'gpyfft' and gfft is None:
+            raise ImportError('gpyfft is not installed. Use fft_backend=\'numpy\' instead.')
+        self.fft_backend = fft_backend
 
-        self.transform = gfft.fft.FFT(self.context, self.queue, (self.charge,), axes=(0, 1))
+        charge_cpu = charge_cpu.astype(np.float32, order='F')
+        self.charge = cl.array.to_device(self.queue, charge_cpu, allocator=self.allocator)
 
         self.lam = lam # Interaction length lambda
         self.dx = dx # Spatial scale
 
-        Lx = self.dx * charge_cpu.shape[0]
-        Ly = self.dx * charge_cpu.shape[1]
-
-        freq_x = Lx * np.fft.fftfreq(charge_cpu.shape[0], d=dx)
-        freq_y = Ly * np.fft.fftfreq(charge_cpu.shape[1], d=dx)
-
-        freq_Y_cpu, freq_X_cpu = np.meshgrid(freq_y, freq_x)
-
-        freq_Y_cpu = np.asfortranarray(freq_Y_cpu)
-        freq_X_cpu = np.asfortranarray(freq_X_cpu)
-        # Calculate the rescaling on the CPU, as it only has to be done once.
-
-        self.freq_X = cl.array.to_device(self.queue, freq_X_cpu)
-        self.freq_Y = cl.array.to_device(self.queue, freq_Y_cpu)
-
-        self.rescaling = 1./(self.lam**2*(self.freq_X**2 + self.freq_Y**2) + 1.)
-
+        self.nx = np.int32(charge_cpu.shape[0])
+        self.ny = np.int32(charge_cpu.shape[1])
+        self.nx_half = np.int32(self.nx//2 + 1) # Length of the halved axis of the spectrum
+
+        Lx = self.dx * self.nx
+        Ly = self.dx * self.ny
+
+        # Frequencies of the half spectrum
+        freq_x = Lx * np.fft.rfftfreq(self.nx, d=dx)
+        freq_y = Ly * np.fft.fftfreq(self.ny, d=dx)
+
+        # Gradient multipliers (without the factor i). The Nyquist modes of even axes have no sign, so their
+        # derivative is dropped; this is what taking .real of a complex inverse transform did.
+        grad_freq_x = 2*np.pi*freq_x
+        grad_freq_y = 2*np.pi*freq_y
+        if self.nx % 2 == 0:
+            grad_freq_x[-1] = 0
+        if self.ny % 2 == 0:
+            grad_freq_y[self.ny//2] = 0
+
+        self.freq_x = freq_x.astype(np.float32)
+        self.freq_y = freq_y.astype(np.float32)
+        self.grad_freq_x = grad_freq_x.astype(np.float32)
+        self.grad_freq_y = grad_freq_y.astype(np.float32)
+
+        self.spectrum = None
+        self.grad_spectra = None
+        self.grad_fields = None
+        self.previous_grad_fields = None # The gradients of the previous solve; see store_grad_fields
         self.xgrad = None
         self.ygrad = None
 
-        self.xgrad_transform = None
-        self.ygrad_transform = None
-
-        self.xgrad_rescale = None
-        self.ygrad_rescale = None
+        self.transform = None # Real to complex: charge -> spectrum
+        self.inverse_transform = None # Complex to real: spectrum -> charge
+        self.grad_transform = None # Complex to real: grad_spectra -> grad_fields
+        self.host_fft = None
+        self.map_buffers = False
+
+        self.two_d_local_size = two_d_local_size
+        self.coupling_programs = {} # Pack/unpack kernels, per floating point type of the runner
+
+        if self.fft_backend == 'numpy':
+            self.host_fft = host_fft.Host_FFT(self.freq_x, self.freq_y, self.grad_freq_x, self.grad_freq_y,
+                                              lam=self.lam, num_threads=num_threads)
+            # On a CPU device, mapping a buffer exposes its memory directly; otherwise copy through host arrays.
+            self.map_buffers = host_fft.is_cpu_device(self.queue)
+            self.charge_host = charge_cpu
+            self.grad_fields_host = None
+        else:
+            self.two_d_global_size = get_divisible_global((self.nx_half, self.ny), self.two_d_local_size)
+            self.kernels = cl.Program(self.context, open(file_dir + '/screened_poisson.cl').read()).build(options='')
+
+            self.spectrum = cl.array.empty(self.queue, (self.nx_half, self.ny), dtype=np.complex64, order='F',
+                                           allocator=self.allocator)
+            self.transform = gfft.fft.FFT(self.context, self.queue, self.charge, out_array=self.spectrum,
+                                          axes=(0, 1), real=True)
+            # A real to complex plan can not be run backwards; the inverse needs its own complex to real plan.
+            self.inverse_transform = gfft.fft.FFT(self.context, self.queue, self.spectrum, out_array=self.charge,
+                                                  axes=(0, 1), real=True)
+
+            self.freq_x_device = cl.array.to_device(self.queue, self.freq_x, allocator=self.allocator)
+            self.freq_y_device = cl.array.to_device(self.queue, self.freq_y, allocator=self.allocator)
+            self.grad_freq_x_device = cl.array.to_device(self.queue, self.grad_freq_x, allocator=self.allocator)
+            self.grad_freq_y_device = cl.array.to_device(self.queue, self.grad_freq_y, allocator=self.allocator)
 
     def fft_and_screen(self):
-
-        event, = self.transform.enqueue()
-        event.wait()
-
-        self.charge *= self.rescaling
+        if self.host_fft is not None:
+            # The screened spectrum is kept on the host, in self.host_fft.spectrum
+            if self.map_buffers:
+                charge_host = host_fft.map_array(self.queue, self.charge, cl.map_flags.READ)
+                self.host_fft.fft_and_screen(charge_host)
+                host_fft.unmap_array(self.queue, charge_host)
+            else:
+                self.charge.get(ary=self.charge_host)
+                self.host_fft.fft_and_screen(self.charge_host)
+            return
+
+        # Not waited on; the in-order queue keeps the transforms and kernels in sequence.
+        self.transform.enqueue()
+        self.screen_and_differentiate(differentiate=False)
 
     def inverse_fft(self):
-        event, = self.transform.enqueue(forward=False)
-        event.wait()
+        """Transforms the screened spectrum back into charge."""
+        if self.host_fft is not None:
+            self.write_to_device(self.charge, self.host_fft.inverse_fft())
+            return
+
+        self.inverse_transform.enqueue(forward=False)
+
+    def screen_and_differentiate(self, screen=True, differentiate=True):
+        """
+        One pass over the half spectrum. If screen, the spectrum is screened in place; if differentiate, the spectra
+        of both gradients are written into grad_spectra.
+        """
+        if differentiate:
+            grad_spectra = self.grad_spectra.data
+        else:
+            grad_spectra = self.spectrum.data # Not written to
+
+        self.kernels.screen_and_differentiate(self.queue, self.two_d_global_size, self.two_d_local_size,
+                                              self.spectrum.data, grad_spectra,
+                                              self.freq_x_device.data, self.freq_y_device.data,
+                                              self.grad_freq_x_device.data, self.grad_freq_y_device.data,
+                                              np.float32(self.lam**2), np.int32(screen), np.int32(differentiate),
+                                              self.nx_half, self.ny)
 
     def create_grad_fields(self):
+        self.grad_fields = cl.array.zeros(self.queue, (self.nx, self.ny, 2), dtype=np.float32, order='F',
+                                          allocator=self.allocator)
+        self.xgrad = self.grad_fields[:, :, 0]
+        self.ygrad = self.grad_fields[:, :, 1]
 
-        self.xgrad = self.charge.copy()
-        self.ygrad = self.charge.copy()
-
-        self.xgrad_transform = gfft.fft.FFT(self.context, self.queue, (self.xgrad,), axes=(0, 1))
-        self.ygrad_transform = gfft.fft.FFT(self.context, self.queue, (self.ygrad,), axes=(0, 1))
-
-        self.xgrad_rescale = 2*np.pi * 1.0j*self.freq_X
-        self.ygrad_rescale = 2*np.pi * 1.0j*self.freq_Y
+        if self.host_fft is not None:
+            self.grad_fields_host = np.zeros((self.nx, self.ny, 2), dtype=np.float32, order='F')
+            return
 
+        self.grad_spectra = cl.array.empty(self.queue, (self.nx_half, self.ny, 2), dtype=np.complex64, order='F',
+                                           allocator=self.allocator)
+        # One batched complex-to-real transform returns both gradients
+        self.grad_transform = gfft.fft.FFT(self.context, self.queue, self.grad_spectra, out_array=self.grad_fields,
+                                           axes=(0, 1), real=True)
 
     def update_grad_fields(self):
         """Requires fft to have been run first"""
 
-        cl.enqueue_copy(self.queue, self.xgrad.data, self.charge.data)
-        cl.enqueue_copy(self.queue, self.ygrad.data, self.charge.data)
-
-        self.xgrad *= self.xgrad_rescale
-        self.ygrad *= self.ygrad_rescale
-
-        event, = self.xgrad_transform.enqueue(forward=False)
-        event.wait()
-        event, = self.ygrad_transform.enqueue(forward=False)
-        event.wait()
+        if self.host_fft is not None:
+            # Both gradients come out of one batched inverse transform
+            self.write_to_device(self.grad_fields, self.host_fft.get_grad_fields(), self.grad_fields_host)
+            return
+
+        self.screen_and_differentiate(screen=False)
+        self.grad_transform.enqueue(forward=False)
+
+    def write_to_device(self, device_array, host_field, staging=None):
+        """Writes a host field into a device array, through a mapping on CPU devices or a staging array otherwise."""
+        if self.map_buffers:
+            mapped = host_fft.map_array(self.queue, device_array, cl.map_flags.WRITE)
+            mapped[...] = host_field
+            host_fft.unmap_array(self.queue, mapped)
+        else:
+            if staging is None:
+                staging = self.charge_host
+            staging[...] = host_field
+            device_array.set(staging)
+
+    def get_coupling_program(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self.coupling_programs:
+            if dtype == np.float64:
+                options = '-D NUM_TYPE=double -D USE_DOUBLE'
+            elif dtype == np.float32:
+                options = '-D NUM_TYPE=float'
+            else:
+                raise ValueError('Fields of type ' + str(dtype) + ' can not be coupled to the solver.')
+            self.coupling_programs[dtype] = cl.Program(self.context,
+                                                       open(file_dir + '/coupling.cl').read()).build(options=options)
+        return self.coupling_programs[dtype]
+
+    def pack_charge(self, density, field_index=0):
+        """
+        Copies one population of a runner's density straight into charge, converting it to float32 on the way.
+
+        :param density: A Fortran ordered (nx, ny) or (nx, ny, num_populations) cl.array of float32 or float64.
+        :param field_index: The population to use as the charge.
+        """
+        program = self.get_coupling_program(density.dtype)
+        program.pack_density(self.queue, get_divisible_global((self.nx, self.ny), self.two_d_local_size),
+                             self.two_d_local_size,
+                             density.data, self.charge.data, np.int32(field_index),
+                             self.nx, self.ny)
+
+    def get_checkpoint_state(self):
+        return {'has_previous_grad_fields': self.previous_grad_fields is not None}
+
+    def set_checkpoint_state(self, state):
+        if state.get('has_previous_grad_fields') and self.previous_grad_fields is None:
+            self.previous_grad_fields = self.grad_fields.copy() # Overwritten by the checkpoint
+
+    def store_grad_fields(self):
+        """Keeps a copy of the current gradients, to extrapolate from in unpack_grad_fields."""
+        if self.previous_grad_fields is None:
+            self.previous_grad_fields = self.grad_fields.copy()
+        else:
+            cl.enqueue_copy(self.queue, self.previous_grad_fields.data, self.grad_fields.data)
+
+    def unpack_grad_fields(self, out_x, out_y, scale=1., field_index=0, accumulate=False, extrapolation=0.):
+        """
+        Writes scale times the gradients into one field of out_x and out_y, i.e. into a runner's force or velocity.
+        Requires update_grad_fields to have been run first.
+
+        :param out_x: A Fortran ordered (nx, ny) or (nx, ny, num_fields) cl.array of float32 or float64.
+        :param out_y: Same as out_x, for the y gradient.
+        :param scale: The factor multiplying the gradients.
+        :param field_index: The field of out_x and out_y to write to.
+        :param accumulate: If True, the scaled gradients are added to out_x and out_y instead of overwriting them.
+        :param extrapolation: Uses grad + extrapolation*(grad - previous grad) instead of the gradients; requires
+            store_grad_fields to have been called before the last solve if nonzero.
+        """
+        if extrapolation != 0:
+            previous_grad_fields = self.previous_grad_fields
+        else:
+            previous_grad_fields = self.grad_fields
+
+        program = self.get_coupling_program(out_x.dtype)
+        program.unpack_gradients(self.queue, get_divisible_global((self.nx, self.ny), self.two_d_local_size),
+                                 self.two_d_local_size,
+                                 self.grad_fields.data, previous_grad_fields.data, out_x.data, out_y.data,
+                                 out_x.dtype.type(scale), np.float32(extrapolation),
+                                 np.int32(field_index), np.int32(accumulate),
+                                 self.nx, self.ny)
 
     def solve_and_update_grad_fields(self):
-        """Run this to solve the screened poisson equation and get the gradient fields (what we usually need)"""
-        self.fft_and_screen()
-        self.update_grad_fields()
+        """
+        Run this to solve the screened poisson equation and get the gradient fields (what we usually need). Screening
+        and both gradient multipliers are applied in a single pass over the spectrum.
+        """
+        if self.host_fft is not None:
+            self.fft_and_screen()
+            self.update_grad_fields()
+            return
+
+        self.transform.enqueue()
+        self.screen_and_differentiate()
+        self.grad_transform.enqueue(forward=False)
 
     def create_context_and_queue(self):
         # Startup script shamelessly taken from CS205 homework
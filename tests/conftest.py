@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def opencl():
+    """Skips a test when pyopencl or an OpenCL platform is not available."""
+    cl = pytest.importorskip('pyopencl')
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        platforms = []
+    if len(platforms) == 0:
+        pytest.skip('No OpenCL platform available.')
+    return cl
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import checkpoint
+
+
+class Owner(object):
+    pass
+
+
+def test_field_layout_is_page_aligned():
+    offsets, total = checkpoint.get_field_layout([1, checkpoint.ALIGNMENT, checkpoint.ALIGNMENT + 1, 0])
+    assert offsets == [0, checkpoint.ALIGNMENT, 2*checkpoint.ALIGNMENT, 4*checkpoint.ALIGNMENT]
+    assert total == 4*checkpoint.ALIGNMENT
+
+
+def test_header_round_trip(tmpdir):
+    path = str(tmpdir.join('header.ckpt'))
+    header = {'step': 12, 'fields': [{'name': 'f', 'offset': 0, 'nbytes': 8}], 'state': {'next_check': 40}}
+    with open(path, 'wb') as checkpoint_file:
+        data_start = checkpoint.write_header(checkpoint_file, header)
+
+    read, read_data_start = checkpoint.read_header(path)
+    assert read == header
+    assert read_data_start == data_start
+    assert data_start % checkpoint.ALIGNMENT == 0
+
+
+def test_read_header_rejects_other_files(tmpdir):
+    path = str(tmpdir.join('other.ckpt'))
+    with open(path, 'wb') as other_file:
+        other_file.write(b'\x00' * 64)
+    with pytest.raises(ValueError):
+        checkpoint.read_header(path)
+
+
+def test_get_attribute_follows_dots_and_lists():
+    owner = Owner()
+    owner.solver = Owner()
+    owner.solver.history = ['first', 'second']
+    assert checkpoint.get_attribute(owner, 'solver.history.1') == 'second'
+
+
+def get_multi_runner():
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    nx = ny = 32
+    sim = multi.Simulation_Runner(nx=nx, ny=ny, num_populations=2, two_d_local_size=(16, 16))
+    fluids = [multi.Fluid(sim, 0, nu=1./6.), multi.Fluid(sim, 1, nu=1./6.)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+
+    random_state = np.random.RandomState(0)
+    fluids[0].initialize(0.5 + 0.05*random_state.rand(nx, ny))
+    fluids[1].initialize(0.5 + 0.05*random_state.rand(nx, ny))
+    sim.add_interaction_force(0, 1, 1.0)
+    sim.add_screened_poisson_force(0, 1, 4., 0.01, resolve_interval=3, extrapolate=True)
+    return sim
+
+
+def test_multi_restart_continues_the_same_trajectory(opencl, tmpdir):
+    path = str(tmpdir.join('multi.ckpt'))
+
+    original = get_multi_runner()
+    original.run(4)
+    original.save_checkpoint(path)
+    original.run(5)
+
+    restarted = get_multi_runner()
+    restarted.load_checkpoint(path)
+    assert restarted.step_count == 4
+    assert restarted.poisson_schedule.last_solve_step == original.poisson_schedule.last_solve_step - 3
+    restarted.run(5)
+
+    assert restarted.poisson_schedule.num_solves == original.poisson_schedule.num_solves
+    assert np.array_equal(restarted.psi.get(), original.psi.get())
+    assert np.array_equal(restarted.rho.get(), original.rho.get())
+
+
+def get_poisson_solver(cl):
+    import pyopencl.array
+    from LB_D2Q9.poisson import solver
+
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+    n = 33
+    sources = np.zeros((n, n), dtype=np.float32, order='F')
+    sources[n//2, n//2] = 1.
+    return solver.Poisson_Solver(nx=n, ny=n, sources=cl.array.to_device(queue, sources),
+                                 delta_t=1./n**2, delta_x=1./n, context=context, queue=queue,
+                                 two_d_local_size=(16, 16), three_d_local_size=(16, 16, 1))
+
+
+def test_poisson_solver_restart_checks_at_the_same_iterations(opencl, tmpdir):
+    path = str(tmpdir.join('poisson.ckpt'))
+
+    original = get_poisson_solver(opencl)
+    original.run(45)
+    original.save_checkpoint(path)
+    original.run(10000)
+
+    restarted = get_poisson_solver(opencl)
+    restarted.load_checkpoint(path)
+    assert restarted.num_iterations == 45
+    restarted.run(10000)
+
+    assert restarted.num_iterations == original.num_iterations
+    assert np.array_equal(restarted.rho.get(), original.rho.get())
@@ -0,0 +1,82 @@
+import gc
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import diagnostics
+
+
+class Field_Holder(object):
+    """The attributes Diagnostics reads from a runner."""
+
+    def __init__(self, cl, rho, u, v):
+        import pyopencl.array
+
+        self.context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.context)
+        self.nx, self.ny = rho.shape[:2]
+        self.step_count = 0
+        self.rho = cl.array.to_device(self.queue, rho)
+        self.u = cl.array.to_device(self.queue, u)
+        self.v = cl.array.to_device(self.queue, v)
+
+
+def get_fields(dtype, num_populations, per_population_velocity, nx=37, ny=29):
+    random_state = np.random.RandomState(0)
+    rho = np.asfortranarray(0.5 + random_state.rand(nx, ny, num_populations).astype(dtype))
+    velocity_shape = (nx, ny, num_populations) if per_population_velocity else (nx, ny)
+    u = np.asfortranarray(random_state.randn(*velocity_shape).astype(dtype)*0.1)
+    v = np.asfortranarray(random_state.randn(*velocity_shape).astype(dtype)*0.1)
+
+    rho[3, 4, 0] = np.nan
+    rho[10, 2, num_populations - 1] = np.inf
+    u[5, 6] = np.inf
+    v[7, 8] = -np.nan
+    return rho, u, v
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('per_population_velocity', [True, False])
+def test_diagnostics_match_numpy(opencl, dtype, per_population_velocity):
+    num_populations = 3
+    rho, u, v = get_fields(dtype, num_populations, per_population_velocity)
+    sim = Field_Holder(opencl, rho, u, v)
+    diag = diagnostics.Diagnostics(sim, local_size=64, num_groups=4)
+    assert diag.num_populations == num_populations
+    assert diag.velocity_stride == (sim.nx*sim.ny if per_population_velocity else 0)
+
+    diag.compute()
+    results = diag.get()
+
+    rtol = 1e-5 if dtype == np.float32 else 1e-12
+    for p in range(num_populations):
+        cur_u = u[:, :, p] if per_population_velocity else u
+        cur_v = v[:, :, p] if per_population_velocity else v
+        cur_rho = rho[:, :, p].astype(np.float64)
+        finite = np.isfinite(cur_rho) & np.isfinite(cur_u) & np.isfinite(cur_v)
+
+        assert results['num_nonfinite'][p] == np.count_nonzero(~finite)
+        assert np.isclose(results['mass'][p], cur_rho[finite].sum(), rtol=rtol)
+        assert np.isclose(results['momentum_x'][p], (cur_rho*cur_u)[finite].sum(), rtol=rtol)
+        assert np.isclose(results['momentum_y'][p], (cur_rho*cur_v)[finite].sum(), rtol=rtol)
+        speed = np.sqrt(cur_u.astype(np.float64)**2 + cur_v.astype(np.float64)**2)
+        assert np.isclose(results['max_speed'][p], speed[finite].max(), rtol=rtol)
+        assert results['rho_min'][p] == rho[:, :, p][finite].min()
+        assert results['rho_max'][p] == rho[:, :, p][finite].max()
+
+
+def test_programs_are_shared_but_do_not_keep_the_context_alive(opencl):
+    import weakref
+
+    context = opencl.create_some_context(interactive=False)
+    program = diagnostics.get_program(context, np.float32)
+    assert diagnostics.get_program(context, np.float32) is program
+    key = (context.int_ptr, np.dtype(np.float32).str, 'diagnostics.cl')
+    assert key in diagnostics._program_cache
+
+    context_ref = weakref.ref(context)
+    del program, context
+    gc.collect()
+    assert key not in diagnostics._program_cache
+    assert context_ref() is None
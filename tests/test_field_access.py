@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import field_access
+
+
+def test_get_bounds():
+    assert field_access.get_bounds(None, 10, 20) == (0, 10, 0, 20)
+    assert field_access.get_bounds((slice(2, 5), slice(None)), 10, 20) == (2, 3, 0, 20)
+    with pytest.raises(ValueError):
+        field_access.get_bounds((slice(0, 10, 2), slice(None)), 10, 20)
+
+
+class Runner(field_access.Field_Access):
+    """The least a runner needs for get_field"""
+
+    field_shapes = {'rho': ('nx', 'ny'), 'f': ('nx', 'ny', 9)}
+
+    def __init__(self, cl, nx, ny):
+        import pyopencl.array
+
+        context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(context)
+        self.nx = nx
+        self.ny = ny
+        random_state = np.random.RandomState(0)
+        self.rho_host = np.asfortranarray(random_state.rand(nx, ny).astype(np.float32))
+        self.f_host = np.asfortranarray(random_state.rand(nx, ny, 9).astype(np.float32))
+        self.rho = cl.array.to_device(self.queue, self.rho_host)
+        self.f = cl.array.to_device(self.queue, self.f_host)
+
+
+def test_get_field_reads_the_declared_shapes(opencl):
+    runner = Runner(opencl, 17, 13)
+    assert runner.get_field_shapes() == {'rho': (17, 13), 'f': (17, 13, 9)}
+    assert np.array_equal(runner.get_field('rho'), runner.rho_host)
+    assert np.array_equal(runner.get_field('f'), runner.f_host)
+    with pytest.raises(ValueError):
+        runner.get_field('u')
+
+
+def test_get_field_region_and_stride(opencl):
+    runner = Runner(opencl, 17, 13)
+    region = (slice(3, 15), slice(2, 11))
+    expected = runner.f_host[3:15:2, 2:11:3]
+    assert np.array_equal(runner.get_field('f', region=region, stride=(2, 3)), expected)
+
+    out = np.empty((12, 9), dtype=np.float32, order='F')
+    assert runner.get_field('rho', out=out, region=region) is out
+    assert np.array_equal(out, runner.rho_host[3:15, 2:11])
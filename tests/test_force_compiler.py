@@ -0,0 +1,76 @@
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.multicomponent_multiphase import force_compiler
+
+D2Q9_STENCIL = ((4./9., 0, 0), (1./9., 1, 0), (1./9., 0, 1), (1./9., -1, 0), (1./9., 0, -1),
+                (1./36., 1, 1), (1./36., -1, 1), (1./36., -1, -1), (1./36., 1, -1))
+
+NUM_FLUIDS = 4
+PAIRS = list(itertools.combinations(range(NUM_FLUIDS), 2))
+
+
+def get_specs():
+    psi_slots = [(fluid, 'linear', None) for fluid in range(NUM_FLUIDS)]
+    specs = [('interaction', f1, f2, 1.0, 'periodic', 'linear', None, D2Q9_STENCIL) for f1, f2 in PAIRS]
+    return specs, psi_slots
+
+
+def test_split_keeps_every_group_within_the_budget():
+    specs, psi_slots = get_specs()
+    local_size = (16, 16)
+    tile_bytes = force_compiler.get_local_memory_size([None], 1, local_size)
+
+    assert force_compiler.split_force_specs(specs, psi_slots, local_size, 4*tile_bytes) == [tuple(specs)]
+
+    groups = force_compiler.split_force_specs(specs, psi_slots, local_size, 3*tile_bytes)
+    assert len(groups) > 1
+    assert [spec for group in groups for spec in group] == specs
+    for group in groups:
+        tiles, halo = force_compiler.get_tiles(group, psi_slots)
+        assert len(tiles) <= 3
+
+    assert force_compiler.split_force_specs(specs, psi_slots, local_size, tile_bytes) is None
+
+
+def get_forces(fuse_forces, nx=32, ny=32):
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    sim = multi.Simulation_Runner(nx=nx, ny=ny, num_populations=NUM_FLUIDS, two_d_local_size=(16, 16),
+                                  fuse_forces=fuse_forces)
+    fluids = [multi.Fluid(sim, i, nu=1./6.) for i in range(NUM_FLUIDS)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+
+    random_state = np.random.RandomState(0)
+    for fluid in fluids:
+        fluid.initialize(0.25 + 0.05*random_state.rand(nx, ny))
+    for num, (f1, f2) in enumerate(PAIRS):
+        sim.add_interaction_force(f1, f2, 0.5 + 0.1*num)
+    sim.add_static_force(1, 1e-4, -2e-4)
+
+    sim.run(1)
+    return sim, sim.Gx.get(), sim.Gy.get()
+
+
+@pytest.mark.parametrize('num_tiles, num_kernels', [(4, 1), (3, 3), (1, None)])
+def test_fused_forces_within_a_local_memory_budget_match_the_separate_kernels(opencl, monkeypatch,
+                                                                            num_tiles, num_kernels):
+    # Four tiles hold every fluid, three force a split over several kernels and one forces the separate kernels
+    unfused, expected_x, expected_y = get_forces(fuse_forces=False)
+    tile_bytes = force_compiler.get_local_memory_size([None], 1, (16, 16))
+    monkeypatch.setattr(force_compiler, 'get_max_local_memory', lambda context: num_tiles*tile_bytes)
+    sim, Gx, Gy = get_forces(fuse_forces=True)
+
+    if num_kernels is None:
+        assert sim.fused_force_kernels is None
+    else:
+        assert len(sim.fused_force_kernels) == num_kernels
+
+    assert np.abs(expected_x).max() > 0
+    assert np.allclose(Gx, expected_x, rtol=1e-10, atol=1e-14)
+    assert np.allclose(Gy, expected_y, rtol=1e-10, atol=1e-14)
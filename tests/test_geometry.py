@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('skimage')
+from LB_D2Q9 import geometry
+from LB_D2Q9 import obstacles
+
+
+@pytest.mark.parametrize('N, center, radius', [(10, (2., 1.5), 1.), (16, (1.25, 0.75), 0.5), (25, (3., 2.), 1.)])
+def test_circle_matches_the_mask_skimage_drew(N, center, radius):
+    import skimage.draw
+
+    nx, ny = 5*N, 4*N
+    expected = np.zeros((nx, ny), dtype=np.bool_)
+    rows, cols = skimage.draw.circle(N*center[0], N*center[1], N*radius)
+    expected[rows, cols] = True
+
+    assert np.array_equal(geometry.Circle(center, radius).rasterize(nx, ny, N), expected)
+
+
+def test_cache_round_trip(tmpdir, monkeypatch):
+    monkeypatch.setattr(geometry, '_memory_cache', geometry._memory_cache.__class__())
+    cache_dir = str(tmpdir)
+    shape = geometry.Union([geometry.Circle((1., 1.), 0.4),
+                            geometry.Polygon([(2., 0.5), (2.8, 0.5), (2.4, 1.5)])])
+
+    built = geometry.get_rasterized_geometry(shape, 60, 40, 20, periodic=(True, False), cache_dir=cache_dir)
+    assert len(tmpdir.listdir()) == 1
+    assert geometry.get_rasterized_geometry(shape, 60, 40, 20, periodic=(True, False), cache_dir=cache_dir) is built
+
+    loaded = geometry.Rasterized_Geometry.load(str(tmpdir.listdir()[0]))
+    assert (loaded.nx, loaded.ny, loaded.periodic) == (60, 40, (True, False))
+    assert np.array_equal(loaded.mask, shape.rasterize(60, 40, 20))
+    for name in geometry.Rasterized_Geometry.TABLE_NAMES:
+        assert np.array_equal(getattr(loaded, name), getattr(built, name))
+
+    # A fresh process finds the file instead of rasterising again
+    geometry._memory_cache.clear()
+    monkeypatch.setattr(obstacles, 'get_bounceback_pairs', None)
+    from_disk = geometry.get_rasterized_geometry(shape, 60, 40, 20, periodic=(True, False), cache_dir=cache_dir)
+    assert np.array_equal(from_disk.mask, built.mask)
+    assert np.array_equal(from_disk.neighbours, built.neighbours)
+
+
+def test_memory_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(geometry, '_memory_cache', geometry._memory_cache.__class__())
+    monkeypatch.setattr(geometry, 'MEMORY_CACHE_SIZE', 2)
+    circles = [geometry.Circle((1., 1.), 0.1*(i + 1)) for i in range(3)]
+
+    first = geometry.get_rasterized_geometry(circles[0], 20, 20, 10, cache_dir=None)
+    geometry.get_rasterized_geometry(circles[1], 20, 20, 10, cache_dir=None)
+    assert geometry.get_rasterized_geometry(circles[0], 20, 20, 10, cache_dir=None) is first # Now the most recent
+    geometry.get_rasterized_geometry(circles[2], 20, 20, 10, cache_dir=None)
+
+    assert len(geometry._memory_cache) == 2
+    assert geometry.get_rasterized_geometry(circles[0], 20, 20, 10, cache_dir=None) is first
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import initialization
+
+NX, NY = 20, 12
+NUM_FIELDS = 3
+NUM_JUMPERS = 9
+
+
+class Grid(object):
+    """The attributes Initializer reads from a runner."""
+
+    def __init__(self, cl):
+        self.context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.context)
+        self.nx, self.ny = NX, NY
+        self.two_d_local_size = (8, 4)
+        self.two_d_global_size = (24, 12)
+
+
+def get_initializer(cl):
+    return initialization.Initializer(Grid(cl))
+
+
+def get_random_field(shape, dtype, seed=0):
+    return np.asfortranarray(np.random.RandomState(seed).rand(*shape).astype(dtype))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_set_field_slice_writes_one_population(opencl, dtype):
+    import pyopencl.array
+
+    initializer = get_initializer(opencl)
+    queue = initializer.sim.queue
+    original = get_random_field((NX, NY, NUM_FIELDS), dtype)
+    field = opencl.array.to_device(queue, original)
+    x, y = np.meshgrid(np.arange(NX), np.arange(NY), indexing='ij')
+
+    initializer.set_field_slice(field, 1, 2.5)
+    expected = original.copy()
+    expected[:, :, 1] = 2.5
+    assert np.array_equal(field.get(), expected)
+
+    host_values = get_random_field((NX, NY), np.float64, seed=1)
+    initializer.set_field_slice(field, 0, host_values)
+    expected[:, :, 0] = host_values
+    assert np.array_equal(field.get(), expected)
+
+    initializer.set_field_slice(field, 2, '1 + 0.5*sin(2*M_PI*x/nx) + 0.25*y')
+    expected[:, :, 2] = 1 + 0.5*np.sin(2*np.pi*x/NX) + 0.25*y
+    rtol = 1e-5 if dtype == np.float32 else 1e-12
+    assert np.array_equal(field.get()[:, :, :2], expected[:, :, :2])
+    assert np.allclose(field.get()[:, :, 2], expected[:, :, 2], rtol=rtol)
+
+
+def test_set_field_slice_of_a_buffer(opencl):
+    initializer = get_initializer(opencl)
+    original = get_random_field((NX, NY, 2), np.float32)
+    buf = opencl.Buffer(initializer.sim.context, opencl.mem_flags.READ_WRITE | opencl.mem_flags.COPY_HOST_PTR,
+                        hostbuf=original)
+
+    initializer.set_field_slice(buf, 1, 'x + 100*y')
+    result = np.empty_like(original)
+    opencl.enqueue_copy(initializer.sim.queue, result, buf)
+
+    x, y = np.meshgrid(np.arange(NX), np.arange(NY), indexing='ij')
+    assert np.array_equal(result[:, :, 0], original[:, :, 0])
+    assert np.array_equal(result[:, :, 1], x + 100*y)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_perturb_populations_writes_only_its_own_field(opencl, dtype):
+    import pyopencl.array
+
+    initializer = get_initializer(opencl)
+    queue = initializer.sim.queue
+    shape = (NX, NY, NUM_FIELDS, NUM_JUMPERS)
+    original = get_random_field(shape, dtype)
+    feq_host = 0.1 + get_random_field(shape, dtype, seed=1)
+    f = opencl.array.to_device(queue, original)
+    feq = opencl.array.to_device(queue, feq_host)
+
+    initializer.perturb_populations(f, feq, 1, NUM_FIELDS, NUM_JUMPERS, 0.)
+    expected = original.copy()
+    expected[:, :, 1, :] = feq_host[:, :, 1, :]
+    assert np.array_equal(f.get(), expected)
+
+    initializer.perturb_populations(f, feq, 2, NUM_FIELDS, NUM_JUMPERS, 0.01)
+    result = f.get()
+    assert np.array_equal(result[:, :, :2, :], expected[:, :, :2, :])
+    noise = result[:, :, 2, :]/feq_host[:, :, 2, :] - 1
+    assert 0.005 < noise.std() < 0.02
+    assert abs(noise.mean()) < 0.002
@@ -0,0 +1,41 @@
+import gc
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import memory_pool
+
+
+def test_allocator_is_shared_per_context_and_released_with_its_users(opencl):
+    import pyopencl.array
+
+    context = opencl.create_some_context(interactive=False)
+    queue = opencl.CommandQueue(context)
+    allocator = memory_pool.get_allocator(queue)
+    assert memory_pool.get_allocator(opencl.CommandQueue(context)) is allocator
+
+    field = opencl.array.zeros(queue, (16, 16), dtype=np.float32, allocator=allocator)
+    key = context.int_ptr
+    del allocator
+    gc.collect()
+    # The array still uses the pool
+    assert key in memory_pool._allocator_cache
+
+    del field
+    gc.collect()
+    assert key not in memory_pool._allocator_cache
+
+
+def test_pool_reuses_freed_blocks_without_warnings(opencl, recwarn):
+    import pyopencl.array
+
+    context = opencl.create_some_context(interactive=False)
+    queue = opencl.CommandQueue(context)
+    allocator = memory_pool.get_allocator(queue)
+
+    field = opencl.array.zeros(queue, (64, 64), dtype=np.float64, allocator=allocator)
+    for i in range(3):
+        (field + 1.).get()
+    assert allocator.stats()['held_blocks'] + allocator.stats()['active_blocks'] <= 2
+    assert not [w for w in recwarn if 'non-deferred' in str(w.message)]
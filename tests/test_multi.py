@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+
+D2Q9_STENCIL = ((4./9., 0, 0), (1./9., 1, 0), (1./9., 0, 1), (1./9., -1, 0), (1./9., 0, -1),
+                (1./36., 1, 1), (1./36., -1, 1), (1./36., -1, -1), (1./36., 1, -1))
+
+# (fluid 1, fluid 2, G_int, bc, potential, parameters); each force after the first adds a psi slot
+INTERACTIONS = [(0, 1, 0.7, 'periodic', 'shan_chen', [1.2]),
+                (1, 2, 0.5, 'zero_gradient', 'pow', [1.5]),
+                (0, 2, 0.3, 'periodic', 'shan_chen', [1.2]),
+                (2, 0, 1.0, 'periodic', 'vdw', [9./49., 2./21., 0.8, 1./np.sqrt(3.)])]
+
+
+def get_psi(rho, potential, parameters):
+    rho = np.maximum(rho, 0)
+    if potential == 'shan_chen':
+        return parameters[0]*(1 - np.exp(-rho/parameters[0]))
+    if potential == 'pow':
+        return rho**parameters[0]
+    a, b, T, cs = parameters
+    P = rho*T/(1 - rho*b) - a*rho**2
+    return np.sqrt(2*(P - cs**2*rho)/cs**2)
+
+
+def get_neighbour(field, cx, cy, bc):
+    """The field at (x + cx, y + cy), wrapped or clamped at the edges like get_BC."""
+    if bc == 'periodic':
+        return np.roll(np.roll(field, -cx, axis=0), -cy, axis=1)
+    padded = np.pad(field, 1, mode='edge')
+    nx, ny = field.shape
+    return padded[1 + cx:1 + cx + nx, 1 + cy:1 + cy + ny]
+
+
+def get_pair_forces(rho, interactions):
+    """The force of every pair, with psi evaluated from rho for each pair separately."""
+    Gx = np.zeros_like(rho)
+    Gy = np.zeros_like(rho)
+    for f1, f2, G_int, bc, potential, parameters in interactions:
+        psi_1 = get_psi(rho[:, :, f1], potential, parameters)
+        psi_2 = get_psi(rho[:, :, f2], potential, parameters)
+        for w, cx, cy in D2Q9_STENCIL:
+            Gx[:, :, f1] -= G_int*psi_1*w*cx*get_neighbour(psi_2, cx, cy, bc)
+            Gy[:, :, f1] -= G_int*psi_1*w*cy*get_neighbour(psi_2, cx, cy, bc)
+            Gx[:, :, f2] -= G_int*psi_2*w*cx*get_neighbour(psi_1, cx, cy, bc)
+            Gy[:, :, f2] -= G_int*psi_2*w*cy*get_neighbour(psi_1, cx, cy, bc)
+    return Gx, Gy
+
+
+@pytest.mark.parametrize('fuse_forces', [True, False])
+def test_forces_from_shared_psi_match_forces_per_pair(opencl, fuse_forces):
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    nx, ny = 26, 18
+    sim = multi.Simulation_Runner(nx=nx, ny=ny, num_populations=3, two_d_local_size=(8, 8),
+                                  fuse_forces=fuse_forces)
+    fluids = [multi.Fluid(sim, i, nu=1./6.) for i in range(3)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+
+    random_state = np.random.RandomState(2)
+    for fluid in fluids:
+        fluid.initialize(0.25 + 0.1*random_state.rand(nx, ny))
+    for f1, f2, G_int, bc, potential, parameters in INTERACTIONS:
+        sim.add_interaction_force(f1, f2, G_int, bc=bc, potential=potential, potential_parameters=parameters)
+    # The third force reuses the shan_chen slot of fluid 0, and psi is reallocated for every new slot
+    assert len(sim.psi_slots) == 7
+
+    sim.run(1)
+    if fuse_forces:
+        assert sim.fused_force_kernels is not None
+
+    expected_x, expected_y = get_pair_forces(sim.rho.get(), INTERACTIONS)
+    assert np.abs(expected_x).max() > 0
+    assert np.allclose(sim.Gx.get(), expected_x, rtol=1e-10, atol=1e-14)
+    assert np.allclose(sim.Gy.get(), expected_y, rtol=1e-10, atol=1e-14)
+
+
+def get_runner(batch_fluids, nx=30, ny=20):
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    fluid_bcs = ['zero_gradient', 'periodic', 'zero_gradient', 'periodic']
+    sim = multi.Simulation_Runner(nx=nx, ny=ny, num_populations=len(fluid_bcs), two_d_local_size=(8, 8),
+                                  batch_fluids=batch_fluids)
+    fluids = [multi.Fluid(sim, i, nu=0.05 + 0.1*i, bc=bc) for i, bc in enumerate(fluid_bcs)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+
+    random_state = np.random.RandomState(1)
+    for fluid in fluids:
+        fluid.initialize(0.25 + 0.05*random_state.rand(nx, ny))
+    sim.add_interaction_force(0, 1, 0.9)
+    sim.add_interaction_force(2, 3, 0.7, bc='zero_gradient')
+    sim.add_constant_g_force(1, 2e-5, 1e-5)
+    return sim
+
+
+def test_batched_launches_match_launches_per_fluid(opencl):
+    expected = get_runner(batch_fluids=False)
+    expected.run(15)
+    sim = get_runner(batch_fluids=True)
+    sim.run(15)
+
+    assert [num_fields for bc, table, num_fields in sim.fluid_groups] == [2, 2]
+    assert np.abs(expected.v_bary.get()).max() > 0
+    for name in ['f', 'feq', 'rho', 'u', 'v', 'u_bary', 'v_bary', 'Gx', 'Gy']:
+        assert np.array_equal(getattr(sim, name).get(), getattr(expected, name).get()), name
+
+
+def get_d2q25_runner(runner_class, nx=36, ny=28):
+    fluid_bcs = ['periodic', 'zero_gradient', 'periodic']
+    sim = runner_class(nx=nx, ny=ny, num_populations=len(fluid_bcs), two_d_local_size=(8, 8))
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    fluids = [multi.Fluid(sim, i, nu=0.1 + 0.05*i, bc=bc) for i, bc in enumerate(fluid_bcs)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+
+    random_state = np.random.RandomState(0)
+    for fluid in fluids:
+        fluid.initialize(0.3 + 0.05*random_state.rand(nx, ny))
+    sim.add_interaction_force(0, 1, 0.8)
+    sim.add_interaction_force(1, 2, 0.6, bc='zero_gradient')
+    sim.add_constant_g_force(2, 1e-5, -2e-5)
+    return sim
+
+
+def test_d2q25_kernels_match_the_generic_kernels(opencl):
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    class Generic_Runner(multi.Simulation_RunnerD2Q25):
+        # Stream, compute feq and collide with the kernels of multi.cl, fed the same D2Q25 velocities
+        move_fields = multi.Simulation_Runner.move_fields.im_func
+        collide_fields = multi.Simulation_Runner.collide_fields.im_func
+        update_feq = multi.Simulation_Runner.update_feq.im_func
+
+    expected = get_d2q25_runner(Generic_Runner)
+    expected.run(20)
+    sim = get_d2q25_runner(multi.Simulation_RunnerD2Q25)
+    sim.run(20)
+
+    assert int(sim.num_jumpers) == 25
+    assert np.abs(expected.u_bary.get()).max() > 0
+    for name in ['f', 'rho', 'u_bary', 'v_bary', 'Gx', 'Gy']:
+        assert np.allclose(getattr(sim, name).get(), getattr(expected, name).get(), rtol=1e-12, atol=1e-15), name
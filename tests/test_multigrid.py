@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.poisson import multigrid
+
+
+def get_problem(nx, ny):
+    random_state = np.random.RandomState(0)
+    u = np.zeros((nx, ny), dtype=np.float32, order='F')
+    f = np.asfortranarray(random_state.rand(nx, ny).astype(np.float32))
+    return u, f
+
+
+def test_even_sizes_are_rejected():
+    assert multigrid.get_coarse_size(33) == 17
+    with pytest.raises(ValueError):
+        multigrid.get_coarse_size(32)
+    with pytest.raises(ValueError):
+        multigrid.Multigrid_Poisson(32, 33, backend='numpy')
+
+
+def test_odd_sizes_stop_coarsening_at_an_even_level():
+    solver = multigrid.Multigrid_Poisson(45, 33, backend='numpy')
+    assert solver.sizes == [(45, 33), (23, 17), (12, 9)]
+    for (nx, ny), (nx_c, ny_c) in zip(solver.sizes[:-1], solver.sizes[1:]):
+        assert 2*(nx_c - 1) == nx - 1
+        assert 2*(ny_c - 1) == ny - 1
+
+
+@pytest.mark.parametrize('nx, ny', [(33, 33), (45, 33)])
+def test_cycles_converge(nx, ny):
+    solver = multigrid.Multigrid_Poisson(nx, ny, backend='numpy')
+    u, f = get_problem(nx, ny)
+    residuals = [solver.get_relative_residual(u, f)]
+    for i in range(8):
+        solver.cycle(u, f)
+        residuals.append(solver.get_relative_residual(u, f))
+    assert residuals[-1] < 1e-4*residuals[0]
+
+
+def test_opencl_backend_matches_numpy(opencl):
+    import pyopencl.array
+
+    nx, ny = 45, 33
+    context = opencl.create_some_context(interactive=False)
+    queue = opencl.CommandQueue(context)
+    u, f = get_problem(nx, ny)
+    u_device, f_device = opencl.array.to_device(queue, u), opencl.array.to_device(queue, f)
+
+    host_solver = multigrid.Multigrid_Poisson(nx, ny, backend='numpy')
+    device_solver = multigrid.Multigrid_Poisson(nx, ny, context=context, queue=queue, two_d_local_size=(16, 16))
+    for i in range(3):
+        host_solver.cycle(u, f)
+        device_solver.cycle(u_device, f_device)
+    assert np.allclose(u_device.get(), u, rtol=1e-4, atol=1e-4*np.abs(u).max())
+
+
+def get_incremental_solver(cl, n):
+    from LB_D2Q9.poisson import solver
+
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+    x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    sources = np.asfortranarray(np.exp(-((x - n/2.)**2 + (y - n/3.)**2)/(n/8.)**2).astype(np.float32))
+    sources = cl.array.to_device(queue, sources)
+    poisson = solver.Poisson_Solver(nx=n, ny=n, sources=sources, delta_t=1./n**2, delta_x=1./n,
+                                    context=context, queue=queue, two_d_local_size=(16, 16),
+                                    three_d_local_size=(16, 16, 1), method='multigrid', incremental=True)
+    return poisson, sources
+
+
+def test_incremental_solve_of_an_unchanged_source_costs_at_most_one_cycle(opencl):
+    import pyopencl.array
+
+    poisson, sources = get_incremental_solver(opencl, 129)
+    poisson.run(100)
+    assert poisson.num_iterations < 100
+    assert poisson.multigrid.get_relative_residual(poisson.rho, poisson.multigrid_rhs) < poisson.tolerance
+
+    for i in range(3):
+        poisson.update_source(sources)
+        poisson.run(100)
+        assert poisson.num_iterations <= 1
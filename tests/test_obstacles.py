@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+
+from LB_D2Q9 import obstacles
+
+CX = obstacles.D2Q9_CX
+CY = obstacles.D2Q9_CY
+
+# A 5 x 4 lattice with an L shaped obstacle touching the x = 0 edge
+MASK = np.zeros((5, 4), dtype=np.bool_)
+MASK[0, 1] = MASK[1, 1] = MASK[1, 2] = True
+
+
+def get_source(x, y, i, nx, ny, periodic):
+    """The node the population moving in direction i streams from into (x, y), or None if it is off the lattice."""
+    source_x, source_y = x - CX[i], y - CY[i]
+    if periodic[0]:
+        source_x %= nx
+    if periodic[1]:
+        source_y %= ny
+    if 0 <= source_x < nx and 0 <= source_y < ny:
+        return source_x, source_y
+    return None
+
+
+@pytest.mark.parametrize('periodic', [(False, False), (True, False), (True, True)])
+def test_fluid_node_tables_follow_the_streaming_sources(periodic):
+    nx, ny = MASK.shape
+    fluid_nodes, neighbours = obstacles.get_fluid_node_tables(MASK, periodic=periodic)
+
+    expected_nodes = [y*nx + x for y in range(ny) for x in range(nx) if not MASK[x, y]]
+    assert fluid_nodes.tolist() == expected_nodes
+    assert neighbours.shape == (9, len(expected_nodes))
+
+    for n, node in enumerate(expected_nodes):
+        x, y = node % nx, node // nx
+        for i in range(9):
+            source = get_source(x, y, i, nx, ny, periodic)
+            if source is None or MASK[source]:
+                assert neighbours[i, n] == -1
+            else:
+                assert fluid_nodes[neighbours[i, n]] == source[1]*nx + source[0]
+
+    nodes, directions = obstacles.get_link_list(neighbours)
+    assert sorted(zip(nodes.tolist(), directions.tolist())) == \
+        sorted(zip(*[a.tolist() for a in np.nonzero(neighbours.T < 0)]))
+
+
+def test_a_geometry_without_fluid_is_rejected():
+    with pytest.raises(ValueError):
+        obstacles.get_fluid_node_tables(np.ones((3, 3), dtype=np.bool_))
+
+
+def test_bounceback_pairs_cover_every_link_once():
+    nx, ny = MASK.shape
+    x, y, directions, opposites = obstacles.get_bounceback_pairs(MASK)
+    assert np.all(directions < opposites)
+    assert np.array_equal(opposites, obstacles.get_opposite(CX, CY)[directions])
+
+    touched = sorted(zip(x, y, directions)) + sorted(zip(x, y, opposites))
+    assert len(set(touched)) == len(touched) # No population is swapped twice
+
+    links = set(zip(*obstacles.get_boundary_links(MASK)))
+    expected_links = set((sx, sy, i) for sx in range(nx) for sy in range(ny) for i in range(9)
+                         if MASK[sx, sy] and get_source(sx, sy, i, nx, ny, (False, False)) is not None
+                         and not MASK[get_source(sx, sy, i, nx, ny, (False, False))])
+    assert links == expected_links
+    assert links <= set(touched)
+
+
+def test_pair_list_bounceback_matches_swapping_every_solid_node(tmpdir, monkeypatch):
+    pytest.importorskip('skimage')
+    from LB_D2Q9 import geometry
+    from LB_D2Q9.dimensionless import python_dim
+
+    monkeypatch.setattr(geometry.get_rasterized_geometry, '__defaults__', ((False, False), str(tmpdir)))
+
+    class Full_Swap_Cylinder(python_dim.Pipe_Flow_Cylinder):
+        """Bounces back every population of every solid node, as Pipe_Flow_Cylinder used to, on an inert obstacle."""
+
+        def move_bcs(self):
+            python_dim.Pipe_Flow.move_bcs(self)
+            x, y = np.nonzero(self.obstacle_mask)
+            for i, j in [(1, 3), (2, 4), (5, 7), (6, 8)]:
+                old_f = self.f[i, x, y]
+                self.f[i, x, y] = self.f[j, x, y]
+                self.f[j, x, y] = old_f
+
+        def collide_particles(self):
+            solid_f = self.f[:, self.obstacle_mask]
+            python_dim.Pipe_Flow.collide_particles(self)
+            self.f[:, self.obstacle_mask] = solid_f
+
+    kwargs = dict(diameter=1., rho=1., viscosity=1., pressure_grad=-10., pipe_length=3., N=20,
+                  time_prefactor=1., cylinder_center=[0.75, 0.5], cylinder_radius=0.1)
+    np.random.seed(0) # init_pop perturbs f
+    pair_list = python_dim.Pipe_Flow_Cylinder(**kwargs)
+    np.random.seed(0)
+    full_swap = Full_Swap_Cylinder(**kwargs)
+    assert pair_list.bounceback_x.shape[0] < np.count_nonzero(pair_list.obstacle_mask) * 4
+
+    pair_list.run(20)
+    full_swap.run(20)
+
+    fluid = ~pair_list.obstacle_mask
+    assert np.abs(pair_list.f[:, fluid]).max() > 0
+    assert np.array_equal(pair_list.f[:, fluid], full_swap.f[:, fluid])
+
+
+@pytest.mark.parametrize('module_name', ['opencl_dim', 'opencl_dim_D2Q9i'])
+def test_opencl_obstacle_keeps_the_link_populations_out_of_the_collision(opencl, tmpdir, monkeypatch, module_name):
+    pytest.importorskip('skimage')
+    import importlib
+    from LB_D2Q9 import geometry
+
+    monkeypatch.setattr(geometry.get_rasterized_geometry, '__defaults__', ((False, False), str(tmpdir)))
+    module = importlib.import_module('LB_D2Q9.dimensionless.' + module_name)
+    sim = module.Pipe_Flow_Cylinder(diameter=1., rho=1., viscosity=1., pressure_grad=-10., pipe_length=3., N=10,
+                                    time_prefactor=1., cylinder_center=[0.75, 0.5], cylinder_radius=0.1,
+                                    two_d_local_size=(16, 16), three_d_local_size=(16, 16, 1))
+    sim.move_bcs()
+    sim.move()
+    sim.update_hydro()
+    sim.update_feq()
+    before = sim.get_field('f')
+    sim.collide_particles()
+    after = sim.get_field('f')
+
+    x, y, directions, opposites = sim.rasterized_geometry.get_bounceback_pairs()
+    assert x.shape[0] > 0
+    assert np.array_equal(after[x, y, directions], before[x, y, directions])
+    assert np.array_equal(after[x, y, opposites], before[x, y, opposites])
+    fluid = sim.obstacle_mask_host == 0
+    assert not np.array_equal(after[fluid], before[fluid])
+
+
+def test_the_obstacle_runner_takes_any_geometry(tmpdir, monkeypatch):
+    pytest.importorskip('skimage')
+    from LB_D2Q9 import geometry
+    from LB_D2Q9.dimensionless import python_dim
+
+    monkeypatch.setattr(geometry.get_rasterized_geometry, '__defaults__', ((False, False), str(tmpdir)))
+    kwargs = dict(diameter=1., rho=1., viscosity=1., pressure_grad=-10., pipe_length=3., N=4,
+                  time_prefactor=1., cylinder_radius=0.1)
+
+    # In units of the cylinder radius, the characteristic length
+    image = np.zeros((8, 8))
+    image[2:6, 1:7] = 1
+    shapes = [geometry.Polygon([(5., 3.), (9., 5.), (5., 7.)]),
+              geometry.Image_Mask(image, (14., 3., 4., 4.)),
+              geometry.Circle([7.5, 5.], 1.)]
+    for shape in shapes:
+        sim = python_dim.Pipe_Flow_Cylinder(geometry=shape, **kwargs)
+        expected = geometry.get_rasterized_geometry(shape, sim.nx, sim.ny, sim.N)
+        assert np.count_nonzero(sim.obstacle_mask) > 0
+        assert np.array_equal(sim.obstacle_mask, expected.mask)
+        assert np.array_equal(sim.bounceback_x, expected.get_bounceback_pairs()[0])
+
+        sim.run(5)
+        assert np.all(sim.u[sim.obstacle_mask] == 0)
+        assert np.abs(sim.u).max() > 0
+
+    # Without a geometry, the obstacle is the cylinder
+    default = python_dim.Pipe_Flow_Cylinder(cylinder_center=[0.75, 0.5], **kwargs)
+    assert np.array_equal(default.obstacle_mask, sim.obstacle_mask)
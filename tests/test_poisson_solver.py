@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.poisson import solver
+
+
+def get_solver(cl, n=32, **kwargs):
+    import pyopencl.array
+
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+    x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    sources = np.asfortranarray(np.exp(-((x - n/2.)**2 + (y - n/3.)**2)/(n/8.)**2).astype(np.float32))
+    return solver.Poisson_Solver(nx=n, ny=n, sources=cl.array.to_device(queue, sources), delta_t=1./n**2,
+                                 delta_x=1./n, context=context, queue=queue, two_d_local_size=(16, 16),
+                                 three_d_local_size=(16, 16, 1), **kwargs)
+
+
+def check(poisson, num_iterations, relative_change):
+    poisson.num_iterations = num_iterations
+    poisson.update_check_interval(relative_change)
+    return poisson.check_interval
+
+
+def test_check_interval_follows_the_contraction_rate(opencl):
+    poisson = get_solver(opencl, tolerance=1e-6, check_interval=10, max_check_interval=1000)
+    assert check(poisson, 10, 1e-2) == 10 # Nothing to predict from yet
+
+    # A factor of 10 over 10 iterations leaves 30 iterations to 1e-6, of which half are run before the next check
+    assert check(poisson, 20, 1e-3) == 15
+    assert poisson.next_check == 35
+
+    assert check(poisson, 35, 2e-3) == 30 # Diverging: back off
+    assert check(poisson, 65, 1e-1) == 60
+    assert check(poisson, 125, 1e-1) == 120 # No contraction at all
+    assert check(poisson, 245, 1e-30) == 1 # Far past the tolerance, but checked at least every iteration
+
+@pytest.mark.parametrize('tolerance, relative_change', [(0., 1e-3), (1e-6, 0.)])
+def test_check_interval_without_a_prediction_backs_off(opencl, tolerance, relative_change):
+    poisson = get_solver(opencl, tolerance=tolerance, check_interval=10, max_check_interval=50)
+    assert check(poisson, 10, 1e-2) == 10
+    assert check(poisson, 20, relative_change) == 20
+    assert check(poisson, 40, relative_change) == 40
+    assert check(poisson, 80, relative_change) == 50
+
+
+def test_zero_tolerance_runs_every_iteration(opencl):
+    poisson = get_solver(opencl, tolerance=0., check_interval=10)
+    poisson.run(300)
+    assert poisson.num_iterations == 300
+
+
+def test_relative_change_from_a_zero_solution_is_infinite():
+    assert solver.get_relative_change(1e-3, 0.) == np.inf
+    assert solver.get_relative_change(0., 0.) == 0.
+    assert solver.get_relative_change(1., -4.) == 0.25
+
+
+@pytest.mark.parametrize('multigrid_backend', ['opencl', 'numpy'])
+def test_multigrid_from_zero_does_not_divide_by_zero(opencl, recwarn, multigrid_backend):
+    poisson = get_solver(opencl, n=33, method='multigrid', multigrid_backend=multigrid_backend)
+    poisson.run(50)
+    assert 1 < poisson.num_iterations < 50
+    assert not [w for w in recwarn if issubclass(w.category, RuntimeWarning)]
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import recorder
+
+
+class Runner(recorder.Recordable):
+    """A runner whose step adds one to every node of rho"""
+
+    def __init__(self, cl, nx, ny):
+        import pyopencl.array
+
+        self.context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.context)
+        self.nx = nx
+        self.ny = ny
+        self.step_count = 0
+        self.recorders = []
+        random_state = np.random.RandomState(0)
+        self.rho_host = np.asfortranarray(random_state.rand(nx, ny).astype(np.float32))
+        self.rho = cl.array.to_device(self.queue, self.rho_host)
+
+    def run(self, num_iterations):
+        for i in range(num_iterations):
+            self.rho += 1
+            self.rho_host += 1
+            self.step_count += 1
+            self.update_recorders()
+
+
+def test_recorder_writes_every_interval_across_flushes(opencl):
+    runner = Runner(opencl, 19, 11)
+    series = recorder.Scalar_Recorder(runner, interval=2, capacity=3, local_size=64, num_groups=4)
+    series.add_probe('corner', 'rho', 18, 10)
+    series.add_reduction('mass', 'rho')
+    series.add_reduction('peak', 'rho', op='max')
+    runner.add_recorder(series)
+
+    initial = runner.rho_host.copy()
+    runner.run(15)
+    results = series.get()
+
+    # Seven rows pass through a three row buffer, so it is flushed twice while running and once by get()
+    steps = np.arange(2, 16, 2)
+    assert np.array_equal(results['step'], steps)
+    assert np.allclose(results['corner'], initial[18, 10] + steps)
+    assert np.allclose(results['mass'], initial.sum() + initial.size*steps, rtol=1e-5)
+    assert np.allclose(results['peak'], initial.max() + steps)
+
+
+def test_observables_must_be_registered_before_recording(opencl):
+    runner = Runner(opencl, 8, 8)
+    series = recorder.Scalar_Recorder(runner)
+    with pytest.raises(ValueError):
+        series.record()
+    series.add_reduction('mass', 'rho')
+    series.record()
+    with pytest.raises(ValueError):
+        series.add_probe('corner', 'rho', 0, 0)
+    with pytest.raises(ValueError):
+        series.add_probe('outside', 'rho', 8, 0)
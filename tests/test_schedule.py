@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.spectral_poisson import schedule
+from LB_D2Q9.spectral_poisson import screened_poisson as sp
+
+
+def get_schedule(cl, **kwargs):
+    import pyopencl.array
+
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+    random_state = np.random.RandomState(0)
+    density_host = np.asfortranarray(1. + random_state.rand(16, 12))
+    solver = sp.Screened_Poisson(density_host, cl_context=context, cl_queue=queue, fft_backend='numpy',
+                                 two_d_local_size=(16, 16))
+    solver.create_grad_fields()
+    return schedule.Resolve_Schedule(solver, **kwargs), cl.array.to_device(queue, density_host)
+
+
+def test_tolerance_solves_one_step_after_the_change(opencl):
+    resolve_schedule, density = get_schedule(opencl, interval=None, tolerance=0.1)
+    for step in range(3):
+        resolve_schedule.update(density, step)
+    assert resolve_schedule.num_solves == 1
+    assert resolve_schedule.get_relative_change(density) < 1e-6
+
+    density *= 2
+    resolve_schedule.update(density, 3) # Measures the change
+    assert resolve_schedule.num_solves == 1
+    resolve_schedule.update(density, 4) # Reads it and solves
+    assert resolve_schedule.num_solves == 2
+    assert resolve_schedule.last_solve_step == 4
+    resolve_schedule.update(density, 5)
+    assert resolve_schedule.num_solves == 2
+
+
+def test_pending_change_survives_a_checkpoint(opencl):
+    resolve_schedule, density = get_schedule(opencl, interval=None, tolerance=0.1)
+    resolve_schedule.update(density, 0)
+    density *= 2
+    resolve_schedule.update(density, 1)
+
+    restored, restored_density = get_schedule(opencl, interval=None, tolerance=0.1)
+    restored.set_checkpoint_state(resolve_schedule.get_checkpoint_state())
+    restored.update(restored_density, 2)
+    assert restored.num_solves == 2
+    assert restored.last_solve_step == 2
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.spectral_poisson import screened_poisson as sp
+
+
+def get_charge(nx, ny):
+    random_state = np.random.RandomState(0)
+    return np.asfortranarray(random_state.rand(nx, ny).astype(np.float32))
+
+
+def solve(cl, charge, fft_backend, lam=3.):
+    context = cl.create_some_context(interactive=False)
+    queue = cl.CommandQueue(context)
+    solver = sp.Screened_Poisson(charge, cl_context=context, cl_queue=queue, lam=lam, fft_backend=fft_backend,
+                                 two_d_local_size=(16, 16))
+    solver.create_grad_fields()
+    solver.solve_and_update_grad_fields()
+    grad_fields = solver.grad_fields.get()
+
+    solver.fft_and_screen()
+    solver.inverse_fft()
+    return solver, solver.charge.get(), grad_fields
+
+
+@pytest.mark.parametrize('nx, ny', [(32, 24), (33, 25)])
+def test_numpy_backend_matches_a_direct_transform(opencl, nx, ny):
+    charge = get_charge(nx, ny)
+    solver, screened, grad_fields = solve(opencl, charge, 'numpy')
+
+    # x is the halved axis of the spectrum
+    spectrum = np.fft.rfftn(charge.astype(np.float64), axes=(1, 0))
+    freq_x, freq_y = np.meshgrid(solver.freq_x, solver.freq_y, indexing='ij')
+    spectrum /= solver.lam**2*(freq_x**2 + freq_y**2) + 1.
+    grad_x, grad_y = np.meshgrid(solver.grad_freq_x, solver.grad_freq_y, indexing='ij')
+
+    shape = (ny, nx)
+    assert np.allclose(screened, np.fft.irfftn(spectrum, s=shape, axes=(1, 0)), atol=1e-5)
+    assert np.allclose(grad_fields[:, :, 0], np.fft.irfftn(1j*grad_x*spectrum, s=shape, axes=(1, 0)), atol=1e-4)
+    assert np.allclose(grad_fields[:, :, 1], np.fft.irfftn(1j*grad_y*spectrum, s=shape, axes=(1, 0)), atol=1e-4)
+
+
+@pytest.mark.parametrize('nx, ny', [(32, 24), (33, 25)])
+def test_gpyfft_backend_matches_numpy(opencl, nx, ny):
+    pytest.importorskip('gpyfft')
+    charge = get_charge(nx, ny)
+    host_solver, host_screened, host_grad_fields = solve(opencl, charge, 'numpy')
+    device_solver, device_screened, device_grad_fields = solve(opencl, charge, 'gpyfft')
+
+    assert np.allclose(device_screened, host_screened, atol=1e-5)
+    assert np.allclose(device_grad_fields, host_grad_fields, atol=1e-4)
+
+
+def test_runner_passes_its_local_size_to_the_solver(opencl):
+    from LB_D2Q9.multicomponent_multiphase import multi
+
+    nx = ny = 32
+    sim = multi.Simulation_Runner(nx=nx, ny=ny, num_populations=2, two_d_local_size=(8, 8))
+    fluids = [multi.Fluid(sim, 0, nu=1./6.), multi.Fluid(sim, 1, nu=1./6.)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+    for fluid in fluids:
+        fluid.initialize(0.5)
+    sim.add_screened_poisson_force(0, 1, 4., 0.01)
+
+    assert sim.poisson_solver.two_d_local_size == (8, 8)
+    sim.run(2)
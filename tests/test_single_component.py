@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.porous_media import single_component
+
+
+def get_driven_run(slow_path, nx=24, ny=20):
+    sim = single_component.Simulation_Runner(nx=nx, ny=ny, num_populations=2, two_d_local_size=(16, 16))
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    epsilon = 0.6 + 0.3*np.sin(2*np.pi*x/nx)**2
+    fluids = [single_component.Pourous_Media(sim, 0, nu_e=1./6., nu_fluid=1./6., epsilon=epsilon, K=5., Fe=0.1),
+              single_component.Pourous_Media(sim, 1, nu_e=1./4., nu_fluid=1./4., K=20.)]
+    for fluid in fluids:
+        sim.add_fluid(fluid)
+    sim.complete_setup()
+    fluids[0].initialize(1. + 0.1*np.cos(2*np.pi*y/ny))
+    fluids[1].initialize(0.5)
+
+    sim.add_constant_body_force(0, 1e-4, -2e-5)
+    sim.add_radial_body_force(1, nx/2, ny/2, 1e-6, 1.)
+    if slow_path:
+        # A force that adds nothing, but is evaluated every step like the forces that read the neighbours
+        sim.additional_forces.append([sim.kernels.add_constant_body_force,
+                                      [sim.queue, sim.two_d_global_size, sim.two_d_local_size,
+                                       single_component.int_type(0), single_component.num_type(0.),
+                                       single_component.num_type(0.), sim.Gx.data, sim.Gy.data, sim.nx, sim.ny]])
+
+    sim.run(40)
+    return sim
+
+
+def test_static_forces_on_the_fused_path_match_the_separate_kernels(opencl):
+    fused = get_driven_run(slow_path=False)
+    separate = get_driven_run(slow_path=True)
+
+    assert np.abs(fused.u_bary.get()).max() > 0
+    for name in ['f', 'rho', 'u', 'v', 'Gx', 'Gy', 'u_bary', 'v_bary']:
+        assert np.allclose(getattr(fused, name).get(), getattr(separate, name).get(), rtol=1e-12, atol=1e-18), name
+
+
+def test_reading_forces_requires_a_static_force(opencl):
+    sim = single_component.Simulation_Runner(nx=16, ny=16, two_d_local_size=(16, 16))
+    with pytest.raises(ValueError):
+        sim.update_hydro_forces_bary(read_forces=True)
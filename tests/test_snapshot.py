@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import snapshot
+
+
+class Swapping_Runner(object):
+    """Writes the step number into f_new and swaps it with f every step, like Sparse_Flow."""
+
+    def __init__(self, cl, nx=8, ny=6):
+        import pyopencl.array
+
+        self.context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.context)
+        self.nx, self.ny = nx, ny
+        self.step_count = 0
+        host = np.zeros((nx, ny, 2), dtype=np.float64, order='F')
+        self.f = cl.array.to_device(self.queue, host)
+        self.f_new = cl.array.to_device(self.queue, host)
+        self.rho = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size=nx*ny*4)
+
+    def run(self, num_iterations):
+        for i in range(num_iterations):
+            self.step_count += 1
+            self.f_new.fill(self.step_count)
+            self.f, self.f_new = self.f_new, self.f
+        self.queue.finish()
+
+
+def test_snapshots_follow_swapped_fields_across_chunks(opencl, tmpdir):
+    sim = Swapping_Runner(opencl)
+    writer = snapshot.Snapshot_Writer(sim, str(tmpdir), field_names=['f', 'rho'], interval=3, num_buffers=2,
+                                      chunk_size=2)
+    writer.run(16)
+    writer.close()
+
+    steps, fields = snapshot.load_store(str(tmpdir))
+    assert steps == [3, 6, 9, 12, 15]
+    assert len(fields['f']) == 3
+    assert fields['rho'][0].shape == (2, sim.nx, sim.ny)
+    for i, step in enumerate(steps):
+        saved = fields['f'][i // 2][i % 2]
+        assert saved.shape == (sim.nx, sim.ny, 2)
+        assert np.all(saved == step)
+
+
+def test_a_reallocated_field_of_another_shape_is_rejected(opencl, tmpdir):
+    import pyopencl.array
+
+    sim = Swapping_Runner(opencl)
+    writer = snapshot.Snapshot_Writer(sim, str(tmpdir), field_names=['f'], interval=1)
+    writer.record()
+    sim.f = opencl.array.zeros(sim.queue, (sim.nx, sim.ny, 3), dtype=np.float64, order='F')
+    with pytest.raises(ValueError):
+        writer.record()
+    writer.close()
+
+
+def test_writer_errors_are_raised_on_the_main_thread(opencl, tmpdir, monkeypatch):
+    sim = Swapping_Runner(opencl)
+    writer = snapshot.Snapshot_Writer(sim, str(tmpdir), field_names=['f'], interval=1)
+
+    def append(step, host_set):
+        raise IOError('disk full')
+    monkeypatch.setattr(writer, 'append', append)
+
+    writer.record()
+    with pytest.raises(IOError):
+        writer.close()
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9 import obstacles
+
+CX = obstacles.D2Q9_CX
+CY = obstacles.D2Q9_CY
+OPPOSITE = obstacles.get_opposite(CX, CY)
+W = np.array([4./9., 1./9., 1./9., 1./9., 1./9., 1./36., 1./36., 1./36., 1./36.])
+
+
+def dense_step(f, mask, omega, force, periodic):
+    """One step of pull streaming, halfway bounceback and BGK with Guo forcing on the full (9, nx, ny) lattice."""
+    nx, ny = mask.shape
+    streamed = np.empty_like(f)
+    for i in range(9):
+        from_solid = np.roll(np.roll(mask, CX[i], axis=0), CY[i], axis=1)
+        # Sources across a wall are off the lattice
+        if not periodic[0] and CX[i] != 0:
+            from_solid[0 if CX[i] > 0 else nx - 1, :] = True
+        if not periodic[1] and CY[i] != 0:
+            from_solid[:, 0 if CY[i] > 0 else ny - 1] = True
+        shifted = np.roll(np.roll(f[i], CX[i], axis=0), CY[i], axis=1)
+        streamed[i] = np.where(from_solid, f[OPPOSITE[i]], shifted)
+
+    gx, gy = force
+    cs2 = 1./3.
+    rho = streamed.sum(axis=0)
+    u = np.tensordot(CX, streamed, axes=1)/rho + gx/2.
+    v = np.tensordot(CY, streamed, axes=1)/rho + gy/2.
+
+    collided = np.empty_like(f)
+    for i in range(9):
+        c_dot_u = CX[i]*u + CY[i]*v
+        c_dot_g = CX[i]*gx + CY[i]*gy
+        feq = W[i]*rho*(1 + c_dot_u/cs2 + c_dot_u**2/(2*cs2**2) - (u**2 + v**2)/(2*cs2))
+        Fi = (1 - .5*omega)*W[i]*rho*((c_dot_g - (u*gx + v*gy))/cs2 + c_dot_u*c_dot_g/cs2**2)
+        collided[i] = streamed[i]*(1 - omega) + omega*feq + Fi
+    return collided, rho, u, v
+
+
+def get_obstacle_mask(nx, ny):
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    mask = (x - 8)**2 + (y - 6)**2 < 9
+    mask |= (x > 16) & (x < 20) & (y > 2) & (y < 9)
+    return mask
+
+
+@pytest.mark.parametrize('periodic', [(True, True), (True, False)])
+def test_sparse_flow_matches_a_dense_lattice(opencl, periodic):
+    from LB_D2Q9.sparse import sparse_flow
+
+    nx, ny = 24, 13
+    mask = get_obstacle_mask(nx, ny)
+    force = (1e-4, -3e-5)
+    sim = sparse_flow.Sparse_Flow(mask, viscosity=0.1, force=force, periodic=periodic, local_size=32)
+
+    f = W[:, None, None]*np.ones((9, nx, ny))
+    for step in range(30):
+        f, rho, u, v = dense_step(f, mask, sim.omega, force, periodic)
+    sim.run(30)
+
+    fluid = ~mask
+    assert np.abs(u[fluid]).max() > 0
+    assert np.allclose(sim.get_field('f')[fluid], f[:, fluid].T, rtol=1e-12, atol=1e-15)
+    assert np.allclose(sim.get_field('rho')[fluid], rho[fluid], rtol=1e-12, atol=1e-15)
+    assert np.allclose(sim.get_field('u')[fluid], u[fluid], rtol=1e-12, atol=1e-15)
+    assert np.allclose(sim.get_field('v')[fluid], v[fluid], rtol=1e-12, atol=1e-15)
+    assert np.all(sim.get_field('rho', fill=-1)[mask] == -1)
+
+
+def test_channel_flow_is_poiseuille_and_the_walls_balance_the_force(opencl):
+    from LB_D2Q9.sparse import sparse_flow
+
+    nx, ny = 4, 10
+    gx = 1e-5
+    viscosity = np.sqrt(3./16.)/3. # tau = 1/2 + sqrt(3/16), where BGK bounces back exactly halfway
+    sim = sparse_flow.Sparse_Flow(np.zeros((nx, ny)), viscosity=viscosity, force=(gx, 0.),
+                                  periodic=(True, False), local_size=32)
+    sim.run(4000)
+
+    # Halfway bounceback puts the walls half a node outside the lattice
+    y = np.arange(ny)
+    expected = gx/(2*viscosity)*(y + .5)*(ny - .5 - y)
+    u = sim.get_field('u')
+    assert np.allclose(u, expected[None, :], rtol=1e-4)
+    assert np.abs(sim.get_field('v')).max() < 1e-12
+
+    total_mass = sim.get_field('rho').sum()
+    assert np.allclose(sim.get_obstacle_force(), [gx*total_mass, 0.], rtol=1e-3, atol=1e-12)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyopencl')
+from LB_D2Q9.porous_media import single_component
+
+
+def get_runner(force_x=0.):
+    sim = single_component.Simulation_Runner(nx=16, ny=16, two_d_local_size=(16, 16))
+    fluid = single_component.Pourous_Media(sim, 0, nu_e=1./6., nu_fluid=1./6., K=1.)
+    sim.add_fluid(fluid)
+    sim.complete_setup()
+    fluid.initialize(1.0)
+    if force_x != 0:
+        sim.add_constant_body_force(0, force_x, 0.)
+    return sim
+
+
+def test_a_fluid_at_rest_is_not_converged(opencl):
+    sim = get_runner()
+    result = sim.run_to_steady_state(force=(1e-5, 0.), check_every=10, max_iterations=100)
+    assert not result['converged']
+    assert result['num_iterations'] == 10
+
+
+def test_a_zero_superficial_velocity_is_not_converged(opencl, monkeypatch):
+    sim = get_runner(force_x=1e-5)
+    # A circulating flow: the velocity field is steady but averages to zero
+    monkeypatch.setattr(sim, 'get_steady_state_sums', lambda: (0., 0., 0., 1.))
+    result = sim.run_to_steady_state(check_every=10, max_iterations=50)
+    assert not result['converged']
+    assert result['num_iterations'] == 50
+
+
+def test_a_driven_flow_converges(opencl):
+    sim = get_runner(force_x=1e-5)
+    result = sim.run_to_steady_state(tol=1e-4, check_every=50, max_iterations=20000)
+    assert result['converged']
+    assert result['superficial_velocity'][0] > 0
+    assert np.isfinite(result['permeability'])